@@ -15,14 +15,26 @@ IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 or implied.
 """
 
-import meraki
 import time
 import sys
+import logging
 from credentials import api_key, org_id
+try:
+    from credentials import orgs
+except ImportError:
+    # credentials.py from before multiple organizations were supported
+    orgs = []
+from dashboard_orgs import LazyDashboardAPI, load_orgs, poll_order, read_network_list
 from datetime import datetime
-
-#dasboard_call_delay is the number of seconds to wait between calls to the Meraki Dashboard to evaluate the condition of
-# uplinks. This can be as little as .20 seconds, but that would be the limit of API calls per second an application can make.
+from selector_logging import setup_logging, log_event, log_state_change
+from probe_recorder import ProbeRecorder
+from latency_estimators import UplinkLatencyStats
+from task_scheduler import TaskScheduler
+from diagnostics import LoopWatchdog, SamplingProfiler, install_profile_signal
+from uplink_reconciler import UplinkReconciler, RECONCILE_POLICIES
+
+#dasboard_call_delay is the number of seconds between the starts of successive calls to the Meraki Dashboard to
+# evaluate the condition of uplinks. This can be as little as .20 seconds, but that would be the limit of API calls per second an application can make.
 # default is set to 1 seconds so that the script can get the updated statistics at most 1 second after they are available,
 # giving us visibility in to stats starting at 121 seconds in the past.
 dashboard_call_delay=1
@@ -42,6 +54,23 @@ average_latency_tolerance=0.400
 # we have a loss problem
 average_loss_tolerance=30
 
+# latency_failover_criterion selects which latency statistic over the trouble_eval_window is compared against
+# average_latency_tolerance:
+#   'mean' : the plain average of the samples (default). A single very bad sample can push it over the tolerance
+#   'p50', 'p95' or 'p99' : the median, 95th or 99th percentile of the samples
+#   'ewma' : exponentially weighted moving average with a half life of half the trouble_eval_window
+latency_failover_criterion='mean'
+
+# jitter_tolerance: set to a number of seconds to also consider WAN1 unstable when the jitter between consecutive
+# latency samples (computed as in RFC 3550) goes above it. Set to None to not check jitter
+jitter_tolerance=None
+
+# selectable_uplinks: the uplinks the script may fail over to when WAN1 is in trouble. Every uplink the Dashboard reports
+# loss and latency for ('wan3' and 'cellular' on the MX models that have them) is evaluated, and when several of the
+# selectable ones are up the one within the tolerances with the lowest average loss, then latency, is chosen. The
+# Dashboard only accepts WAN uplinks as default uplink, so a cellular uplink is evaluated and logged but never selected
+selectable_uplinks=['wan1','wan2']
+
 
 
 # number of seconds after failing over to secondary WAN link to wait until evaluating main link again to switch back
@@ -53,36 +82,248 @@ failback_wait_time = 240
 # any devices unless you set useWhiteList to False
 useWhiteList=True
 
-
-dashboard = meraki.DashboardAPI(api_key, output_log=False, suppress_logging= True)
+# log_level controls how much the script reports: 'DEBUG' also logs the latency and loss averages of every device,
+# 'INFO' logs a summary per Dashboard call. Uplink changes (failover and failback) are always logged.
+log_level='INFO'
+# log_file is the file to append JSON lines log entries to. Set to None to write them to the console instead
+log_file=None
+# log_reading_sample_rate: only 1 of every log_reading_sample_rate routine evaluations per device is logged at DEBUG level
+log_reading_sample_rate=10
+
+# record_file: set to a file name to record every loss and latency sample retrieved from the Dashboard and the device inventory to a compact
+# binary log that can later be replayed faster than real time with replay.py to tune the thresholds above. An
+# existing log is appended to. Set to None to disable recording
+record_file=None
+
+# inventory_refresh_interval is the number of seconds between checks for new devices in the Dashboard
+inventory_refresh_interval=3600
+
+# main() runs the Dashboard polls and inventory refreshes at their own deadlines. A task starting more than
+# task_miss_tolerance seconds after its deadline counts as a deadline miss; the number of runs and misses and the
+# lateness of every task are logged every task_stats_interval seconds
+task_miss_tolerance=0.050
+task_stats_interval=60
+
+# watchdog_stall_threshold: when a loop of main() has not gone round for this many seconds, for example because a
+# Dashboard call hangs, an alert with the stack of every thread is logged, and another entry when it recovers. Set to
+# None to disable the watchdog
+watchdog_stall_threshold=30
+
+# sending the process SIGUSR1 (kill -USR1 <pid>) samples the stacks of all threads for profile_duration seconds and
+# writes a report of where the time went to a <script>-profile-<time>.txt file in profile_report_dir
+profile_duration=30
+profile_report_dir='.'
+
+# reconcile_interval: every reconcile_interval seconds the uplink selection of the next reconcile_batch_size monitored
+# networks is read back from the Dashboard, reconcile_concurrency at a time and within dashboard_calls_per_second, to
+# catch changes made outside of the script. reconcile_policy is 'adopt' to take over the uplink selection found in the
+# Dashboard (a network manually failed over to WAN2 waits failback_wait_time before failing back) or 'enforce' to write
+# the script's own uplink selection back. Set reconcile_interval to None to never read the uplink selection back
+reconcile_interval=300
+reconcile_batch_size=100
+reconcile_concurrency=4
+reconcile_policy='adopt'
+
+log = setup_logging('MX_dashboard_uplink_monitor_selector', level=log_level, log_file=log_file,
+                    sample_every=log_reading_sample_rate)
+
+# dashboard_base_url is the root of the Meraki Dashboard API v1. Only change it to point the script at a
+# different Dashboard region or at a local mock Dashboard used for benchmarking
+dashboard_base_url='https://api.meraki.com/api/v1'
+
+# the Dashboard client, the meraki SDK is only imported when it is first used
+dashboard = LazyDashboardAPI(api_key, base_url=dashboard_base_url, output_log=False, suppress_logging= True)
+
+# dashboard_calls_per_second is the maximum number of Dashboard API calls per second the script makes for each
+# organization (the Dashboard allows 10 per organization). Set to None to not limit them
+dashboard_calls_per_second=5
+
+# monitored_orgs holds the OrgContext (Dashboard client, rate limiter and whitelist files) of every organization in
+# credentials.py by org id, and orgOfNetwork the org id of every monitored network. Both are filled in by
+# refreshDevicesDict()
+monitored_orgs={}
+orgOfNetwork={}
+
+# knownUplinkSelection holds the last uplink selection read from or written to the Dashboard for every monitored
+# network, as [load_balancing, default_uplink, time.monotonic() of the read or write], so that writes that would not
+# change anything are skipped
+knownUplinkSelection={}
+
+# clock returns the current time (UTC) used for all evaluation window and failback calculations. replay.py replaces
+# it with a virtual clock
+def clock():
+    return datetime.utcnow().timestamp()
+
+# converts the 'ts' of a Dashboard loss and latency sample to the same time base as clock()
+def ts_to_timestamp(ts):
+    return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ').timestamp()
+
+# recorder is the ProbeRecorder writing to record_file, created in main() when recording is enabled
+recorder=None
+
+
+def org_of_network(networkId):
+    # the OrgContext of the organization a network belongs to (the first one if not known)
+    global monitored_orgs
+    if not monitored_orgs:
+        monitored_orgs = load_orgs(orgs, api_key, org_id, dashboard, dashboard_base_url, dashboard_calls_per_second)
+    return monitored_orgs.get(orgOfNetwork.get(networkId)) or next(iter(monitored_orgs.values()))
+
+def set_uplink_selection(networkId, load_balancing, default_uplink):
+    # every uplink selection change made by the script goes through here so it can be recorded, or redirected
+    # when replaying recorded probe logs (see replay.py)
+    known=knownUplinkSelection.get(networkId)
+    if known is not None and known[0]==load_balancing and known[1]==default_uplink:
+        log_event(log, logging.INFO, "uplink selection of %s already set, not writing it", networkId,
+                  networkId=networkId, load_balancing=load_balancing, uplink=default_uplink)
+        return
+    if recorder is not None:
+        recorder.record_action(clock(), networkId, default_uplink, load_balancing)
+    # since we call the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
+    # we need to guarantee that we do not call the API more than dashboard_calls_per_second times per second for
+    # the organization; its client waits for the organization's rate limiter, even if many other objects will have to
+    # make a WAN change
+    org_of_network(networkId).dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(
+        networkId=networkId, loadBalancingEnabled=load_balancing, defaultUplink=default_uplink)
+    knownUplinkSelection[networkId]=[load_balancing, default_uplink, time.monotonic()]
 
 
 class WAN_device:
     global trouble_eval_window, average_latency_tolerance, average_loss_tolerance, failback_wait_time
 
-    def __init__(self, networkId, serial, my_org_number, uplink1_ip, uplink2_ip):
+    def __init__(self, networkId, serial, my_org_number, uplink1_ip, uplink2_ip, extra_uplinks=()):
         self.networkId = networkId
         self.serial = serial
         self.my_org_number = my_org_number
-        self.uplink1_ip = uplink1_ip
-        self.uplink2_ip = uplink2_ip
         self.current_uplink = 1
-        self.loss1=0
-        self.loss2=0
-        self.latency1=0
-        self.latency2=0
         self.last_failover_time=0
-        self.init_time=time.time()
-        self.lat1_reports=[]
-        self.loss1_reports=[]
+        self.init_time=clock()
+        # everything per uplink is kept in lists indexed like self.uplinks: WAN1 is index 0 and WAN2 index 1, followed by
+        # any other uplink the Dashboard reports for the device ('wan3', 'cellular'). current_uplink is the index of the
+        # uplink in use plus 1
+        self.uplinks=[]
+        self.uplink_ips=[]
+        # uplinks in selectable_uplinks, the ones that can be made the default uplink
+        self.selectable=[]
+        # streaming percentile, EWMA and jitter estimators for latency_failover_criterion and jitter_tolerance, fed with
+        # each latency sample only once even though the Dashboard returns it for 5 minutes
+        self.lat_stats=[]
+        self.lat_stats_ts=[]
+        self.add_uplink('wan1', uplink1_ip)
+        self.add_uplink('wan2', uplink2_ip)
+        for name, ip in extra_uplinks:
+            self.add_uplink(name, ip)
 
     def __repr__(self):
         return(f'NetworkId: {self.networkId}, Serial: {self.serial}, Org number: {self.my_org_number}')
 
+    def add_uplink(self, name, ip=None):
+        # returns the index of the new uplink
+        if name in selectable_uplinks:
+            self.selectable.append(len(self.uplinks))
+        self.uplinks.append(name)
+        self.uplink_ips.append(ip)
+        self.lat_stats.append(UplinkLatencyStats(trouble_eval_window))
+        self.lat_stats_ts.append(0)
+        return len(self.uplinks)-1
+
+    @property
+    def uplink1_ip(self):
+        return self.uplink_ips[0]
+
+    @property
+    def uplink2_ip(self):
+        return self.uplink_ips[1]
+
+    def evaluate_window(self, index, timeSeries, current_time):
+        # evaluates all timeseries entries of one uplink and calculates its average loss and latency for the latest
+        # trouble_eval_window seconds. Returns the failover_latency and failover_loss summaries and whether the uplink
+        # is active: it returned samples and none of them is null or 100% loss, no point in switching to it if not
+        # configured or disconnected!!
+
+        # These are just variuos datetime calculations we are going to need
+        #max_lat_dt = datetime.strptime(max_lat_ts, '%Y-%m-%dT%H:%M:%SZ')
+        #current_dt = datetime.fromtimestamp(current_time)
+        #no_microseconds_time = time.mktime(current_dt.timetuple())
+        #dt_string= current_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+        failover_latency={
+            'cumulative':0,
+            'counts':0,
+            'max_ts': current_time-10000,
+            'min_ts': current_time,
+            'average':0
+        }
+        failover_loss={
+            'cumulative':0,
+            'counts':0,
+            'max_ts': current_time-10000,
+            'min_ts': current_time,
+            'average':0
+        }
+        bActive=True
+
+        lat_stats=self.lat_stats[index]
+        newest_stats_ts=self.lat_stats_ts[index]
+        for tsEntry in timeSeries:
+            entry_timestamp = ts_to_timestamp(tsEntry['ts'])
+
+            if 'lossPercent' in tsEntry:
+                if tsEntry['lossPercent']==None or tsEntry['lossPercent']==100:
+                    bActive=False
+                if tsEntry['lossPercent']!=None:
+                    if ((current_time - entry_timestamp)>=120) and ((current_time - entry_timestamp)<(120 + trouble_eval_window)):
+                        failover_loss['cumulative']+=tsEntry['lossPercent']
+                        failover_loss['counts']+=1
+                        if entry_timestamp<failover_loss['min_ts']:
+                            failover_loss['min_ts']=entry_timestamp
+                        if entry_timestamp>failover_loss['max_ts']:
+                            failover_loss['max_ts']=entry_timestamp
+            if 'latencyMs' in tsEntry:
+                if tsEntry['latencyMs']==None:
+                    bActive=False
+                else:
+                    if entry_timestamp>self.lat_stats_ts[index]:
+                        lat_stats.add(entry_timestamp, tsEntry['latencyMs']/1000)
+                        newest_stats_ts=max(newest_stats_ts, entry_timestamp)
+                    if ((current_time - entry_timestamp)>=120) and ((current_time - entry_timestamp)<(120 + trouble_eval_window)):
+                        failover_latency['cumulative']+=tsEntry['latencyMs']/1000
+                        failover_latency['counts']+=1
+                        if entry_timestamp<failover_latency['min_ts']:
+                            failover_latency['min_ts']=entry_timestamp
+                        if entry_timestamp>failover_latency['max_ts']:
+                            failover_latency['max_ts']=entry_timestamp
+
+        if failover_latency['counts']>0:
+            failover_latency['average']=failover_latency['cumulative']/failover_latency['counts']
+        if failover_loss['counts']>0:
+            failover_loss['average']=failover_loss['cumulative']/failover_loss['counts']
+        self.lat_stats_ts[index]=newest_stats_ts
+
+        # the latency statistic checked against average_latency_tolerance (and the jitter, if configured). The
+        # Dashboard data ends 120 seconds in the past so that is where the window of the estimators ends too
+        failover_latency['criterion']=lat_stats.value(latency_failover_criterion, current_time-120,
+                                                      failover_latency['average'])
+        return failover_latency, failover_loss, bActive
+
+    def is_troubled(self, index, failover_latency, failover_loss):
+        return failover_latency['criterion']>average_latency_tolerance or \
+               (jitter_tolerance is not None and self.lat_stats[index].jitter.value>jitter_tolerance) or \
+               failover_loss['average']>average_loss_tolerance
+
+    def best_uplink(self, windows, exclude=()):
+        # ranks the active selectable uplinks not in exclude, those within the tolerances first, then by average loss
+        # and latency, and returns the index of the best one (None if there is none)
+        candidates=[i for i in self.selectable if windows[i] is not None and windows[i][3] and i not in exclude]
+        if len(candidates)==0:
+            return None
+        return min(candidates, key=lambda i: (windows[i][2], windows[i][1]['average'], windows[i][0]['criterion']))
+
     def uplink_selector(self, ulinksLatency):
-        # current box stats for both WAN1 and WAN2 are passed in via 2 element array ulinksLatency
+        # current box stats of every uplink are passed in via the list ulinksLatency, indexed like self.uplinks
         # ulinksLatency[0] contains timeseries with Loss and Latency for WAN1
-        # ulinksLatency[1] contains timeseries with Loss and Latency for WAN2
+        # ulinksLatency[1] contains timeseries with Loss and Latency for WAN2, and so on
         # the measure can be one of these three:
         #    None : no measurements where returned by the dashboard this time
         #   Array of dicts :   each dict corresponds to a measurement at a timestamp
@@ -102,129 +343,71 @@ class WAN_device:
 
 
         #first let's grab a current timestamp to use in all operations (UTC)
-        current_time=datetime.utcnow().timestamp()
+        current_time=clock()
 
 
         # now check for the existence of a WAN1 uplink (otherwise do nothing)
-        if (ulinksLatency[0] != None):
-            # now let's make the calculations to see if the data contained in ulinksLatency[0]
-            # indicates average latency in the trouble_eval_window period is greater than average_latency_tolerance or if
-            # the average loss is greater than average_loss_tolerance percent
-
-            # 1- evaluate all timeseries entries in ulinksLatency[0] and calculate average loss and latency for the latest trouble_eval_window seconds
-
-            # These are just variuos datetime calculations we are going to need
-            #max_lat_dt = datetime.strptime(max_lat_ts, '%Y-%m-%dT%H:%M:%SZ')
-            #current_dt = datetime.fromtimestamp(current_time)
-            #no_microseconds_time = time.mktime(current_dt.timetuple())
-            #dt_string= current_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-
-            failover_latency={
-                'cumulative':0,
-                'counts':0,
-                'max_ts': current_time-10000,
-                'min_ts': current_time,
-                'average':0
-            }
-            failover_loss={
-                'cumulative':0,
-                'counts':0,
-                'max_ts': current_time-10000,
-                'min_ts': current_time,
-                'average':0
-            }
-
-
-
-            for tsEntry in ulinksLatency[0]:
-                entry_timestamp_dt = datetime.strptime(tsEntry['ts'], '%Y-%m-%dT%H:%M:%SZ')
-                entry_timestamp = entry_timestamp_dt.timestamp()
-
-                # print("tabulatings for ", self.serial)
-                # print("Entry: ",tsEntry)
-                # print("current_time ",current_time)
-                # print("entry_timestamp ",entry_timestamp)
-                # print("trouble_eval_window ",trouble_eval_window)
-
-
-
-                if 'lossPercent' in tsEntry and tsEntry['lossPercent']!=None:
-                    if ((current_time - entry_timestamp)>=120) and ((current_time - entry_timestamp)<(120 + trouble_eval_window)):
-                        failover_loss['cumulative']+=tsEntry['lossPercent']
-                        failover_loss['counts']+=1
-                        if entry_timestamp<failover_loss['min_ts']:
-                            failover_loss['min_ts']=entry_timestamp
-                        if entry_timestamp>failover_loss['max_ts']:
-                            failover_loss['max_ts']=entry_timestamp
-                if 'latencyMs' in tsEntry and tsEntry['latencyMs']!=None:
-                    if ((current_time - entry_timestamp)>=120) and ((current_time - entry_timestamp)<(120 + trouble_eval_window)):
-                        failover_latency['cumulative']+=tsEntry['latencyMs']/1000
-                        failover_latency['counts']+=1
-                        if entry_timestamp<failover_latency['min_ts']:
-                            failover_latency['min_ts']=entry_timestamp
-                        if entry_timestamp>failover_latency['max_ts']:
-                            failover_latency['max_ts']=entry_timestamp
-
-            if failover_latency['counts']>0:
-                failover_latency['average']=failover_latency['cumulative']/failover_latency['counts']
-            if failover_loss['counts']>0:
-                failover_loss['average']=failover_loss['cumulative']/failover_loss['counts']
-
-            #print("Evaluating ",self.serial)
-            #print("Failover latency: ", failover_latency)
-            #print("Failover loss: ", failover_loss)
-            print("Evaluating ",self.serial," with Ave. latency of ",failover_latency['average']," and Ave. loss of ",failover_loss['average']," ",end='')
-
-            # check for the existence of WAN2 also if it is responding, no point in switching to it
-            # if not configured or disconnected!!
-            #first check for empty data structure
-            bActiveWAN2 = not (ulinksLatency[1] == None)
-            #then to see if any of the stats come back null
-            if bActiveWAN2:
-                for tsEntry in ulinksLatency[1]:
-                    if 'lossPercent' in tsEntry:
-                        if tsEntry['lossPercent']==None or tsEntry['lossPercent']==100:
-                            bActiveWAN2=False
-                    if 'latencyMs' in tsEntry:
-                        if tsEntry['latencyMs'] == None:
-                            bActiveWAN2 = False
-
-            print("bActiveWAN2 is ",bActiveWAN2)
+        if len(ulinksLatency)>0 and ulinksLatency[0] != None:
+            # (failover_latency, failover_loss, troubled, active) of every uplink the Dashboard returned stats for
+            windows=[]
+            for index, timeSeries in enumerate(ulinksLatency):
+                if timeSeries is None:
+                    windows.append(None)
+                    continue
+                failover_latency, failover_loss, bActive = self.evaluate_window(index, timeSeries, current_time)
+                windows.append((failover_latency, failover_loss,
+                                self.is_troubled(index, failover_latency, failover_loss), bActive))
+            failover_latency, failover_loss, bTroubledWAN1, _ = windows[0]
+
+            log_event(log, logging.DEBUG, "Evaluating %s", self.serial, sample_key=self.serial, serial=self.serial,
+                      average_latency=failover_latency['average'], average_loss=failover_loss['average'],
+                      latency=failover_latency['criterion'], jitter=self.lat_stats[0].jitter.value,
+                      active=[self.uplinks[i] for i, window in enumerate(windows) if window is not None and window[3]])
             # ready to check to see if we have to make any uplink changes
             # first, and only if we are currently on uplink 1 (WAN1), check to see if it has been problematic during
-            # the last seconds specified in trouble_eval_window and see if we need to switch to uplink2 (WAN2)
-            if self.current_uplink==1 and bActiveWAN2 and (failover_latency['average']>average_latency_tolerance or failover_loss['average']>average_loss_tolerance):
-
-                # if WAN2 exists and have problems with WAN1, set it as uplink on device, turn off load balancing and record the time we failed over
-                dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(networkId=self.networkId, loadBalancingEnabled=False, defaultUplink='wan2')
-                # since we called the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
-                # we need to guarantee that we do not call the API more than 5 times per second so if we add a .2 sec delay
-                # here , even if many other objects will have to make a WAN change, we will not be calling more than 5 times a second
-                time.sleep(.20)
-                self.current_uplink = 2
-                self.last_failover_time=current_time
-                print('WAN1 problems after tolerance period: Load Balancing disabled, using WAN2 as uplink')
-            else:
-                if self.current_uplink==2 and current_time-self.last_failover_time>failback_wait_time:
-                    # since enough time has passed since failover to WAN2, and WAN1 seems to have been healthy for the past
-                    # number of seconds specified by trouble_eval_window, it is safe to fail back to WAN1 and turn
-                    # on load balancing.
-                    print("Two minutes have passed since failover, check to see if WAN1 is ok to switch back...")
-                    if failover_latency['average']<=average_latency_tolerance and failover_loss['average']<=average_loss_tolerance:
-                        dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(
-                            networkId=self.networkId, loadBalancingEnabled=True, defaultUplink='wan1')
-                        # since we called the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
-                        # we need to guarantee that we do not call the API more than 5 times per second so if we add a .2 sec delay
-                        # here , even if many other objects will have to make a WAN change, we will not be calling more than 5 times a second
-                        time.sleep(.20)
-                        self.current_uplink = 1
-                        print('WAN1 good after failback wait time: Failing back to WAN1 as uplink, Load Balancing enabled')
+            # the last seconds specified in trouble_eval_window and see if we need to switch to the best other uplink
+            current=self.current_uplink-1
+            if current==0:
+                best=self.best_uplink(windows, exclude=(0,)) if bTroubledWAN1 else None
+                if best is not None:
+                    # if another uplink exists and have problems with WAN1, set it as uplink on device, turn off load balancing and record the time we failed over
+                    set_uplink_selection(self.networkId, load_balancing=False, default_uplink=self.uplinks[best])
+                    self.current_uplink = best+1
+                    self.last_failover_time=current_time
+                    log_state_change(log, 'failover', self.serial, self.networkId,
+                                     'WAN1 problems after tolerance period: Load Balancing disabled, using %s as uplink',
+                                     self.uplinks[best].upper(), uplink=self.uplinks[best], load_balancing=False,
+                                     average_latency=failover_latency['average'], average_loss=failover_loss['average'])
+            elif current_time-self.last_failover_time>failback_wait_time and not bTroubledWAN1:
+                # since enough time has passed since failover, and WAN1 seems to have been healthy for the past
+                # number of seconds specified by trouble_eval_window, it is safe to fail back to WAN1 and turn
+                # on load balancing.
+                set_uplink_selection(self.networkId, load_balancing=True, default_uplink='wan1')
+                self.current_uplink = 1
+                log_state_change(log, 'failback', self.serial, self.networkId,
+                                 'WAN1 good after failback wait time: Failing back to WAN1 as uplink, Load Balancing enabled',
+                                 uplink='wan1', load_balancing=True, average_latency=failover_latency['average'],
+                                 average_loss=failover_loss['average'])
+            elif current<len(windows) and windows[current] is not None and \
+                    (windows[current][2] or not windows[current][3]):
+                # the uplink we failed over to is in trouble too, move on to the best other one
+                best=self.best_uplink(windows, exclude=(0, current))
+                if best is not None:
+                    set_uplink_selection(self.networkId, load_balancing=False, default_uplink=self.uplinks[best])
+                    self.current_uplink = best+1
+                    self.last_failover_time=current_time
+                    log_state_change(log, 'failover', self.serial, self.networkId,
+                                     '%s problems after tolerance period: using %s as uplink',
+                                     self.uplinks[current].upper(), self.uplinks[best].upper(),
+                                     uplink=self.uplinks[best], load_balancing=False,
+                                     average_latency=windows[current][0]['average'],
+                                     average_loss=windows[current][1]['average'])
 
 
 
 allMXDevices={}
 responsesPerSerial = {}
+# one timeSeries (or None) per uplink of the device, indexed like its uplinks
 # example responsesPerSerial['ER34234']=
 #   [
 #             {
@@ -249,28 +432,42 @@ responsesPerSerial = {}
 
 
 def refreshDevicesDict():
-    global allMXDevices, allUplinkIPs, useWhiteList, responsesPerSerial
+    global allMXDevices, allUplinkIPs, useWhiteList, responsesPerSerial, monitored_orgs, orgOfNetwork, knownUplinkSelection
     allUplinkIPs=[]
     allMXDevices = {}
-    white_list=[]
+    orgOfNetwork = {}
+    knownUplinkSelection = {}
+    # the organizations already monitored keep their clients, rate limiters and poll times
+    monitored_orgs = load_orgs(orgs, api_key, org_id, dashboard, dashboard_base_url, dashboard_calls_per_second,
+                               monitored_orgs)
+
+    # the devices of all organizations are evaluated together
+    for monitored_org in monitored_orgs.values():
+        refreshOrgDevices(monitored_org)
+
+def refreshOrgDevices(monitored_org):
+    # adds the devices of one organization to allMXDevices, using the organization's Dashboard client and whitelist
+    dashboard = monitored_org.dashboard
+    white_list=frozenset()
 
     # read a whitelist of network IDs to consider when adding devices to the Dict
     try:
-        with open('networks_whitelist.txt') as my_file:
-            white_list = my_file.read().splitlines()
+        white_list = read_network_list(monitored_org.whitelist_file)
     except IOError as e:
-        print("Error trying to read whitelist, skipping...")
+        log.error("Error trying to read whitelist %s, skipping...", monitored_org.whitelist_file)
     except:
-        print("Unexpected error: ",sys.exc_info()[0])
+        log.exception("Unexpected error reading whitelist")
+
+    # the report has an entry per uplink of every device, each device is looked at once
+    seen = set()
 
     # Get the last 5 minutes of UplinkLoss and Latency data for all MX devices in the Organization
     # to make a list of which to monitor
-    org = dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(organizationId=org_id)
-    print('updating devices')
+    org = dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(organizationId=monitored_org.org_id)
+    log_event(log, logging.INFO, 'updating devices', org_id=monitored_org.org_id)
     for anEntry in org:
-        if anEntry['serial'] not in allMXDevices.keys():
-            deviceInfo=dashboard.devices.getDevice(anEntry['serial'])
-
+        if anEntry['serial'] not in allMXDevices.keys() and anEntry['serial'] not in seen:
+            seen.add(anEntry['serial'])
             # If useWhiteList is True, then there the NetworkId of the device has to be in the list for it to be considered.
             # Otherwise, the condition will always be met and the device will be considered to add to the list.
             if ((not useWhiteList)  or  (anEntry['networkId'] in white_list)):
@@ -283,37 +480,153 @@ def refreshDevicesDict():
                 response_spare = dashboard.appliance.getNetworkApplianceWarmSpare(anEntry['networkId'])
                 #print("Evaluating warm spare for ",anEntry['serial'],": ",response_spare)
                 if response_spare['primarySerial']==anEntry['serial']:
+                    deviceInfo=dashboard.devices.getDevice(anEntry['serial'])
                     wan1IP=deviceInfo['wan1Ip']
                     wan2IP=deviceInfo['wan2Ip']
-                    allMXDevices[anEntry['serial']] = WAN_device(networkId=anEntry['networkId'], serial=anEntry['serial'],uplink1_ip=wan1IP,uplink2_ip=wan2IP, my_org_number=org_id)
+                    device = WAN_device(networkId=anEntry['networkId'], serial=anEntry['serial'],uplink1_ip=wan1IP,uplink2_ip=wan2IP, my_org_number=monitored_org.org_id)
+
+                    #retrieve current state of defaultUplink and loadbalancing for device, so a network failed over before
+                    #a restart or an inventory refresh stays where it is
+                    ulinkselection=dashboard.appliance.getNetworkApplianceTrafficShapingUplinkSelection(networkId=anEntry['networkId'])
+                    adopt_uplink_selection(device, ulinkselection['loadBalancingEnabled'], ulinkselection['defaultUplink'])
+                    knownUplinkSelection[anEntry['networkId']]=[ulinkselection['loadBalancingEnabled'],
+                                                               ulinkselection['defaultUplink'], time.monotonic()]
+                    allMXDevices[anEntry['serial']] = device
+                    orgOfNetwork[anEntry['networkId']] = monitored_org.org_id
+                    if recorder is not None:
+                        recorder.record_device(anEntry['serial'], anEntry['networkId'], wan1IP, wan2IP,
+                                               device.current_uplink, device.current_uplink==1)
                     responsesPerSerial[anEntry['serial']] = [None, None]
 
-refreshDevicesDict()
-print(allMXDevices)
-
-
-# forever read stats for all devices and decide if to act
-while True:
-    org = dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(organizationId=org_id)
-
-    for anEntry in org:
-        # assemble the responsesPerSerial{} for each device
-        if anEntry['serial']  in allMXDevices.keys():
-            if anEntry['uplink']=="wan1":
-                responsesPerSerial[anEntry['serial']][0] = anEntry['timeSeries']
-            if anEntry['uplink']=="wan2":
-                responsesPerSerial[anEntry['serial']][1] = anEntry['timeSeries']
-
-
-    #now that we a response per device with WAN1 and WAN2, evaluate the switching of uplinks by
+def adopt_uplink_selection(device, load_balancing, default_uplink):
+    # takes over the uplink selection of the device's network found in the Dashboard. An uplink other than WAN1 is
+    # handled like a failover of the script, so WAN1 is only evaluated again after failback_wait_time
+    if load_balancing or default_uplink not in device.uplinks:
+        device.current_uplink=1
+        return
+    device.current_uplink=device.uplinks.index(default_uplink)+1
+    if device.current_uplink!=1:
+        device.last_failover_time=clock()
+
+def uplink_index(device, name):
+    # index of the uplink name of device, added to it the first time the Dashboard reports stats for it
+    if name in device.uplinks:
+        return device.uplinks.index(name)
+    index=device.add_uplink(name)
+    responsesPerSerial[device.serial].append(None)
+    log_event(log, logging.INFO, "Adding uplink %s of device %s", name, device.serial, serial=device.serial,
+              uplink=name)
+    if recorder is not None:
+        recorder.record_uplink(device.serial, index+1, name, None)
+    return index
+
+def dashboard_cycle():
+    # one round of reading the org wide loss and latency stats of every organization and evaluating every device
+    # with them. Returns the number of devices evaluated. The caller is responsible for pacing the calls.
+    # Each organization is polled with its own client and rate limiter, the least recently polled ones first
+    entries=0
+    for monitored_org in poll_order(monitored_orgs):
+        org = monitored_org.dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(
+            organizationId=monitored_org.org_id)
+        monitored_org.last_polled = clock()
+        entries += len(org)
+
+        for anEntry in org:
+            # assemble the responsesPerSerial{} for each device
+            device=allMXDevices.get(anEntry['serial'])
+            if device is not None:
+                responsesPerSerial[device.serial][uplink_index(device, anEntry['uplink'])] = anEntry['timeSeries']
+
+
+    if recorder is not None:
+        recorder.record_cycle(clock())
+        for entry_serial in allMXDevices:
+            for uplink, timeSeries in enumerate(responsesPerSerial[entry_serial], 1):
+                recorder.record_points(entry_serial, uplink, timeSeries, ts_to_timestamp)
+        recorder.flush()
+
+    #now that we a response per device with all its uplinks, evaluate the switching of uplinks by
     #callign the objects uplink_selector() method
     for entry_serial in allMXDevices:
         allMXDevices[entry_serial].uplink_selector(responsesPerSerial[entry_serial])
-        responsesPerSerial[entry_serial] = [None, None]
-
-    #pause so we are not calling the dashboard continuosly
-    time.sleep(dashboard_call_delay)
-
-    #check for new devices at the top of the hour
-    if ((time.time() % 3600) == 0):
-        refreshDevicesDict()
\ No newline at end of file
+        responsesPerSerial[entry_serial] = [None]*len(allMXDevices[entry_serial].uplinks)
+    log_event(log, logging.INFO, "dashboard cycle", entries=entries, orgs=len(monitored_orgs), devices=len(allMXDevices))
+    return len(allMXDevices)
+
+
+def reconcile_round(reconciler):
+    # starts reading back the uplink selection of the next batch of monitored networks
+    networks=[(networkId, monitored_orgs[org]) for networkId, org in orgOfNetwork.items() if org in monitored_orgs]
+    reconciler.start_round(networks)
+
+def reconcile_uplink_selection(reconciler):
+    # compares the uplink selections read back since the last call with the state of the devices and fixes the drift.
+    # Devices of this script are either on WAN1 with load balancing or on WAN2 without it
+    results=reconciler.results()
+    if len(results)==0:
+        return
+    devicesOfNetwork={device.networkId: device for device in allMXDevices.values()}
+    for networkId, load_balancing, default_uplink, read_time in results:
+        known=knownUplinkSelection.get(networkId)
+        if known is not None and known[2]>read_time:
+            # written after it was read, the read is already outdated
+            continue
+        knownUplinkSelection[networkId]=[load_balancing, default_uplink, read_time]
+        device=devicesOfNetwork.get(networkId)
+        if device is None:
+            continue
+        local_uplink=device.uplinks[device.current_uplink-1]
+        if (device.current_uplink==1)==load_balancing and local_uplink==default_uplink:
+            continue
+        if reconcile_policy=='enforce':
+            set_uplink_selection(networkId, load_balancing=device.current_uplink==1, default_uplink=local_uplink)
+            log_state_change(log, 'drift_enforced', device.serial, networkId,
+                             'uplink selection changed in the Dashboard, writing back %s', local_uplink,
+                             uplink=local_uplink, load_balancing=device.current_uplink==1,
+                             dashboard_uplink=default_uplink, dashboard_load_balancing=load_balancing)
+        elif local_uplink!=default_uplink and default_uplink in device.uplinks:
+            device.current_uplink=device.uplinks.index(default_uplink)+1
+            if device.current_uplink!=1:
+                # handled like a failover of the script, so WAN1 is only evaluated again after failback_wait_time
+                device.last_failover_time=clock()
+            log_state_change(log, 'drift_adopted', device.serial, networkId,
+                             'uplink selection changed in the Dashboard, now using %s', default_uplink,
+                             uplink=default_uplink, load_balancing=load_balancing, previous_uplink=local_uplink)
+
+
+def log_task_stats(tasks):
+    log_event(log, logging.INFO, "task deadlines", tasks=tasks.stats_summary())
+
+
+def main():
+    global recorder
+    if record_file:
+        recorder = ProbeRecorder(record_file, 'dashboard')
+    refreshDevicesDict()
+    log_event(log, logging.INFO, "Monitoring %d devices", len(allMXDevices), devices=list(allMXDevices.keys()))
+    install_profile_signal(SamplingProfiler(log), profile_duration, profile_report_dir, 'MX_dashboard_uplink_monitor_selector')
+    watchdog=None
+    if watchdog_stall_threshold is not None:
+        watchdog=LoopWatchdog(log, watchdog_stall_threshold).start()
+
+    # read stats for all devices every dashboard_call_delay seconds (fixed rate, so the time the calls take does not
+    # add up) and check for new devices every inventory_refresh_interval seconds
+    tasks=TaskScheduler(miss_tolerance=task_miss_tolerance, log=log)
+    tasks.every(dashboard_call_delay, dashboard_cycle, name='poll')
+    tasks.every(inventory_refresh_interval, refreshDevicesDict, name='inventory', first_delay=inventory_refresh_interval)
+    tasks.every(task_stats_interval, log_task_stats, tasks, name='stats', first_delay=task_stats_interval)
+    if watchdog is not None:
+        tasks.every(watchdog_stall_threshold/10.0, watchdog.beat, 'main', name='heartbeat')
+    if reconcile_interval is not None:
+        if reconcile_policy not in RECONCILE_POLICIES:
+            raise ValueError("Unknown reconcile_policy %r, must be one of %s" % (reconcile_policy, RECONCILE_POLICIES))
+        # the reads run on the reconciler's threads, the results are applied on this one. The devices start out with
+        # the uplink selection read with the inventory, so the first round waits for reconcile_interval
+        reconciler=UplinkReconciler(log, dashboard_base_url, reconcile_concurrency, reconcile_batch_size)
+        tasks.every(reconcile_interval, reconcile_round, reconciler, name='reconcile', first_delay=reconcile_interval)
+        tasks.every(1.0, reconcile_uplink_selection, reconciler, name='reconcile apply')
+    tasks.run()
+
+
+if __name__ == '__main__':
+    main()
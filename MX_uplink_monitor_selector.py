@@ -15,13 +15,37 @@ IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 or implied.
 """
 
-import meraki
-import requests
 import json
-from mping import MultiPing, multi_ping
+from mping import MultiPing, BurstStats, burst_ping, multi_ping
 import time
 import sys
+import logging
+import gc
+import os
+import threading
 from credentials import api_key, org_id
+try:
+    from credentials import orgs
+except ImportError:
+    # credentials.py from before multiple organizations were supported
+    orgs = []
+from dashboard_orgs import LazyDashboardAPI, load_orgs, read_network_list
+from selector_logging import setup_logging, log_event, log_state_change
+from probe_recorder import ProbeRecorder
+from probe_history import HistoryStore
+from sla_rollups import SLARollups, period
+from shared_fate import SharedFateCorrelator, load_group_prefixes
+from latency_estimators import UplinkLatencyStats, ReportWindow, LATENCY_CRITERIA
+from live_config import (FileWatcher, read_settings, positive, non_negative, positive_int, fraction, percent, boolean,
+                         optional, one_of)
+from changepoint import UplinkChangeDetector
+from probe_scheduler import AdaptiveProbeScheduler
+from load_shedding import LoadShedder
+from task_scheduler import TaskScheduler
+from diagnostics import LoopWatchdog, SamplingProfiler, install_profile_signal
+from uplink_reconciler import UplinkReconciler, RECONCILE_POLICIES
+from probe_handoff import ProbeHandoff
+from decision_tracing import DecisionTracer
 
 
 # ping_timeout and ping_retry usage:
@@ -56,9 +80,83 @@ average_latency_tolerance=0.400
 # values as well as the trouble_eval_window
 period_loss_report_tolerance=12
 
+# burst_size: number of pings sent to every uplink in each ping cycle, burst_interval seconds apart. A single ping per
+# cycle only tells whether the uplink answered, so measuring a loss rate takes many cycles. With a burst every cycle
+# measures the loss percentage of the uplink along with the min/avg/max and jitter of its RTTs, and the lost pings of an
+# uplink over the trouble_eval_window are compared as a percentage of the pings sent against burst_loss_tolerance
+# instead of against period_loss_report_tolerance. For the same confidence in the loss rate the trouble_eval_window
+# can then be a fraction of what single pings need: with burst_size=10 a 30% loss shows up over 40 pings in 2 cycles.
+# A cycle takes (burst_size-1)*burst_interval seconds longer and waits ping_timeout after the last ping of the burst
+# (ping_retry is not used). At most 65535 pings can be waiting for their reply at the same time, so with more than
+# 65535//burst_size uplinks (6553 with burst_size=10) they get their bursts in chunks one after the other, each chunk
+# making the cycle as much longer again. Set to 1 (default) to send a single ping per cycle
+burst_size=1
+burst_interval=0.02
+# loss percentage to tolerate over the trouble_eval_window when burst_size is more than 1
+burst_loss_tolerance=10
+
+# latency_failover_criterion selects which latency statistic over the trouble_eval_window is compared against
+# average_latency_tolerance:
+#   'mean' : the plain average of all replies (default). A few huge outliers can push it over the tolerance
+#   'p50', 'p95' or 'p99' : the median, 95th or 99th percentile of the replies. 'p50' ignores rare outliers while 'p95'
+#            catches a steady fraction of slow replies that the average would hide
+#   'ewma' : exponentially weighted moving average with a half life of half the trouble_eval_window
+latency_failover_criterion='mean'
+
+# jitter_tolerance: set to a number of seconds to also consider an uplink unstable when its interarrival jitter
+# (as defined in RFC 3550, computed on consecutive ping replies) goes above it. Set to None to not check jitter
+jitter_tolerance=None
+
+# changepoint_detector: set to 'cusum' or 'page_hinkley' to also run a sequential change point detector on every ping
+# result of each uplink. It flags a sustained increase in latency or loss as soon as its statistic crosses the threshold,
+# which is typically well before a full trouble_eval_window of bad averages has built up, and it also works during the
+# first trouble_eval_window seconds after the script starts. Set to None (default) to only use the window averages.
+changepoint_detector=None
+# changepoint_latency_drift is the latency increase (seconds) over the learned baseline of the uplink that is ignored,
+# changepoint_latency_threshold is how much accumulated excess latency (seconds) raises the alarm. Raising the
+# threshold makes false alarms exponentially rarer while only delaying detection linearly
+changepoint_latency_drift=0.050
+changepoint_latency_threshold=1.0
+# changepoint_loss_drift is the fraction of lost pings over the baseline loss that is ignored, and
+# changepoint_loss_threshold is how many "excess" lost pings raise the alarm. With the defaults, 6 lost pings in a
+# row or a sustained 60% loss for about 12 pings trigger it
+changepoint_loss_drift=0.25
+changepoint_loss_threshold=4.0
+
 # number of seconds after failing over to secondary WAN link to wait until evaluating main link again to switch back
 failback_wait_time = 120
 
+# adaptive_probing: set to True to ping calm devices less often. A device whose uplinks have had no lost pings and no
+# RTT excursion for adaptive_probe_calm_period seconds, and that is in its normal uplink state, is only pinged every
+# adaptive_probe_base_interval seconds. As soon as one of its uplinks loses a ping or its RTT goes more than
+# adaptive_probe_rtt_excursion seconds over the uplink's EWMA latency, or while it is waiting out failback_wait_time to
+# fail back, it is pinged in every cycle again. Each ping result then counts for the time it stands for in the
+# trouble_eval_window: a lost ping of a calm device counts as adaptive_probe_base_interval/(ping_timeout+inter_ping_delay)
+# lost pings and replies are weighted the same way in the average latency, so period_loss_report_tolerance and
+# average_latency_tolerance keep their meaning. Set to False (default) to ping every device in every cycle
+adaptive_probing=False
+adaptive_probe_base_interval=5
+adaptive_probe_calm_period=60
+adaptive_probe_rtt_excursion=0.050
+
+# threaded_probing: set to True (default) to ping from a thread of its own that hands the results of every cycle to the
+# main thread through a double buffer, so the ping cadence does not depend on how long evaluating the devices and
+# logging take. If evaluation falls behind, the results it did not get to are replaced by the newest ones and counted
+# as dropped in the 'evaluation backlog' log entries. Set to False to ping and evaluate one after the other
+threaded_probing=True
+
+# cycle_budget: set to a number of seconds a ping cycle (pinging the devices due and evaluating them) may take, to shed
+# load when the cycles take longer, as they do with a fleet too large for the host or a busy host. The devices that are
+# unstable, failed over, waiting to fail back or in their first trouble_eval_window are then still pinged in every
+# cycle, while the calm ones (no lost ping or RTT excursion for adaptive_probe_calm_period seconds) take turns in the
+# room left, none of them left out for more than load_shed_max_defer seconds, until all the devices due fit in the
+# budget again. Their results count for the time they stand for, as with adaptive_probing. How much was shed is logged
+# with the task deadlines. The budget must be larger than the longest a cycle waits for the replies,
+# ping_timeout*(ping_retry+1) (or the burst plus ping_timeout with burst_size>1), which no shedding shortens.
+# Set to None (default) to ping every device due in every cycle
+cycle_budget=None
+load_shed_max_defer=10
+
 # set useWhiteList to True if you wish to only include devices from certain NetworkIds in the monitoring.
 # to specify the list of network IDs to consider, add them one per line in the networks_whitelist.txt (networks using load balancing) or the
 # NLB_networks_whitelist.txt (for networks where you do not want to enable Load Balancing at all) file in the same directory as this Python script.
@@ -73,6 +171,15 @@ useWhiteList=True
 # using this API call https://developer.cisco.com/meraki/api/#!get-network-device ( wan1Ip and wan2Ip )
 useWANpublicIP=False
 
+# extra_uplinks: uplinks to ping and evaluate in addition to WAN1 and WAN2 on MX models that have them, for example
+# ['wan3', 'cellular']. Their IPs are taken from the uplink status of the device (the publicIp if useWANpublicIP is True).
+# Leave as an empty list (default) to only monitor WAN1 and WAN2
+extra_uplinks=[]
+# selectable_uplinks: the uplinks the script may make the default uplink of a device when another one is in trouble.
+# When several of them are healthy, the one with the fewest lost pings, then the lowest latency, is chosen. The
+# Dashboard only accepts WAN uplinks as default uplink, so a cellular uplink is monitored and logged but never selected
+selectable_uplinks=['wan1','wan2']
+
 # Assign one or more IP addresses as a strings in a list to scriptConnTestDestinations if you wish to have the script
 # use ping destinations that are not one of the MX devices being evaluated
 # to make sure the script has good network connectivity and it does not confuse network connectivity problems
@@ -84,334 +191,813 @@ useWANpublicIP=False
 # if you do not wish to use this option
 scriptConnTestDestinations=[]
 
-
-
-
-dashboard = meraki.DashboardAPI(api_key, output_log=False, suppress_logging= True)
+# shared_fate_correlation: set to True to hold back uplink changes when many sites go bad at once. The uplinks are
+# grouped by the group name of the longest prefix containing them in shared_fate_groups_file (lines such as
+# "203.0.113.0/24 AS64500", to group them by ISP/ASN or region), or else by their shared_fate_prefix_length
+# (shared_fate_prefix_length_v6 for IPv6) bit prefix. When at least shared_fate_min_degraded uplinks of a group, and at
+# least shared_fate_threshold of those pinged, are unreachable or over average_latency_tolerance in the same ping cycle,
+# the problem is more likely on the path from the script to them than at the sites: devices whose troubled uplinks are in
+# the group make no uplink changes until it has not been over the threshold for trouble_eval_window seconds
+shared_fate_correlation=False
+shared_fate_threshold=0.5
+shared_fate_min_degraded=5
+shared_fate_groups_file=None
+shared_fate_prefix_length=24
+shared_fate_prefix_length_v6=48
+
+# log_level controls how much the script reports: 'DEBUG' also logs the latency and loss readings of every device,
+# 'INFO' logs a summary per ping cycle. Uplink changes (failover, failback and load balancing toggles) are always logged.
+log_level='INFO'
+# log_file is the file to append JSON lines log entries to. Set to None to write them to the console instead
+log_file=None
+# log_reading_sample_rate: only 1 of every log_reading_sample_rate routine readings per device is logged at DEBUG level
+log_reading_sample_rate=10
+
+# record_file: set to a file name to record every ping result and the device inventory to a compact
+# binary log that can later be replayed faster than real time with replay.py to tune the thresholds above. An
+# existing log is appended to. Set to None to disable recording
+record_file=None
+
+# history_dir: set to a directory to keep the ping results and uplink decisions of every device there, in
+# memory-mapped files that are also aggregated per minute and per hour in the background, so the history of an incident
+# is still around after it left the trouble_eval_window. Query it with probe_history.py. Set to None (default) to not
+# keep any history
+history_dir=None
+# history_segment_records is the number of records (56 bytes each) per history file and history_max_segments the number
+# of files kept per resolution, the oldest one is deleted when a new one is started
+history_segment_records=262144
+history_max_segments=16
+
+# sla_dir: set to a directory to keep availability and SLA counters of every device there: the time each uplink was
+# healthy and unstable, the time spent off WAN1 and with load balancing off, the number of failovers and failbacks and
+# the time to detect of the failovers, per UTC day and month. They are updated with every evaluation and written to
+# sla_dir every sla_checkpoint_interval seconds. Report on any period with sla_rollups.py or GET /sla on the control API.
+# Set to None (default) to not keep them
+sla_dir=None
+sla_checkpoint_interval=300
+
+# inventory_refresh_interval is the number of seconds between checks for new devices in the Dashboard
+inventory_refresh_interval=3600
+
+# target_cache_file: set to a file name to save the devices found by every inventory there. When the script starts and
+# the file exists, it starts pinging and evaluating the devices in it right away while it reads the inventory from the
+# Dashboard in the background, instead of waiting for the inventory (which takes minutes in large organizations). The
+# devices the inventory finds with the same uplink IPs keep what was measured in the meantime. Put it on storage that
+# outlives the container or host the script runs on. Set to None (default) to always wait for the inventory
+target_cache_file=None
+
+# config_file: set to a JSON file such as {"average_latency_tolerance": 0.3, "failback_wait_time": 300} to change the
+# settings in RELOADABLE_SETTINGS below while the script runs; environment variables such as
+# MX_SELECTOR_AVERAGE_LATENCY_TOLERANCE=0.3 (config_env_prefix followed by the name in capitals) take precedence over it.
+# Every config_check_interval seconds the script checks whether config_file or a whitelist file changed (with inotify on
+# Linux, so it costs nothing while they do not). The settings are only swapped in if they are all valid, a setting
+# removed from the file goes back to its value here. A whitelist change only adds, removes or re-flags (NLB or not) the
+# devices of the networks it concerns, all other devices keep their evaluation windows
+config_file=None
+config_env_prefix='MX_SELECTOR_'
+config_check_interval=1.0
+
+# main() runs every task (ping cycles, inventory refreshes, failback checks) at its own deadline. A task starting more
+# than task_miss_tolerance seconds after its deadline counts as a deadline miss; the number of runs and misses and the
+# lateness of every task are logged every task_stats_interval seconds
+task_miss_tolerance=0.050
+task_stats_interval=60
+
+# gc_thresholds: the thresholds of the Python garbage collector (see gc.set_threshold()) while the script runs. With the
+# Python defaults it collects every 700 new container objects, and the full collections walking every device of a
+# large fleet stall the loops for a good part of a second. Set to None to keep the Python defaults.
+# gc_freeze_devices: after every inventory load, move all objects there are (the devices just loaded with everything
+# they hold) to the permanent generation of the garbage collector (gc.freeze()) so that collections skip them
+gc_thresholds=(50000, 20, 100)
+gc_freeze_devices=True
+
+# watchdog_stall_threshold: when a loop of main() has not gone round for this many seconds, for example because a
+# Dashboard call hangs, an alert with the stack of every thread is logged, and another entry when it recovers. Set to
+# None to disable the watchdog
+watchdog_stall_threshold=30
+
+# sending the process SIGUSR1 (kill -USR1 <pid>) samples the stacks of all threads for profile_duration seconds and
+# writes a report of where the time went to a <script>-profile-<time>.txt file in profile_report_dir
+profile_duration=30
+profile_report_dir='.'
+
+# reconcile_interval: every reconcile_interval seconds the uplink selection of the next reconcile_batch_size monitored
+# networks is read back from the Dashboard, reconcile_concurrency at a time and within dashboard_calls_per_second, to
+# catch changes made outside of the script. reconcile_policy is 'adopt' to take over the uplink selection found in the
+# Dashboard (a network manually failed over to WAN2 waits failback_wait_time before failing back) or 'enforce' to write
+# the script's own uplink selection back. Set reconcile_interval to None to never read the uplink selection back
+reconcile_interval=300
+reconcile_batch_size=100
+reconcile_concurrency=4
+reconcile_policy='adopt'
+
+# decision_tracing: set to True to trace every failover from the first bad ping result of the device to its new uplink
+# selection read back from the Dashboard right after the change (or, with reconcile_interval set to None, to the
+# Dashboard acknowledging it), timing each stage in between (see decision_tracing.py). Every trace is logged as a
+# 'decision trace' entry, and the time spent in each stage is kept in histograms logged as 'decision latency' entries
+# every task_stats_interval seconds and shown in the control API status. Set to False (default) to not trace them
+decision_tracing=False
+
+# control_api_address: set to a (host, port) tuple, for example ('127.0.0.1', 7612), to serve the local HTTP API of
+# control_api.py there: the state of every device and commands to pin or unpin a network and to evaluate devices right
+# away. Requests have to carry control_api_token in an X-Control-Token header if it is not empty. The state it serves
+# is a snapshot published every control_snapshot_interval seconds (and after every command). Set to None to disable it
+control_api_address=None
+control_api_token=''
+control_snapshot_interval=2
+
+log = setup_logging('MX_uplink_monitor_selector', level=log_level, log_file=log_file,
+                    sample_every=log_reading_sample_rate)
+
+# dashboard_base_url is the root of the Meraki Dashboard API v1. Only change it to point the script at a
+# different Dashboard region or at a local mock Dashboard used for benchmarking
+dashboard_base_url='https://api.meraki.com/api/v1'
+
+# the Dashboard client, the meraki SDK is only imported when it is first used
+dashboard = LazyDashboardAPI(api_key, base_url=dashboard_base_url, output_log=False, suppress_logging= True)
+
+# dashboard_calls_per_second is the maximum number of Dashboard API calls per second the script makes for each
+# organization (the Dashboard allows 10 per organization). Set to None to not limit them
+dashboard_calls_per_second=5
+
+# monitored_orgs holds the OrgContext (Dashboard client, rate limiter and whitelist files) of every organization in
+# credentials.py by org id, and orgOfNetwork the org id of every monitored network. Both are filled in by
+# refreshDevicesDict()
+monitored_orgs={}
+orgOfNetwork={}
+
+# knownUplinkSelection holds the last uplink selection read from or written to the Dashboard for every monitored
+# network, as [load_balancing, default_uplink, time.monotonic() of the read or write], so that writes that would not
+# change anything are skipped
+knownUplinkSelection={}
+
+# pinnedNetworks holds the networks pinned through the control API, no uplink decisions are made for them. The value
+# is the uplink they were pinned to, or None if they were left as they were. control_snapshot is the latest snapshot of
+# the state of all devices published for the control API
+pinnedNetworks={}
+control_snapshot=None
+
+# clock returns the current time used for all evaluation window and failback calculations. replay.py replaces it
+# with a virtual clock
+clock=time.time
+
+# recorder is the ProbeRecorder writing to record_file, created in main() when recording is enabled
+recorder=None
+
+# history is the HistoryStore keeping the probe history in history_dir, created in main() when it is configured
+history=None
+
+# sla is the SLARollups keeping the SLA counters in sla_dir, created in main() when it is configured
+sla=None
+
+# scheduler is the AdaptiveProbeScheduler deciding which devices to ping in each cycle, created in
+# refreshDevicesDict() when adaptive_probing is enabled
+scheduler=None
+
+# shedder is the LoadShedder leaving calm devices out of the cycles that would overrun cycle_budget, created in main()
+# when it is configured
+shedder=None
+
+# tracer is the DecisionTracer of decision_tracing, created in main(), and cycle_started the time.monotonic() at the
+# start of the ping cycle whose results are being evaluated, when its first bad results are
+tracer=None
+cycle_started=None
+
+# inventory_lock is held by the probe thread while it picks the uplink IPs to ping and by main() while it refreshes the
+# devices, and inventory_version is increased with every refresh so results pinged for older devices are discarded
+inventory_lock=threading.Lock()
+inventory_version=0
+
+# failback_timer, when set, is called with a WAN_device and the time at which its failback_wait_time ends every time
+# it fails over, so that main() can check for failback right then instead of at the next ping result of the device
+failback_timer=None
 
 # isTestConnDown is a boolean used to indicate if the test connection is healthy or not IF scriptConnTestDestinations
 # is configured.
 isTestConnDown= {}
+# proberPathDown is True while all the testers are down: no uplink decisions are made for the MX devices then
+proberPathDown=False
+# testerSerials holds the serials of the testers, which are evaluated before the MX devices in every cycle
+testerSerials=set()
+
+# correlator is the SharedFateCorrelator holding the uplink groups and the groups held back, created by
+# build_correlation_index() when shared_fate_correlation is enabled
+correlator=None
+
+# RELOADABLE_SETTINGS are the settings config_file and the environment can change while running, with the check of
+# their values. config_defaults holds the values they were given above, taken by load_config() before changing them
+RELOADABLE_SETTINGS={
+    'average_latency_tolerance': positive,
+    'period_loss_report_tolerance': non_negative,
+    'burst_loss_tolerance': percent,
+    'latency_failover_criterion': one_of(*LATENCY_CRITERIA),
+    'jitter_tolerance': optional(positive),
+    'failback_wait_time': non_negative,
+    'shared_fate_threshold': fraction,
+    'shared_fate_min_degraded': positive_int,
+    'useWhiteList': boolean,
+}
+config_defaults=None
+
+def org_of_network(networkId):
+    # the OrgContext of the organization a network belongs to (the first one if not known)
+    global monitored_orgs
+    if not monitored_orgs:
+        monitored_orgs = load_orgs(orgs, api_key, org_id, dashboard, dashboard_base_url, dashboard_calls_per_second)
+    return monitored_orgs.get(orgOfNetwork.get(networkId)) or next(iter(monitored_orgs.values()))
+
+def state_change(event, serial, networkId, msg, *args, **fields):
+    # logs a state change of a device (failover, failback, ...) and adds it to the probe history if one is kept
+    if history is not None:
+        history.record_event(clock(), serial, event, fields.get('uplink'), fields.get('load_balancing'))
+    device=allMXDevices.get(serial)
+    if sla is not None and device is not None and serial[0 : 6]!='tester':
+        sla.decision(serial, device.uplinks, clock(), event, device.current_uplink==1, device.isLoadbalancing)
+    log_state_change(log, event, serial, networkId, msg, *args, **fields)
+
+def set_uplink_selection(networkId, load_balancing, default_uplink):
+    # every uplink selection change made by the script goes through here so it can be recorded, or redirected
+    # when replaying recorded probe logs (see replay.py)
+    known=knownUplinkSelection.get(networkId)
+    if known is not None and known[0]==load_balancing and known[1]==default_uplink:
+        log_event(log, logging.INFO, "uplink selection of %s already set, not writing it", networkId,
+                  networkId=networkId, load_balancing=load_balancing, uplink=default_uplink)
+        if tracer is not None:
+            tracer.abandon(networkId, 'already set')
+        return
+    if recorder is not None:
+        recorder.record_action(clock(), networkId, default_uplink, load_balancing)
+    # since we call the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
+    # we need to guarantee that we do not call the API more than dashboard_calls_per_second times per second for
+    # the organization; we wait for the organization's rate limiter, even if many other objects will have to
+    # make a WAN change
+    monitored_org=org_of_network(networkId)
+    if tracer is not None:
+        tracer.stage(networkId, 'action_queued', time.monotonic())
+    monitored_org.throttle()
+    if tracer is not None:
+        tracer.stage(networkId, 'request_sent', time.monotonic())
+    try:
+        monitored_org.client.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(
+            networkId=networkId, loadBalancingEnabled=load_balancing, defaultUplink=default_uplink)
+    except Exception:
+        if tracer is not None:
+            tracer.abandon(networkId, 'request failed')
+        raise
+    knownUplinkSelection[networkId]=[load_balancing, default_uplink, time.monotonic()]
+    if tracer is not None:
+        tracer.stage(networkId, 'acknowledged', knownUplinkSelection[networkId][2])
+
 
 class WAN_device:
     global trouble_eval_window, average_latency_tolerance, period_loss_report_tolerance, failback_wait_time, isTestConnDown
-
-    def __init__(self, networkId, serial, my_org_number, uplink1_ip, uplink2_ip, current_uplink,is_load_balancing, is_NLB):
-        self.networkId = networkId
-        self.serial = serial
+    # there is one per device of fleets of tens of thousands of them, so no __dict__
+    __slots__ = ('networkId', 'serial', 'my_org_number', 'current_uplink', 'isLoadbalancing', 'isNLB',
+                 'last_failover_time', 'init_time', 'last_sample_time', 'last_excursion_time', 'uplinks', 'uplink_ips',
+                 'selectable', 'active', 'lat_reports', 'loss_reports', 'lat_stats', 'change')
+
+    def __init__(self, networkId, serial, my_org_number, uplink1_ip, uplink2_ip, current_uplink,is_load_balancing, is_NLB,
+                 extra_uplinks=()):
+        # interned, they are also the keys of allMXDevices, orgOfNetwork, ... and are compared all the time
+        self.networkId = sys.intern(networkId)
+        self.serial = sys.intern(serial)
         self.my_org_number = my_org_number
-        self.uplink1_ip = uplink1_ip
-        self.uplink2_ip = uplink2_ip
         self.current_uplink = current_uplink
         self.isLoadbalancing = is_load_balancing
         self.isNLB = is_NLB
-        self.loss1=0
-        self.loss2=0
-        self.latency1=0
-        self.latency2=0
         self.last_failover_time=0
-        self.init_time=time.time()
-        self.lat1_reports=[]
-        self.loss1_reports=[]
-        self.lat2_reports=[]
-        self.loss2_reports=[]
+        self.init_time=clock()
+        # time of the previous ping result and of the last lost ping or RTT excursion, for adaptive_probing
+        self.last_sample_time=None
+        self.last_excursion_time=float('-inf')
+        # everything per uplink is kept in lists indexed like self.uplinks: WAN1 is index 0 and WAN2 index 1, followed by
+        # the extra_uplinks (name, IP) of MX models with a third WAN or a cellular uplink. current_uplink is the index
+        # of the uplink in use plus 1
+        self.uplinks=[]
+        self.uplink_ips=[]
+        # uplinks in selectable_uplinks, the ones that can be made the default uplink
+        self.selectable=[]
+        # whether each uplink answered the latest ping
+        self.active=[]
+        # the latency reports (time, average latency, weight) and loss reports (time, weighted lost pings) in the
+        # trouble_eval_window
+        self.lat_reports=[]
+        self.loss_reports=[]
+        # streaming percentile, EWMA and jitter estimators for latency_failover_criterion and jitter_tolerance
+        self.lat_stats=[]
+        # sequential change point detectors if changepoint_detector is configured
+        self.change=[]
+        self.add_uplink('wan1', uplink1_ip)
+        self.add_uplink('wan2', uplink2_ip)
+        for name, ip in extra_uplinks:
+            self.add_uplink(name, ip)
 
     def __repr__(self):
         return(f'NetworkId: {self.networkId}, Serial: {self.serial}, Org number: {self.my_org_number}')
 
+    def add_uplink(self, name, ip):
+        if name in selectable_uplinks:
+            self.selectable.append(len(self.uplinks))
+        self.uplinks.append(name)
+        self.uplink_ips.append(ip)
+        self.active.append(False)
+        self.lat_reports.append(ReportWindow())
+        self.loss_reports.append(ReportWindow())
+        self.lat_stats.append(UplinkLatencyStats(trouble_eval_window))
+        self.change.append(UplinkChangeDetector(changepoint_detector, changepoint_latency_drift,
+                                                changepoint_latency_threshold, changepoint_loss_drift,
+                                                changepoint_loss_threshold) if changepoint_detector else None)
+
+    @property
+    def uplink1_ip(self):
+        return self.uplink_ips[0]
+
+    @property
+    def uplink2_ip(self):
+        return self.uplink_ips[1]
+
+    def sample_weight(self, current_time):
+        # number of regularly spaced pings (one every ping_timeout+inter_ping_delay seconds, plus the length of the
+        # burst with burst_size>1) a ping result stands for.
+        # Always 1 unless adaptive_probing or cycle_budget is on, then a result taken after a longer gap counts for the
+        # whole gap (but never for more than longest_probe_gap())
+        elapsed=None if self.last_sample_time is None else current_time-self.last_sample_time
+        self.last_sample_time=current_time
+        if not (adaptive_probing or shedder is not None) or elapsed is None:
+            return 1.0
+        return max(1.0, min(elapsed, longest_probe_gap())/
+                   ((burst_size-1)*burst_interval+ping_timeout+inter_ping_delay))
+
+    @staticmethod
+    def is_excursion(latency, stats):
+        # a lost ping, or a reply slower than the latency tolerance or than the uplink's EWMA by more than
+        # adaptive_probe_rtt_excursion
+        if latency is None:
+            return False
+        if latency==-1 or latency>average_latency_tolerance:
+            return True
+        return stats.ewma.value is not None and latency>stats.ewma.value+adaptive_probe_rtt_excursion
+
+    def needs_close_watch(self, current_time):
+        # True if the device has to be pinged in every cycle when adaptive_probing is on (or is spared by load
+        # shedding with cycle_budget): during the first
+        # trouble_eval_window, shortly after any lost ping or RTT excursion, while a change point alarm is up and while
+        # the device is away from its normal uplink state waiting to fail back
+        if current_time-self.init_time<trouble_eval_window:
+            return True
+        if current_time-self.last_excursion_time<adaptive_probe_calm_period:
+            return True
+        if any(change is not None and change.alarm for change in self.change):
+            return True
+        return self.away_from_normal()
+
+    def away_from_normal(self):
+        # True while the device waits to fail back: off WAN1 for testers and NLB sites, load balancing off otherwise
+        if self.serial[0 : 6]=='tester' or self.isNLB:
+            return self.current_uplink!=1
+        return not self.isLoadbalancing
+
+    @staticmethod
+    def sample_rtts(sample):
+        # the RTTs of the pings a result of uplink_selector() stands for: every ping of a burst (-1 for lost ones), or
+        # the latency, -1 or None of a single ping
+        return sample.rtts if isinstance(sample, BurstStats) else (sample,)
+
+    def readings(self, current_time):
+        # the (weighted) average latency, the (weighted) number of lost pings, the latency statistic checked
+        # against average_latency_tolerance and the percentage of lost pings of every uplink over the
+        # trouble_eval_window
+        average_latency=[]
+        loss_count=[]
+        latency=[]
+        loss_percent=[]
+        for lat_reports, loss_reports, lat_stats in zip(self.lat_reports, self.loss_reports, self.lat_stats):
+            #first calculate the (weighted) average latency time, if any (could be all loss packet reports)
+            lat_sum, weight_sum = lat_reports.weighted_sum()
+            average_latency.append(lat_sum/weight_sum if weight_sum else 0)
+            #next, get the (weighted) number of loss reports, if any (could have had no packet loss in period)
+            loss_count.append(loss_reports.value_sum())
+            latency.append(lat_stats.value(latency_failover_criterion, current_time, average_latency[-1]))
+            loss_percent.append(100.0*loss_count[-1]/(weight_sum+loss_count[-1]) if loss_count[-1] else 0.0)
+        return average_latency, loss_count, latency, loss_percent
+
+    def status(self, current_time):
+        # the state of the device as served by the control API
+        average_latency, loss_count, latency, loss_percent = self.readings(current_time)
+        return {'serial': self.serial, 'networkId': self.networkId, 'org_id': self.my_org_number, 'is_NLB': self.isNLB,
+                'current_uplink': self.current_uplink, 'current_uplink_name': self.uplinks[self.current_uplink-1],
+                'load_balancing': self.isLoadbalancing,
+                'pinned': self.networkId in pinnedNetworks, 'pinned_uplink': pinnedNetworks.get(self.networkId),
+                'uplinks': [{'name': name, 'ip': self.uplink_ips[i], 'selectable': i in self.selectable,
+                             'active': self.active[i], 'latency_reports': len(self.lat_reports[i]),
+                             'loss_count': loss_count[i], 'loss_percent': loss_percent[i],
+                             'average_latency': average_latency[i],
+                             'latency': latency[i], 'jitter': self.lat_stats[i].jitter.value,
+                             'change_alarm': self.change[i] is not None and self.change[i].alarm}
+                            for i, name in enumerate(self.uplinks)],
+                'last_failover_time': self.last_failover_time,
+                'next_failback_check': max(0.0, self.last_failover_time+failback_wait_time-current_time)
+                                       if self.away_from_normal() and self.networkId not in pinnedNetworks else None}
+
     def uplink_selector(self, ulinksLatency):
-        # current box latency for both WAN1 and WAN2 are passed in via 2 element array ulinksLatency
+        # current box latency of every uplink is passed in via the list ulinksLatency, indexed like self.uplinks:
         # ulinksLatency[0] contains latency measure for WAN1
-        # ulinksLatency[1] contains latency measure for WAN2
-        # the measure can be one of these three:
+        # ulinksLatency[1] contains latency measure for WAN2, and so on
+        # the measure can be one of these four:
         #   Float : latency as measured by a ping from where this script is running to the Meraki MX uplink interface
         #    -1 : interface is unreachable or disconnected, it is also used to estimate packet loss
         #    None : interface is not configured in the Meraki Dashboard for that MX device
+        #    BurstStats : the RTTs of a burst of pings when burst_size is more than 1, each of them counting as a reply
+        #                 or a lost ping on its own
         global isTestConnDown
 
         #first let's grab a current timestamp to use in all operations
-        current_time=time.time()
-
-        # check for the existence of WAN1 also if it is responding, no point in switching back to it
-        # if not configured or disconnected!!
-        bActiveWAN1 = not (ulinksLatency[0] == None or ulinksLatency[0] == -1)
-
-        # check for the existence of WAN2 also if it is responding, no point in switching to it
-        # if not configured or disconnected!!
-        bActiveWAN2=not (ulinksLatency[1]==None or ulinksLatency[1]==-1)
-
-
-
-        # now check for the existence of a WAN1 or WAN2 uplink (otherwise do nothing)
-        if (ulinksLatency[0] != None) or (ulinksLatency[1] != None):
-            # now let's add to the queues containing the latency or loss reports correspondingly for WAN1 if configured
-            if ulinksLatency[0] != None and ulinksLatency[0]>=0:
-                self.lat1_reports.append([current_time,ulinksLatency[0]])
-            else:
-                self.loss1_reports.append(current_time)
-
-            # now we need to remove any reports that are outside the trouble_eval_window
-            while len(self.lat1_reports)>0 and current_time-self.lat1_reports[0][0] > trouble_eval_window:
-                throwaway=self.lat1_reports.pop(0)
-            while len(self.loss1_reports)>0 and current_time-self.loss1_reports[0] > trouble_eval_window:
-                throwaway=self.loss1_reports.pop(0)
-
-            # now let's add to the queues containing the latency or loss reports correspondingly for WAN2 if configured
-            if ulinksLatency[1] != None and ulinksLatency[1] >= 0:
-                self.lat2_reports.append([current_time, ulinksLatency[1]])
-            else:
-                self.loss2_reports.append(current_time)
-
-            # now we need to remove any reports that are outside the trouble_eval_window
-            while len(self.lat2_reports) > 0 and current_time - self.lat2_reports[0][0] > trouble_eval_window:
-                throwaway = self.lat2_reports.pop(0)
-            while len(self.loss2_reports) > 0 and current_time - self.loss2_reports[0] > trouble_eval_window:
-                throwaway = self.loss2_reports.pop(0)
-
-
-            #check to see if we are within the initial eval window to start running the logic
-            if current_time-self.init_time>=trouble_eval_window:
-                #first calculate the average latency time, if any (could be all loss packet reports) for WAN1
-                average_latency1=0
-                if len(self.lat1_reports)>0:
-                    lat_sum1=0
-                    for lat1_rep in self.lat1_reports:
-                        lat_sum1+=lat1_rep[1]
-                    average_latency1 = lat_sum1/len(self.lat1_reports)
-
-                # Now for WAN2
-                average_latency2=0
-                if len(self.lat2_reports)>0:
-                    lat_sum2=0
-                    for lat2_rep in self.lat2_reports:
-                        lat_sum2+=lat2_rep[1]
-                    average_latency2 = lat_sum2/len(self.lat2_reports)
-
-                #next, get the number of loss reports, if any (could have had no packet loss in period)
-                loss_count1=len(self.loss1_reports)
-                loss_count2=len(self.loss2_reports)
-
-
-                print(self.serial," Average latency1: ",average_latency1," Loss count1: ",loss_count1)
-                print(self.serial," Average latency2: ",average_latency2," Loss count2: ",loss_count2)
-
-
-                if self.serial[0 : 6]=='tester':
-                    #handling for special object with serial 'tester' to decide if we proceed with logic
-                    #here, since it is not a real MX device, we use self.current_uplink just as an indicator that we have
-                    # "failed over"  and are looking to "fail back" when the connection is improved, but we are really not
-                    # doing anything regarding switching "uplinks", it's just to keep the logic similar to the regular MX
-                    # devices since we are using the same objects to track status.
-                    # Checking for adverse network conditions for tester to prevent rest of code from operating on MX devices:
-                    if self.current_uplink==1 and (average_latency1>average_latency_tolerance or loss_count1>period_loss_report_tolerance):
-                        print("lat1_reports: ", self.lat1_reports)
-                        print("loss1_reports: ", self.loss1_reports)
-
-                        # sets global object to stop checking the rest of MX devices!!!
-                        isTestConnDown[self.uplink1_ip]=True
-
-                        #keep setting the "current_uplink" for consistency, but not needed for this type of object
-                        self.current_uplink = 2
-                        self.last_failover_time = current_time
-                        print('tester '+self.serial+' experiencing problems; marking as such in list')
-                    else:
-                        #now check if we were already handling adverse network conditions for tester to try and
-                        #switch back to "normal" once the adversities are gone.
-                        if self.current_uplink == 2 and current_time - self.last_failover_time > failback_wait_time:
-                            print(
-                                "Two minutes have passed since tester "+self.serial+" went bad, check to see if now ok to mark as such...")
-                            if average_latency1 <= average_latency_tolerance and loss_count1 <= period_loss_report_tolerance:
-                                print("lat1_reports: ", self.lat1_reports)
-                                print("loss1_reports: ", self.loss1_reports)
-
-                                #set global object to continue checking the rest of MX devices!!!
-                                isTestConnDown[self.uplink1_ip]=False
-                                self.current_uplink = 1
-                                print('tester '+self.serial+' back up after failback wait time.. marking as such in list')
-
-                # before doing the "real" checks on MX devices to see if we need to manipulate load balancing and primary
-                # uplink values on the Meraki Dashboard, we must make sure the at least one "tester" destination is doing
-                # well. We only skip evaluating real MX devices if all tester destinations are reporting issues.
-                elif len(isTestConnDown) == 0 or not all(isTestConnDown.values()):
-
-                    # fill out some booleans to summarize network conditions on links on this device to make logic
-                    # simpler below
-                    bUnstableWAN1=average_latency1>average_latency_tolerance or loss_count1>period_loss_report_tolerance
-                    bUnstableWAN2=average_latency2>average_latency_tolerance or loss_count2>period_loss_report_tolerance
-                    print("bUnstableWAN1:",bUnstableWAN1, " bUnstableWAN2:",bUnstableWAN2)
-
-                    # First check to see if device belongs to network in the NLB_networks_whitelist since, for those,
-                    # there will never be any load balacing: if WAN1 is active and having issues then we need to failover
-                    # to WAN2 (typically a 4G circuit) and constantly try to switch back to WAN1 (typically a broadband circuit)
-                    # when things are better
-                    if self.isNLB:
-                        # NOTE: load balancing should never be turned on for NLB locations. If for some reason it is,
-                        # this code ignores that until it comes time to take action (either failover to WAN2 or failback to WAN1)
-                        # when it sets the load balancing off anyhow.
-                        # Ok, time to check to see if we have to make any uplink changes. First, and only if
-                        # we are currently on uplink 1 (WAN1), check to see if it has been problematic during
-                        # the last seconds specified in trouble_eval_window and see if we need to switch to uplink2 (WAN2)
-                        if self.current_uplink==1 and bUnstableWAN1 and bActiveWAN2 and not bUnstableWAN2:
-                            print("lat1_reports: ", self.lat1_reports)
-                            print("loss1_reports: ", self.loss1_reports)
-                            # Set WAN2 as uplink on device, keep load balancing turned off and record the time we failed over
-                            dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(networkId=self.networkId, loadBalancingEnabled=False, defaultUplink='wan2')
-                            self.isLoadbalancing=False
-                            # since we called the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
-                            # we need to guarantee that we do not call the API more than 5 times per second so if we add a .2 sec delay
-                            # here , even if many other objects will have to make a WAN change, we will not be calling more than 5 times a second
-                            time.sleep(.20)
-                            self.current_uplink = 2
-                            self.last_failover_time=current_time
-                            print('WAN1 problems in NLB site after tolerance period: using WAN2 as uplink')
-                        else:
-                            if self.current_uplink==2 and current_time-self.last_failover_time>failback_wait_time:
-                                # since enough time has passed since failover to WAN2, and WAN1 seems to have been healthy for the past
-                                # number of seconds specified by trouble_eval_window, it is safe to fail back to WAN1 and we keep load balancing
-                                # turned off since this is an NLB site.
-                                print("Two minutes have passed since failover, check to see if WAN1 is ok to switch back...")
-                                if bActiveWAN1 and not bUnstableWAN1:
-                                    print("lat1_reports: ", self.lat1_reports)
-                                    print("loss1_reports: ", self.loss1_reports)
-                                    dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(
-                                        networkId=self.networkId, loadBalancingEnabled=False, defaultUplink='wan1')
-                                    self.isLoadbalancing = False
-                                    # since we called the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
-                                    # we need to guarantee that we do not call the API more than 5 times per second so if we add a .2 sec delay
-                                    # here , even if many other objects will have to make a WAN change, we will not be calling more than 5 times a second
-                                    time.sleep(.20)
-                                    self.current_uplink = 1
-                                    print('WAN1 good in NLB site after failback wait time: Failing back to WAN1 as uplink....')
+        current_time=clock()
+
+        # now check for the existence of any uplink (otherwise do nothing)
+        if any(latency is not None for latency in ulinksLatency):
+            # every report carries the number of regular pings it stands for (always 1 without adaptive_probing)
+            weight=self.sample_weight(current_time)
+            # incidents start in the normal uplink state, the bad results of a device that already failed over are
+            # not the start of its next failover
+            if tracer is not None and self.serial not in testerSerials and not self.away_from_normal() and \
+                    any(latency is not None and is_bad_sample(latency) for latency in ulinksLatency):
+                tracer.anomaly(self.serial, cycle_started if cycle_started is not None else time.monotonic())
+            samples=[self.sample_rtts(sample) for sample in ulinksLatency]
+            if (adaptive_probing or shedder is not None) and any(self.is_excursion(latency, lat_stats)
+                                        for rtts, lat_stats in zip(samples, self.lat_stats) for latency in rtts):
+                self.last_excursion_time=current_time
+
+            for i, rtts in enumerate(samples):
+                replies=[latency for latency in rtts if latency is not None and latency>=0]
+                # check for the existence of the uplink and if it is responding, no point in switching to it if not
+                # configured or disconnected!!
+                self.active[i]=len(replies)>0
+                # now let's add to the queues containing the latency or loss reports correspondingly, a burst adds
+                # its average latency weighted by its number of replies and one loss report for all its lost pings
+                if replies:
+                    self.lat_reports[i].append(current_time,sum(replies)/len(replies),weight*len(replies))
+                    for latency in replies:
+                        self.lat_stats[i].add(current_time,latency)
+                if len(replies)<len(rtts):
+                    self.loss_reports[i].append(current_time,weight*(len(rtts)-len(replies)))
+                if history is not None and rtts[0] is not None:
+                    history.record_sample(current_time, self.serial, i+1, len(rtts), replies)
+                if sla is not None and rtts[0] is not None and self.serial[0 : 6]!='tester':
+                    sla.sample(self.serial, self.uplinks, i, current_time,
+                               len(replies)<len(rtts) or max(replies)>average_latency_tolerance)
+                # feed the change point detector, if any, with every ping result
+                if self.change[i] is not None:
+                    for latency in rtts:
+                        self.change[i].update(latency)
+
+            self.prune_reports(current_time)
+            self.evaluate(current_time)
+
+    def prune_reports(self, current_time):
+        # now we need to remove any reports that are outside the trouble_eval_window
+        for reports in self.lat_reports+self.loss_reports:
+            reports.prune(current_time, trouble_eval_window)
+
+    def failback_check(self):
+        # run by the failback timer of the scheduled main loop as soon as failback_wait_time has passed since the
+        # failover, instead of waiting for the next ping result
+        current_time=clock()
+        self.prune_reports(current_time)
+        self.evaluate(current_time)
+
+    def schedule_failback(self):
+        if failback_timer is not None:
+            failback_timer(self, self.last_failover_time+failback_wait_time)
+
+    def best_uplink(self, healthy, loss_count, latency, exclude=()):
+        # ranks the healthy selectable uplinks not in exclude by their lost pings, then by their latency, and returns
+        # the index of the best one (None if there is none)
+        candidates=[i for i in self.selectable if healthy[i] and i not in exclude]
+        if len(candidates)==0:
+            return None
+        return min(candidates, key=lambda i: (loss_count[i], latency[i]))
+
+    def switch_uplink(self, event, index, current_time, msg, *args, **fields):
+        # makes uplink index the default uplink with load balancing off and records the time we failed over
+        if tracer is not None and event=='failover':
+            tracer.decision(self.serial, self.networkId, self.uplinks[index], time.monotonic())
+        set_uplink_selection(self.networkId, load_balancing=False, default_uplink=self.uplinks[index])
+        self.isLoadbalancing=False
+        self.current_uplink=index+1
+        if event=='failover':
+            self.last_failover_time=current_time
+            self.schedule_failback()
+        state_change(event, self.serial, self.networkId, msg, *args, uplink=self.uplinks[index],
+                     load_balancing=False, **fields)
+
+    @staticmethod
+    def uplink_fields(indexes, average_latency, loss_count):
+        # average_latencyN and loss_countN log fields of the given uplinks, N being the uplink number
+        fields={}
+        for i in indexes:
+            fields['average_latency%d' % (i+1)]=average_latency[i]
+            fields['loss_count%d' % (i+1)]=loss_count[i]
+        return fields
+
+    def shared_fate_held(self, bUnstable):
+        # True if one of the troubled uplinks is in a group held back by shared_fate_correlation
+        if correlator is None or not correlator.is_held(self.serial, bUnstable):
+            return False
+        log_event(log, logging.DEBUG, "%s held back: its troubled uplinks share the fate of others in the same group",
+                  self.serial, sample_key=self.serial, serial=self.serial)
+        return True
+
+    def evaluate(self, current_time):
+        # the decision part: evaluates the reports in the trouble_eval_window and changes uplinks if needed. Whether
+        # each uplink is active is that of the latest ping result
+        global isTestConnDown
+        if self.networkId in pinnedNetworks:
+            # pinned through the control API
+            return
+        bChange=[change is not None and change.alarm for change in self.change]
+
+        #check to see if we are within the initial eval window to start running the logic. A change point
+        # alarm does not need to wait for it
+        if current_time-self.init_time>=trouble_eval_window or any(bChange):
+            average_latency, loss_count, latency, loss_percent = self.readings(current_time)
+            # an uplink is unstable if its latency statistic (or the jitter, if configured) is over the tolerance, it
+            # lost too many pings (a percentage of them with bursts) or its change point detector raised the alarm,
+            # and healthy if it answered the latest ping and is not unstable
+            bUnstable=[]
+            bHealthy=[]
+            for i in range(len(self.uplinks)):
+                bUnstable.append(latency[i]>average_latency_tolerance or
+                                 (jitter_tolerance is not None and self.lat_stats[i].jitter.value>jitter_tolerance) or
+                                 (loss_percent[i]>burst_loss_tolerance if burst_size>1 else
+                                  loss_count[i]>period_loss_report_tolerance) or bChange[i])
+                bHealthy.append(self.active[i] and not bUnstable[i])
+            if sla is not None and self.serial[0 : 6]!='tester':
+                sla.observe(self.serial, self.uplinks, current_time, bHealthy, bUnstable, self.current_uplink==1,
+                            self.isLoadbalancing)
+
+            if log.isEnabledFor(logging.DEBUG):
+                fields=self.uplink_fields(range(len(self.uplinks)), average_latency, loss_count)
+                for i in range(len(self.uplinks)):
+                    fields['latency%d' % (i+1)]=latency[i]
+                    fields['loss_percent%d' % (i+1)]=loss_percent[i]
+                    fields['jitter%d' % (i+1)]=self.lat_stats[i].jitter.value
+                    fields['change%d' % (i+1)]=bChange[i]
+                    fields['bUnstableWAN%d' % (i+1)]=bUnstable[i]
+                log_event(log, logging.DEBUG, "%s readings", self.serial, sample_key=self.serial, serial=self.serial,
+                          **fields)
+
+
+            if self.serial[0 : 6]=='tester':
+                #handling for special object with serial 'tester' to decide if we proceed with logic
+                #here, since it is not a real MX device, we use self.current_uplink just as an indicator that we have
+                # "failed over"  and are looking to "fail back" when the connection is improved, but we are really not
+                # doing anything regarding switching "uplinks", it's just to keep the logic similar to the regular MX
+                # devices since we are using the same objects to track status. Only its first "uplink" is pinged.
+                # Checking for adverse network conditions for tester to prevent rest of code from operating on MX devices:
+                if self.current_uplink==1 and bUnstable[0]:
+                    # sets global object to stop checking the rest of MX devices!!!
+                    isTestConnDown[self.uplink1_ip]=True
+                    update_prober_path()
+
+                    #keep setting the "current_uplink" for consistency, but not needed for this type of object
+                    self.current_uplink = 2
+                    self.last_failover_time = current_time
+                    self.schedule_failback()
+                    state_change('tester_down', self.serial, self.networkId,
+                                 'tester %s experiencing problems; marking as such in list', self.serial,
+                                 **self.uplink_fields((0,), average_latency, loss_count))
+                else:
+                    #now check if we were already handling adverse network conditions for tester to try and
+                    #switch back to "normal" once the adversities are gone.
+                    if self.current_uplink == 2 and current_time - self.last_failover_time > failback_wait_time:
+                        log_event(log, logging.DEBUG,
+                                  "Failback wait time has passed since tester %s went bad, check to see if now ok to mark as such...",
+                                  self.serial, sample_key=self.serial, serial=self.serial)
+                        if not bUnstable[0]:
+                            #set global object to continue checking the rest of MX devices!!!
+                            isTestConnDown[self.uplink1_ip]=False
+                            update_prober_path()
+                            self.current_uplink = 1
+                            state_change('tester_up', self.serial, self.networkId,
+                                         'tester %s back up after failback wait time.. marking as such in list',
+                                         self.serial, **self.uplink_fields((0,), average_latency, loss_count))
+
+            # before doing the "real" checks on MX devices to see if we need to manipulate load balancing and primary
+            # uplink values on the Meraki Dashboard, we must make sure the at least one "tester" destination is doing
+            # well. We only skip evaluating real MX devices if all tester destinations are reporting issues, or if
+            # the troubled uplinks are in a group many of whose uplinks went bad at once (shared_fate_correlation).
+            elif not proberPathDown and not self.shared_fate_held(bUnstable):
+                current=self.current_uplink-1
+                current_name=self.uplinks[current].upper()
+
+                # First check to see if device belongs to network in the NLB_networks_whitelist since, for those,
+                # there will never be any load balacing: if WAN1 is active and having issues then we need to failover
+                # to the best healthy other uplink (typically a 4G circuit) and constantly try to switch back to WAN1
+                # (typically a broadband circuit) when things are better
+                if self.isNLB:
+                    # NOTE: load balancing should never be turned on for NLB locations. If for some reason it is,
+                    # this code ignores that until it comes time to take action (either failover or failback to WAN1)
+                    # when it sets the load balancing off anyhow.
+                    # Ok, time to check to see if we have to make any uplink changes. First, and only if
+                    # we are currently on uplink 1 (WAN1), check to see if it has been problematic during
+                    # the last seconds specified in trouble_eval_window and see if we need to switch to another uplink
+                    if current==0:
+                        best=self.best_uplink(bHealthy, loss_count, latency, exclude=(0,)) if bUnstable[0] else None
+                        if best is not None:
+                            self.switch_uplink('failover', best, current_time,
+                                               'WAN1 problems in NLB site after tolerance period: using %s as uplink',
+                                               self.uplinks[best].upper(),
+                                               **self.uplink_fields((0,), average_latency, loss_count))
+                    elif current_time-self.last_failover_time>failback_wait_time and bHealthy[0]:
+                        # since enough time has passed since failover, and WAN1 seems to have been healthy for the past
+                        # number of seconds specified by trouble_eval_window, it is safe to fail back to WAN1 and we keep load balancing
+                        # turned off since this is an NLB site.
+                        self.switch_uplink('failback', 0, current_time,
+                                           'WAN1 good in NLB site after failback wait time: Failing back to WAN1 as uplink....',
+                                           **self.uplink_fields((0,), average_latency, loss_count))
+                    elif bUnstable[current]:
+                        # the uplink we failed over to is in trouble too, move on to the best other healthy one
+                        best=self.best_uplink(bHealthy, loss_count, latency, exclude=(0, current))
+                        if best is not None:
+                            self.switch_uplink('failover', best, current_time,
+                                               '%s problems in NLB site after tolerance period: using %s as uplink',
+                                               current_name, self.uplinks[best].upper(),
+                                               **self.uplink_fields((current,), average_latency, loss_count))
+                else:
+                    # If the logic reaches this point, then this is is a regular load-balancing site where our main goal is to have all circuits healthy
+                    # and load balancing turned on.
+
+                    # For this type of network/site, if load balancing is turned on and one of the links is in trouble, we need to set
+                    # the primarly uplink to the best healthy one and turn off load balancing. (If load balancing is on and
+                    # all links are healthy or all are bad we do nothing)
+                    if self.isLoadbalancing:
+                        troubled=[i for i in self.selectable if bUnstable[i]]
+                        best=self.best_uplink(bHealthy, loss_count, latency, exclude=troubled) if troubled else None
+                        if best is not None:
+                            self.switch_uplink('failover', best, current_time,
+                                               '%s problems after tolerance period: Load Balancing disabled, using %s as uplink',
+                                               '/'.join(self.uplinks[i].upper() for i in troubled),
+                                               self.uplinks[best].upper(),
+                                               **self.uplink_fields(troubled, average_latency, loss_count))
                     else:
-                        # If the logic reaches this point, then this is is a regular load-balancing site where our main goal is to have both circuits healthy
-                        # and load balancing turned on.
-
-                        # For this type of network/site, if load balancing is turned on and one of the links is in trouble, we need to set
-                        # the primarly uplink to the healthy one and turn off load balancing. (If load balancing is on and
-                        # both links are healthy or both are bad we do nothing)
-                        if self.isLoadbalancing:
-                            if bUnstableWAN1 and (bActiveWAN2 and not bUnstableWAN2):
-                                print("WAN1 unstable, latency: ", self.lat1_reports, " loss: ", self.loss1_reports)
-                                # Set WAN2 as uplink on device, turn off load balancing and record the time we failed over
-                                dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(
-                                    networkId=self.networkId, loadBalancingEnabled=False, defaultUplink='wan2')
-                                self.isLoadbalancing=False
-                                # since we called the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
-                                # we need to guarantee that we do not call the API more than 5 times per second so if we add a .2 sec delay
-                                # here , even if many other objects will have to make a WAN change, we will not be calling more than 5 times a second
-                                time.sleep(.20)
-                                self.current_uplink = 2
-                                self.last_failover_time = current_time
-                                print(
-                                    'WAN1 problems after tolerance period: Load Balancing disabled, using WAN2 as uplink')
-                            if bUnstableWAN2 and (bActiveWAN1 and not bUnstableWAN1):
-                                print("WAN2 unstable, latency: ", self.lat2_reports, " loss: ", self.loss2_reports)
-                                # Set WAN1 as uplink on device, turn off load balancing and record the time we failed over
-                                dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(
-                                    networkId=self.networkId, loadBalancingEnabled=False, defaultUplink='wan1')
-                                self.isLoadbalancing = False
-                                # since we called the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
-                                # we need to guarantee that we do not call the API more than 5 times per second so if we add a .2 sec delay
-                                # here , even if many other objects will have to make a WAN change, we will not be calling more than 5 times a second
-                                time.sleep(.20)
-                                self.current_uplink = 1
-                                self.last_failover_time = current_time
-                                print(
-                                    'WAN2 problems after tolerance period: Load Balancing disabled, using WAN1 as uplink')
-                        else:
-                            # This is where the logic goes if load balancing is turned off from the beginning or if the
-                            # script turned it off due to problems. Our goal is to turn it back on after the failback wait
-                            # time which would be immediately if this condition is detected when the script starts running
-                            # due toe failover manually having been turned off. But we only turn it back on if both circuits
-                            # are healthy, otherwise we do nothing.
-                            if current_time - self.last_failover_time > failback_wait_time:
-                                print(
-                                    "Two minutes or more have passed since load balacing was turned off, check to see if both uplinks are good again to turn back on...")
-                                if (bActiveWAN1 and not bUnstableWAN1) and (bActiveWAN2 and not bUnstableWAN2):
-                                    if self.current_uplink==1:
-                                        theWan='wan1'
-                                    else:
-                                        theWan='wan2'
-                                    print("Yes! latency wan1: ", self.lat1_reports, " loss wan1: ", self.loss1_reports,
-                                          " latency wan2: ", self.lat2_reports, " loss wan2: ", self.loss2_reports)
-                                    dashboard.appliance.updateNetworkApplianceTrafficShapingUplinkSelection(
-                                        networkId=self.networkId, loadBalancingEnabled=True, defaultUplink=theWan)
-                                    self.isLoadbalancing = True
-                                    # since we called the Meraki Dashboard API withing a MX Device Object method which is called within a large loop
-                                    # we need to guarantee that we do not call the API more than 5 times per second so if we add a .2 sec delay
-                                    # here , even if many other objects will have to make a WAN change, we will not be calling more than 5 times a second
-                                    time.sleep(.20)
-                                    print(
-                                        'WAN1 and WAN2 good after failback wait time:  re-enabling Load Balancing and keeping primary link as: ',theWan)
-
+                        # This is where the logic goes if load balancing is turned off from the beginning or if the
+                        # script turned it off due to problems. Our goal is to turn it back on after the failback wait
+                        # time which would be immediately if this condition is detected when the script starts running
+                        # due toe failover manually having been turned off. But we only turn it back on if all selectable
+                        # circuits are healthy, otherwise we do nothing.
+                        if current_time - self.last_failover_time > failback_wait_time:
+                            log_event(log, logging.DEBUG,
+                                      "Failback wait time has passed since load balacing was turned off, check to see if all uplinks are good again to turn back on...",
+                                      sample_key=self.serial, serial=self.serial)
+                            if all(bHealthy[i] for i in self.selectable):
+                                theWan=self.uplinks[current]
+                                set_uplink_selection(self.networkId, load_balancing=True, default_uplink=theWan)
+                                self.isLoadbalancing = True
+                                state_change('load_balancing_enabled', self.serial, self.networkId,
+                                             '%s good after failback wait time:  re-enabling Load Balancing and keeping primary link as: %s',
+                                             ' and '.join(self.uplinks[i].upper() for i in self.selectable),
+                                             theWan, uplink=theWan, load_balancing=True,
+                                             **self.uplink_fields(self.selectable, average_latency, loss_count))
 
 
 
 
 allMXDevices={}
 deviceSerialofUplinkIP={}
+uplinkIPsOfSerial={}
 allUplinkIPs=[]
 def refreshDevicesDict():
-    global allMXDevices, allUplinkIPs, useWhiteList, scriptConnTestDestination
+    install_inventory(*read_inventory())
+
+def read_inventory():
+    # reads the organizations, their whitelists and all their devices from the Dashboard without touching the
+    # monitored devices, so it can run while they are pinged and evaluated. Returns what install_inventory() takes
+    # the organizations already monitored keep their clients, rate limiters and poll times
+    read_orgs = load_orgs(orgs, api_key, org_id, dashboard, dashboard_base_url, dashboard_calls_per_second,
+                          monitored_orgs)
+    # the devices of all organizations are pinged and evaluated together
+    records = []
+    for monitored_org in read_orgs.values():
+        load_whitelists(monitored_org)
+        records.extend(read_org_devices(monitored_org))
+    return read_orgs, records
+
+def tester_device(testerIP):
+    testerSString='tester'+testerIP
+    return WAN_device(networkId=testerSString, serial=testerSString, uplink1_ip=testerIP, uplink2_ip='',
+                      my_org_number=org_id, current_uplink=1, is_load_balancing=False, is_NLB=False)
+
+def install_inventory(read_orgs, records, keep_windows=False):
+    # replaces the monitored devices with those read by read_inventory(). With keep_windows the devices that were
+    # already monitored with the same uplink IPs keep their evaluation windows
+    global allMXDevices, allUplinkIPs, uplinkIPsOfSerial, useWhiteList, scriptConnTestDestination, monitored_orgs, orgOfNetwork, knownUplinkSelection
+    previous = allMXDevices if keep_windows else None
     allUplinkIPs=[]
     allMXDevices = {}
-    white_list=[]
-    NLB_white_list=[]
+    uplinkIPsOfSerial = {}
+    orgOfNetwork = {}
+    knownUplinkSelection = {}
+    monitored_orgs = read_orgs
+
+    # If scriptConnTestDestinations is not empty, add them as the first "MX devices" with a serial number that
+    # identifies them as a special test destination "device" to include in ping test but not consider for
+    # switchover
+    if len(scriptConnTestDestinations)>0:
+        for testerIP in scriptConnTestDestinations:
+            testerSString='tester'+testerIP
+            allMXDevices[testerSString] = tester_device(testerIP)
+            if recorder is not None:
+                recorder.record_device(testerSString, testerSString, testerIP, '', 1, False, False)
+            deviceSerialofUplinkIP[testerIP] = (testerSString, 0)
+            uplinkIPsOfSerial[testerSString] = [testerIP]
+            allUplinkIPs.append(testerIP)
+            isTestConnDown[testerIP]=False
+
+    for record in records:
+        add_device(record, previous)
+
+    # the device objects were all just recreated, so start a fresh probe schedule with every device due right away
+    start_probe_schedule()
+    build_correlation_index()
+    tune_gc()
+    save_target_cache()
+
+def load_whitelists(monitored_org):
+    # reads the whitelists of network IDs of one organization. A missing file is an empty whitelist, also when it is
+    # deleted while running; the ones read before are kept if a file is there but cannot be read
 
     # read a whitelist of network IDs to consider when adding devices to the Dict
     try:
-        with open('networks_whitelist.txt') as my_file:
-            white_list = my_file.read().splitlines()
+        monitored_org.whitelist = read_network_list(monitored_org.whitelist_file)
+    except FileNotFoundError:
+        log.error("Whitelist %s not found, monitoring none of its networks", monitored_org.whitelist_file)
+        monitored_org.whitelist = frozenset()
     except IOError as e:
-        print("Error trying to read whitelist, skipping...")
+        log.error("Error trying to read whitelist %s, skipping...", monitored_org.whitelist_file)
     except:
-        print("Unexpected error: ",sys.exc_info()[0])
+        log.exception("Unexpected error reading whitelist")
 
     # read a NLB (no load balance) whitelist of network IDs to consider when adding devices to the Dict
     try:
-        with open('NLB_networks_whitelist.txt') as NLB_file:
-            NLB_white_list = NLB_file.read().splitlines()
+        monitored_org.NLB_whitelist = read_network_list(monitored_org.NLB_whitelist_file)
+    except FileNotFoundError:
+        log.error("NLB whitelist %s not found, monitoring none of its networks", monitored_org.NLB_whitelist_file)
+        monitored_org.NLB_whitelist = frozenset()
     except IOError as e:
-        print("Error trying to read NLB whitelist, skipping...")
+        log.error("Error trying to read NLB whitelist %s, skipping...", monitored_org.NLB_whitelist_file)
     except:
-        print("Unexpected error: ",sys.exc_info()[0])
-
-    # If scriptConnTestDestinations is not empty, add them as the first "MX devices" with a serial number that
-    # identifies them as a special test destination "device" to include in ping test but not consider for
-    # switchover
-    if len(scriptConnTestDestinations)>0:
-        for testerIP in scriptConnTestDestinations:
-            testerSString='tester'+testerIP
-            allMXDevices[testerSString] = WAN_device(networkId=testerSString, serial=testerSString, uplink1_ip=testerIP,
-                                                     uplink2_ip='', my_org_number=org_id,
-                                                     current_uplink=1, is_load_balancing=False, is_NLB=False)
-            deviceSerialofUplinkIP[testerIP] = [testerSString, 'wan1']
-            allUplinkIPs.append(testerIP)
-            isTestConnDown[testerIP]=False
+        log.exception("Unexpected error reading NLB whitelist")
+
+def is_monitored_network(monitored_org, networkId):
+    # If useWhiteList is True, then there the NetworkId of the device has to be in the list for it to be considered.
+    # Otherwise, the condition will always be met and the device will be considered to add to the list.
+    return (not useWhiteList) or (networkId in monitored_org.whitelist) or (networkId in monitored_org.NLB_whitelist)
+
+def is_NLB_network(monitored_org, networkId):
+    return useWhiteList and networkId in monitored_org.NLB_whitelist
+
+def refreshOrgDevices(monitored_org, networks=None):
+    # adds the devices of one organization that are not monitored yet to allMXDevices (only those of the networks in
+    # networks if given)
+    for record in read_org_devices(monitored_org, allMXDevices, networks):
+        add_device(record)
+
+def read_org_devices(monitored_org, known=(), networks=None):
+    # reads the devices of one organization that are not in known (only those of the networks in networks if given)
+    # with the organization's Dashboard client and the whitelists read by load_whitelists(), and returns what
+    # add_device() needs for each of them
+    import requests  # imported on first use, see LazyDashboardAPI
+    dashboard = monitored_org.dashboard
+    records = []
+    # the report has an entry per uplink (and probe IP) of every device, each device is read once
+    seen = set()
 
     # Get the last 5 minutes of UplinkLoss and Latency data for all MX devices in the Organization
     # to make a list of which to monitor via Ping.
-    org = dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(organizationId=org_id)
-    print('updating devices')
+    org = dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(organizationId=monitored_org.org_id)
+    log_event(log, logging.INFO, 'updating devices', org_id=monitored_org.org_id)
     for anEntry in org:
-        if anEntry['serial'] not in allMXDevices.keys():
-            deviceInfo=dashboard.devices.getDevice(anEntry['serial'])
-            print("GetDevice: ",deviceInfo)
-            print("Trying to call getNetworkDeviceUplink with: ",anEntry['networkId'],"  ",anEntry['serial'])
-            url = "https://api.meraki.com/api/v0/networks/"+anEntry['networkId']+"/devices/"+anEntry['serial']+"/uplink"
-            payload = None
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "X-Cisco-Meraki-API-Key": api_key
-            }
-            response = requests.request('GET', url, headers=headers, data=payload)
-            deviceULinkInfo=json.loads(response.text.encode('utf8'))
-            print("DeviceULinkInfo: ", deviceULinkInfo)
-
-            # If useWhiteList is True, then there the NetworkId of the device has to be in the list for it to be considered.
-            # Otherwise, the condition will always be met and the device will be considered to add to the list.
-            if ((not useWhiteList)  or  (anEntry['networkId'] in white_list) or (anEntry['networkId'] in NLB_white_list)):
+        if networks is not None and anEntry['networkId'] not in networks:
+            continue
+        if anEntry['serial'] not in known and anEntry['serial'] not in seen:
+            seen.add(anEntry['serial'])
+            # the devices of networks that are not monitored are skipped before making any more Dashboard calls
+            if is_monitored_network(monitored_org, anEntry['networkId']):
+                deviceInfo=dashboard.devices.getDevice(anEntry['serial'])
+                log_event(log, logging.DEBUG, "GetDevice", serial=anEntry['serial'], deviceInfo=deviceInfo)
+                url = dashboard_base_url.replace('/api/v1','/api/v0')+"/networks/"+anEntry['networkId']+"/devices/"+anEntry['serial']+"/uplink"
+                payload = None
+                headers = {
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                    "X-Cisco-Meraki-API-Key": monitored_org.api_key
+                }
+                monitored_org.throttle()
+                response = requests.request('GET', url, headers=headers, data=payload)
+                deviceULinkInfo=json.loads(response.text.encode('utf8'))
+                log_event(log, logging.DEBUG, "DeviceULinkInfo", serial=anEntry['serial'], deviceULinkInfo=deviceULinkInfo)
+
                 #fist make sure this device is not a warm spare using getNetworkApplianceWarmSpare call which returns:
                 #{
                 #     "enabled": false,
@@ -424,91 +1010,812 @@ def refreshDevicesDict():
                     wan1IP=deviceInfo['wan1Ip']
                     wan2IP=deviceInfo['wan2Ip']
 
-                    #  Change to the publicIp of an uplink if useWANpublicIP is set to true
+                    # the uplink status names its uplinks 'WAN 1', 'WAN 2', 'WAN 3', 'Cellular'; change to the publicIp of
+                    # an uplink if useWANpublicIP is set to true. The IPs of the extra_uplinks only come from there
+                    uplinkIPs={}
+                    for uplinkInfo in deviceULinkInfo:
+                        uplinkIPs[uplinkInfo['interface'].lower().replace(' ','')]=\
+                            uplinkInfo.get('publicIp' if useWANpublicIP else 'ip')
                     if useWANpublicIP:
-                        if len(deviceULinkInfo)>0:
-                            if deviceULinkInfo[0]['interface']=='WAN 1':
-                                wan1IP=deviceULinkInfo[0]['publicIp']
-                            elif deviceULinkInfo[0]['interface']=='WAN 2':
-                                wan2IP = deviceULinkInfo[0]['publicIp']
-                        if len(deviceULinkInfo)>1:
-                            if deviceULinkInfo[1]['interface']=='WAN 1':
-                                wan1IP=deviceULinkInfo[1]['publicIp']
-                            elif deviceULinkInfo[1]['interface']=='WAN 2':
-                                wan2IP = deviceULinkInfo[1]['publicIp']
+                        wan1IP=uplinkIPs.get('wan1', wan1IP)
+                        wan2IP=uplinkIPs.get('wan2', wan2IP)
+                    extraIPs=[(name, uplinkIPs.get(name)) for name in extra_uplinks]
 
                     #retrieve current state of defaultUplink and loadbalancing for device
-                    print("About to retrieve WAN selection and load balancing from dashboard for ",anEntry['networkId'])
                     ulinkselection=dashboard.appliance.getNetworkApplianceTrafficShapingUplinkSelection(networkId=anEntry['networkId'])
                     ulinks_currentuplink=1 if ulinkselection['defaultUplink']=="wan1" else 2
                     ulinks_isloadbalancing=ulinkselection['loadBalancingEnabled']
-                    if not useWhiteList:
-                        is_in_NLB_whitelist=False
-                    else:
-                        is_in_NLB_whitelist=(anEntry['networkId'] in NLB_white_list)
-
-                    print("Result: ",ulinks_currentuplink, ulinks_isloadbalancing,is_in_NLB_whitelist )
-
-                    allMXDevices[anEntry['serial']] = WAN_device(networkId=anEntry['networkId'], serial=anEntry['serial'],
-                                                                 uplink1_ip=wan1IP,uplink2_ip=wan2IP, my_org_number=org_id,
-                                                                 current_uplink=ulinks_currentuplink, is_load_balancing=ulinks_isloadbalancing,
-                                                                 is_NLB=is_in_NLB_whitelist)
-                    #keeping track of which IPs belong to which MX devices and also which wan link is for each IP address
-                    if wan1IP!=None:
-                        deviceSerialofUplinkIP[wan1IP]=[anEntry['serial'],'wan1']
-                        allUplinkIPs.append(wan1IP)
-                    if wan2IP!=None:
-                        deviceSerialofUplinkIP[wan2IP]=[anEntry['serial'],'wan2']
-                        allUplinkIPs.append(wan2IP)
-
-refreshDevicesDict()
-print(allMXDevices)
-
-# forever loop to ping all devices and decide if to act
-while True:
-    if len(allUplinkIPs)>0:
-        responses, no_responses = multi_ping(allUplinkIPs, timeout=ping_timeout, retry=ping_retry, ignore_lookup_errors=True)
-        print("responses=", responses, "no_responses=", no_responses)
-
-        responsesPerSerial={}
-        # example responsesPerSerial['ER34234']=[0.009306907653808594,0.012850046157836914]
-        for response in responses.keys():
-            theDev=deviceSerialofUplinkIP[response]
-            theDevSerial=theDev[0]
-            theDevWan = theDev[1]
-            # initialize the response array if not already done
-            if theDevSerial not in responsesPerSerial:
-                responsesPerSerial[theDevSerial]=[None,None]
-            if theDevWan=='wan1':
-                responsesPerSerial[theDevSerial][0]=responses[response]
-            if theDevWan=='wan2':
-                responsesPerSerial[theDevSerial][1]=responses[response]
-
-        #now process the no_response array
-        for nresponse in no_responses:
-            theDev=deviceSerialofUplinkIP[nresponse]
-            theDevSerial=theDev[0]
-            theDevWan = theDev[1]
-            #initialize the response array if there was none returned in response above
-            if theDevSerial not in responsesPerSerial:
-                responsesPerSerial[theDevSerial] = [None, None]
-            if theDevWan=='wan1':
-                responsesPerSerial[theDevSerial][0]=-1
-            if theDevWan=='wan2':
-                responsesPerSerial[theDevSerial][1]=-1
-
-
-        for entry_serial in allMXDevices:
-            allMXDevices[entry_serial].uplink_selector(responsesPerSerial[entry_serial])
-
-        #just to give a small break between calls to multi-ping, could remove
-        time.sleep(inter_ping_delay)
+                    is_in_NLB_whitelist=is_NLB_network(monitored_org, anEntry['networkId'])
+
+                    records.append({'networkId': anEntry['networkId'], 'serial': anEntry['serial'],
+                                    'my_org_number': monitored_org.org_id, 'uplink1_ip': wan1IP, 'uplink2_ip': wan2IP,
+                                    'current_uplink': ulinks_currentuplink, 'is_load_balancing': ulinks_isloadbalancing,
+                                    'is_NLB': is_in_NLB_whitelist, 'extra_uplinks': extraIPs,
+                                    'selection': [ulinks_isloadbalancing, ulinkselection['defaultUplink'],
+                                                  time.monotonic()]})
+    return records
+
+def add_device(record, previous=None):
+    # starts monitoring a device read by read_org_devices(). If previous holds the device with the same uplink IPs, that
+    # object is kept with its evaluation windows and given the uplink state just read
+    serial=record['serial']
+    log_event(log, logging.INFO, "Adding device %s", serial, serial=serial, networkId=record['networkId'],
+              org_id=record['my_org_number'], current_uplink=record['current_uplink'],
+              load_balancing=record['is_load_balancing'], is_NLB=record['is_NLB'])
+    device=previous.get(serial) if previous is not None else None
+    if device is not None and device.uplink_ips==[record['uplink1_ip'], record['uplink2_ip']]+\
+            [ip for _, ip in record['extra_uplinks']]:
+        device.networkId=sys.intern(record['networkId'])
+        device.my_org_number=record['my_org_number']
+        device.current_uplink=record['current_uplink']
+        device.isLoadbalancing=record['is_load_balancing']
+        device.isNLB=record['is_NLB']
+    else:
+        device=WAN_device(**{key: value for key, value in record.items() if key!='selection'})
+    allMXDevices[device.serial]=device
+    orgOfNetwork[device.networkId]=device.my_org_number
+    knownUplinkSelection[device.networkId]=record['selection']
+    register_uplinks(device.serial, device)
+
+def register_uplinks(serial, device):
+    #keeping track of which IPs belong to which MX devices and also which uplink (its index) is for each IP address
+    if recorder is not None:
+        recorder.record_device(serial, device.networkId, device.uplink1_ip, device.uplink2_ip,
+                               device.current_uplink, device.isLoadbalancing, device.isNLB)
+        for index in range(2, len(device.uplinks)):
+            recorder.record_uplink(serial, index+1, device.uplinks[index], device.uplink_ips[index])
+    for index, ip in enumerate(device.uplink_ips):
+        if ip!=None:
+            deviceSerialofUplinkIP[ip]=(device.serial, index)
+            uplinkIPsOfSerial.setdefault(serial, []).append(ip)
+            allUplinkIPs.append(ip)
+
+def remove_devices(serials):
+    # stops monitoring the devices with the given serials
+    global allUplinkIPs
+    removedIPs=set()
+    for serial in serials:
+        device=allMXDevices.pop(serial, None)
+        if device is None:
+            continue
+        for ip in uplinkIPsOfSerial.pop(serial, ()):
+            deviceSerialofUplinkIP.pop(ip, None)
+            removedIPs.add(ip)
+        orgOfNetwork.pop(device.networkId, None)
+        knownUplinkSelection.pop(device.networkId, None)
+        if scheduler is not None:
+            scheduler.remove(serial)
+        log_event(log, logging.INFO, "Removing device %s", serial, serial=serial, networkId=device.networkId)
+    if removedIPs:
+        allUplinkIPs=[ip for ip in allUplinkIPs if ip not in removedIPs]
+
+def apply_whitelists(changed_orgs):
+    # brings the monitored devices of the given organizations in line with their whitelists (already read): the
+    # devices of networks no longer in them are removed, those of networks moved between the two are re-flagged and
+    # those of networks new to them are read from the Dashboard and added. All other devices are left as they are
+    global allUplinkIPs
+    # a copy, the probe thread may still be pinging the uplink IPs of the list it was handed
+    allUplinkIPs=list(allUplinkIPs)
+    removed=0
+    reflagged=0
+    for monitored_org in changed_orgs:
+        networks=set()
+        unlisted=[]
+        for serial, device in allMXDevices.items():
+            if serial in testerSerials or device.my_org_number!=monitored_org.org_id:
+                continue
+            networks.add(device.networkId)
+            if not is_monitored_network(monitored_org, device.networkId):
+                unlisted.append(serial)
+            elif device.isNLB!=is_NLB_network(monitored_org, device.networkId):
+                device.isNLB=not device.isNLB
+                reflagged+=1
+                log_event(log, logging.INFO, "Re-flagging device %s", serial, serial=serial,
+                          networkId=device.networkId, is_NLB=device.isNLB)
+        remove_devices(unlisted)
+        removed+=len(unlisted)
+        before=len(allMXDevices)
+        if not useWhiteList:
+            refreshOrgDevices(monitored_org)
+        else:
+            added=(monitored_org.whitelist | monitored_org.NLB_whitelist)-networks
+            if added:
+                refreshOrgDevices(monitored_org, added)
+        if scheduler is not None:
+            now=clock()
+            for serial in list(allMXDevices)[before:]:
+                scheduler.add(serial, now)
+    build_correlation_index()
+    save_target_cache()
+    log_event(log, logging.INFO, "whitelists applied", removed=removed, reflagged=reflagged,
+              devices=len(allMXDevices))
+
+def start_probe_schedule():
+    global scheduler
+    if adaptive_probing:
+        scheduler = AdaptiveProbeScheduler(adaptive_probe_base_interval)
+        now = clock()
+        for serial in uplinkIPsOfSerial:
+            scheduler.add(serial, now)
+    else:
+        scheduler = None
+
+def save_target_cache():
+    # saves the monitored devices to target_cache_file for the next start, replacing the file in one step
+    if not target_cache_file:
+        return
+    devices=[{'serial': serial, 'networkId': device.networkId, 'org_id': device.my_org_number,
+              'uplinks': [[name, ip] for name, ip in zip(device.uplinks, device.uplink_ips)],
+              'current_uplink': device.current_uplink, 'load_balancing': device.isLoadbalancing, 'is_NLB': device.isNLB}
+             for serial, device in allMXDevices.items() if serial[0 : 6]!='tester']
+    try:
+        with open(target_cache_file+'.tmp', 'w') as cache_file:
+            json.dump({'saved': time.time(), 'devices': devices}, cache_file)
+        os.replace(target_cache_file+'.tmp', target_cache_file)
+    except (IOError, OSError):
+        log.exception("Error writing target cache %s", target_cache_file)
+
+def load_target_cache():
+    # the testers and the devices saved in target_cache_file as WAN_device objects by serial, None without a cache
+    try:
+        with open(target_cache_file) as cache_file:
+            cache=json.load(cache_file)
+        devices={'tester'+testerIP: tester_device(testerIP) for testerIP in scriptConnTestDestinations}
+        for entry in cache['devices']:
+            uplinks=entry['uplinks']
+            devices[entry['serial']]=WAN_device(networkId=entry['networkId'], serial=entry['serial'],
+                                                my_org_number=entry['org_id'], uplink1_ip=uplinks[0][1],
+                                                uplink2_ip=uplinks[1][1], current_uplink=entry['current_uplink'],
+                                                is_load_balancing=entry['load_balancing'], is_NLB=entry['is_NLB'],
+                                                extra_uplinks=[tuple(uplink) for uplink in uplinks[2:]])
+    except (IOError, OSError):
+        return None
+    except (ValueError, KeyError, IndexError, TypeError):
+        log.exception("Error reading target cache %s, waiting for the inventory", target_cache_file)
+        return None
+    log_event(log, logging.INFO, "loaded %d devices from target cache %s", len(cache['devices']), target_cache_file,
+              saved=cache.get('saved'))
+    return devices
+
+def tune_gc():
+    # applies gc_thresholds and gc_freeze_devices after the devices were (re)loaded. The objects frozen with the
+    # previous devices are unfrozen and collected first, cycles among them are only found then
+    if gc_thresholds is not None:
+        gc.set_threshold(*gc_thresholds)
+    if gc_freeze_devices:
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+
+def update_prober_path():
+    # called whenever a tester goes down or comes back
+    global proberPathDown
+    proberPathDown = len(isTestConnDown)>0 and all(isTestConnDown.values())
+
+def build_correlation_index():
+    # indexes the testers and, with shared_fate_correlation, the group of every uplink of the MX devices. Called after
+    # every change of the devices, the groups held back stay held if they still have uplinks
+    global testerSerials, correlator
+    testerSerials = {serial for serial in allMXDevices if serial[0 : 6]=='tester'}
+    update_prober_path()
+    if not shared_fate_correlation:
+        correlator = None
+        return
+    if correlator is None:
+        group_prefixes = load_group_prefixes(shared_fate_groups_file) if shared_fate_groups_file else ()
+        correlator = SharedFateCorrelator(shared_fate_threshold, shared_fate_min_degraded, trouble_eval_window,
+                                          shared_fate_prefix_length, shared_fate_prefix_length_v6, group_prefixes)
+    correlator.build((serial, device.uplink_ips) for serial, device in allMXDevices.items()
+                     if serial not in testerSerials)
+
+def is_bad_sample(value):
+    # whether a ping result (or burst) counts as bad for shared_fate_correlation: unreachable, too much loss or latency
+    if isinstance(value, BurstStats):
+        return value.loss>burst_loss_tolerance or (value.avg is not None and value.avg>average_latency_tolerance)
+    return value==-1 or value>average_latency_tolerance
+
+def correlate(responsesPerSerial):
+    # holds back the uplink groups with too many bad results in this cycle and releases those that have been fine for
+    # long enough
+    held, released = correlator.correlate(responsesPerSerial, is_bad_sample, clock())
+    for group, degraded, probed in held:
+        log_state_change(log, 'shared_fate_hold', None, None,
+                         '%d of %d uplinks in %s bad at once: holding back uplink changes of their devices',
+                         degraded, probed, group, group=group, degraded=degraded, probed=probed)
+    for group in released:
+        log_state_change(log, 'shared_fate_release', None, None, 'uplinks in %s recovered: releasing them', group,
+                         group=group)
+
+def evaluate_devices(responsesPerSerial, dueSerials=None):
+    # evaluates the devices in dueSerials (all of them if None) with the results of one cycle: the testers first, so
+    # that the MX devices see whether the path of the script is down, then the MX devices once the shared fate groups
+    # are updated. Returns the number of devices evaluated
+    serials = allMXDevices if dueSerials is None else dueSerials
+    now=clock()
+    evaluated=0
+    for testers in (True, False):
+        if not testers and correlator is not None:
+            correlate(responsesPerSerial)
+        for entry_serial in serials:
+            if (entry_serial in testerSerials)!=testers:
+                continue
+            device=allMXDevices.get(entry_serial)
+            if device is None:
+                continue
+            device.uplink_selector(responsesPerSerial.get(entry_serial, ()))
+            if dueSerials is not None and scheduler is not None:
+                scheduler.reschedule(entry_serial, now, device.needs_close_watch(now))
+            evaluated+=1
+    return evaluated
+
+def load_devices(devices):
+    # replaces the monitored devices with already built WAN_device objects (keyed by serial) instead of reading them
+    # from the Dashboard, keeping whatever evaluation state they carry. Used by sharded_prober.py to hand each worker
+    # process its share of the devices, possibly restored from a snapshot of another worker
+    global allMXDevices, allUplinkIPs, uplinkIPsOfSerial
+    allMXDevices = dict(devices)
+    allUplinkIPs = []
+    uplinkIPsOfSerial = {}
+    for serial, device in allMXDevices.items():
+        if serial[0 : 6]=='tester':
+            if recorder is not None:
+                recorder.record_device(serial, device.networkId, device.uplink1_ip, device.uplink2_ip,
+                                       device.current_uplink, device.isLoadbalancing, device.isNLB)
+            deviceSerialofUplinkIP[device.uplink1_ip] = (device.serial, 0)
+            uplinkIPsOfSerial[serial] = [device.uplink1_ip]
+            allUplinkIPs.append(device.uplink1_ip)
+            isTestConnDown[device.uplink1_ip] = device.current_uplink != 1
+            continue
+        orgOfNetwork[device.networkId] = device.my_org_number
+        register_uplinks(serial, device)
+    start_probe_schedule()
+    build_correlation_index()
+    tune_gc()
+
+def probe_targets():
+    # returns the serials of the devices to evaluate with this cycle's results (None for all of them) and the uplink
+    # IPs to ping. With adaptive_probing only the devices the scheduler says are due are pinged and evaluated, and
+    # with cycle_budget calm devices may be left out of cycles that would take too long
+    dueSerials=scheduler.due(clock()) if scheduler is not None else None
+    if shedder is not None:
+        dueSerials=shed_load(dueSerials)
+    if dueSerials is not None:
+        return dueSerials, [ip for serial in dueSerials for ip in uplinkIPsOfSerial.get(serial, ())]
+    return None, allUplinkIPs
+
+def longest_probe_wait():
+    # the longest a ping cycle waits for the replies: ping_timeout per try, or after the burst with burst_size>1
+    if burst_size>1:
+        return (burst_size-1)*burst_interval+ping_timeout
+    return ping_timeout*(ping_retry+1)
+
+def longest_probe_gap():
+    # the longest a device goes without being pinged: adaptive_probe_base_interval with adaptive_probing, plus
+    # load_shed_max_defer with cycle_budget
+    gap=adaptive_probe_base_interval if adaptive_probing else 0
+    if shedder is not None:
+        gap+=load_shed_max_defer
+    return gap
+
+def shed_load(dueSerials):
+    # the devices to ping in this cycle out of dueSerials (all the devices if None) while the cycles overrun
+    # cycle_budget. The testers, the devices that need a close watch and those not pinged for load_shed_max_defer
+    # seconds always are. With adaptive_probing the devices left out are due again in the next cycle
+    now=clock()
+    overdue=longest_probe_gap()
+
+    def is_priority(serial):
+        device=allMXDevices.get(serial)
+        if device is None or serial in testerSerials:
+            return True
+        if device.last_sample_time is not None and now-device.last_sample_time>=overdue:
+            return True
+        return device.needs_close_watch(now)
+
+    selected, deferred=shedder.select(allMXDevices if dueSerials is None else dueSerials, is_priority)
+    if not deferred:
+        return dueSerials
+    if scheduler is not None:
+        for serial in deferred:
+            scheduler.defer(serial, now)
+    return selected
+
+def cycle_done(started, waited, evaluated):
+    # tells the shedder how long the cycle that started at started (time.monotonic()) took for its evaluated devices,
+    # of which it waited seconds in the ICMP call
+    duration=time.monotonic()-started
+    change=shedder.cycle_done(duration, waited, evaluated)
+    if change=='started':
+        log_state_change(log, 'load_shedding_started', None, None,
+                         'ping cycle took %.3fs of a %.3fs budget: pinging up to %d devices per cycle, priority '
+                         'devices first', duration, shedder.budget, shedder.capacity, duration=duration,
+                         budget=shedder.budget, capacity=shedder.capacity)
+    elif change=='ended':
+        log_state_change(log, 'load_shedding_ended', None, None,
+                         'all devices due fit in the %.3fs cycle budget again', shedder.budget, duration=duration,
+                         budget=shedder.budget)
+
+def probe(uplinkIPs):
+    # uplinks an ICMP error message came back for (unreachable, administratively prohibited, time exceeded) are
+    # counted as lost right when the error arrives instead of after ping_timeout, and the cycle ends as soon as every
+    # uplink has answered or failed
+    # With burst_size>1 responses holds the BurstStats of every uplink and no_responses those without any reply.
+    # Also returns the seconds spent in the ICMP call, for cycle_budget
+    icmp_errors={}
+    icmp_started=time.monotonic()
+    if len(uplinkIPs)>0 and burst_size>1:
+        responses, no_responses = burst_ping(uplinkIPs, burst_size, burst_interval, ping_timeout,
+                                             ignore_lookup_errors=True, errors=icmp_errors)
+    elif len(uplinkIPs)>0:
+        responses, no_responses = multi_ping(uplinkIPs, timeout=ping_timeout, retry=ping_retry, ignore_lookup_errors=True,
+                                             errors=icmp_errors)
+    else:
+        responses, no_responses = {}, []
+    waited=time.monotonic()-icmp_started
+    # only a per cycle summary is logged at INFO level, the full results can be very large with many devices
+    log_event(log, logging.INFO, "ping cycle", responses=len(responses), no_responses=len(no_responses),
+              icmp_errors=len(icmp_errors), probed=len(uplinkIPs),
+              boosted=len(scheduler.boosted) if scheduler is not None else None,
+              deferred=shedder.last_deferred if shedder is not None else None)
+    log_event(log, logging.DEBUG, "ping cycle results", responses=responses, no_responses=no_responses,
+              icmp_errors=icmp_errors)
+    return responses, no_responses, waited
+
+def probe_due(dueSerials, uplinkIPs):
+    # probe() for the devices in dueSerials, taken from the scheduler by probe_targets(): if the ICMP call fails they
+    # are due again in the next cycle instead of dropping out of the schedule
+    try:
+        return probe(uplinkIPs)
+    except Exception:
+        if scheduler is not None and dueSerials is not None:
+            now=clock()
+            for serial in dueSerials:
+                scheduler.defer(serial, now)
+        raise
+
+def ping_cycle():
+    # one round of pinging all uplink IPs and evaluating every device with the results. Returns the number of
+    # devices evaluated. The caller is responsible for pacing the calls.
+    global cycle_started
+    started=time.monotonic()
+    dueSerials, uplinkIPs = probe_targets()
+    responses, no_responses, waited = probe_due(dueSerials, uplinkIPs)
+    cycle_started=started
+    evaluated=evaluate_cycle(responses, no_responses, dueSerials)
+    if shedder is not None:
+        cycle_done(started, waited, evaluated)
+    return evaluated
+
+def probe_into(result):
+    # one round of pinging from the probe thread of threaded_probing, filling the ProbeResult buffer result
+    result.started=time.monotonic()
+    with inventory_lock:
+        result.inventory=inventory_version
+        result.dueSerials, uplinkIPs = probe_targets()
+    result.cycle_time=clock()
+    result.responses, result.no_responses, result.waited = probe_due(result.dueSerials, uplinkIPs)
+
+def evaluate_probe_result(result):
+    # evaluates the devices with the results handed off by the probe thread, returns the number of devices evaluated
+    global cycle_started
+    if result.inventory!=inventory_version:
+        defer_stale(result)
+        return 0
+    cycle_started=result.started
+    evaluated=evaluate_cycle(result.responses, result.no_responses, result.dueSerials)
+    if shedder is not None:
+        # from the start of the ping cycle, so the time the results waited to be evaluated counts too
+        cycle_done(result.started, result.waited, evaluated)
+    return evaluated
+
+def reschedule_dropped(result):
+    # the devices of results replaced before they were evaluated are due again right away
+    if result.inventory!=inventory_version:
+        defer_stale(result)
+    elif scheduler is not None and result.dueSerials is not None:
+        now=clock()
+        for serial in result.dueSerials:
+            scheduler.reschedule(serial, now, True)
+
+def defer_stale(result):
+    # results pinged for an older inventory are not evaluated, but their devices were taken from the scheduler by
+    # due(): those still monitored are due again in the next cycle, or they would not be pinged until the next
+    # inventory refresh
+    if scheduler is not None and result.dueSerials is not None:
+        now=clock()
+        for serial in result.dueSerials:
+            if serial in allMXDevices:
+                scheduler.defer(serial, now)
+
+
+def evaluate_cycle(responses, no_responses, dueSerials=None):
+    # evaluates the devices with one round of ping results: responses maps uplink IPs to their RTT (or the BurstStats
+    # of their burst) and no_responses lists the uplink IPs that did not answer. Only the devices in dueSerials are evaluated if given, otherwise all of
+    # them. Returns the number of devices evaluated. Also used by probe_aggregator.py with results from probe agents
+    responsesPerSerial={}
+    # one value per uplink of the device, indexed like its uplinks
+    # example responsesPerSerial['ER34234']=[0.009306907653808594,0.012850046157836914]
+    for response in responses.keys():
+        theDevSerial, theDevUplink = deviceSerialofUplinkIP[response]
+        # initialize the response array if not already done
+        if theDevSerial not in responsesPerSerial:
+            responsesPerSerial[theDevSerial]=[None]*len(allMXDevices[theDevSerial].uplinks)
+        responsesPerSerial[theDevSerial][theDevUplink]=responses[response]
+
+    #now process the no_response array
+    for nresponse in no_responses:
+        theDevSerial, theDevUplink = deviceSerialofUplinkIP[nresponse]
+        #initialize the response array if there was none returned in response above
+        if theDevSerial not in responsesPerSerial:
+            responsesPerSerial[theDevSerial]=[None]*len(allMXDevices[theDevSerial].uplinks)
+        # the burst of an uplink without replies is already in responses
+        if responsesPerSerial[theDevSerial][theDevUplink] is None:
+            responsesPerSerial[theDevSerial][theDevUplink]=-1
+
+    if recorder is not None:
+        recorder.record_cycle(clock())
+        recorder.record_pings(responsesPerSerial)
+        recorder.flush()
+
+    return evaluate_devices(responsesPerSerial, dueSerials)
+
+
+def check_failback(device):
+    # failback timer task: the device may have been replaced by an inventory refresh since it was started
+    if allMXDevices.get(device.serial) is device:
+        device.failback_check()
+
+
+def reconcile_round(reconciler):
+    # starts reading back the uplink selection of the next batch of monitored networks
+    networks=[(networkId, monitored_orgs[org]) for networkId, org in orgOfNetwork.items() if org in monitored_orgs]
+    reconciler.start_round(networks)
+
+def reconcile_uplink_selection(reconciler):
+    # compares the uplink selections read back since the last call with the state of the devices and fixes the drift
+    results=reconciler.results()
+    if len(results)==0:
+        return
+    devicesOfNetwork={device.networkId: device for serial, device in allMXDevices.items() if serial[0 : 6]!='tester'}
+    for networkId, load_balancing, default_uplink, read_time in results:
+        if tracer is not None:
+            tracer.read_back(networkId, load_balancing, default_uplink, read_time)
+        known=knownUplinkSelection.get(networkId)
+        if known is not None and known[2]>read_time:
+            # written after it was read, the read is already outdated
+            continue
+        knownUplinkSelection[networkId]=[load_balancing, default_uplink, read_time]
+        device=devicesOfNetwork.get(networkId)
+        if device is None:
+            continue
+        local_uplink=device.uplinks[device.current_uplink-1]
+        if device.isLoadbalancing==load_balancing and local_uplink==default_uplink:
+            continue
+        if reconcile_policy=='enforce':
+            set_uplink_selection(networkId, load_balancing=device.isLoadbalancing, default_uplink=local_uplink)
+            state_change('drift_enforced', device.serial, networkId,
+                         'uplink selection changed in the Dashboard, writing back %s', local_uplink,
+                         uplink=local_uplink, load_balancing=device.isLoadbalancing,
+                         dashboard_uplink=default_uplink, dashboard_load_balancing=load_balancing)
+        elif default_uplink in device.uplinks:
+            device.isLoadbalancing=load_balancing
+            device.current_uplink=device.uplinks.index(default_uplink)+1
+            if device.current_uplink!=1:
+                # handled like a failover of the script, so WAN1 is only evaluated again after failback_wait_time
+                device.last_failover_time=clock()
+                device.schedule_failback()
+            state_change('drift_adopted', device.serial, networkId,
+                         'uplink selection changed in the Dashboard, now using %s', default_uplink,
+                         uplink=default_uplink, load_balancing=load_balancing, previous_uplink=local_uplink)
+
+def trace_decisions(reconciler):
+    # drops the decision traces gone stale and has the uplink selections just changed read back to confirm them
+    tracer.expire(time.monotonic())
+    if reconciler is not None:
+        networks=[(networkId, org_of_network(networkId)) for networkId in tracer.awaiting_confirmation()]
+        if networks:
+            reconciler.confirm(networks)
+
+
+def publish_control_snapshot():
+    # the control API only ever reads the snapshot this assigns, never the devices themselves
+    global control_snapshot
+    now=clock()
+    control_snapshot={'status': {'time': now, 'devices': len(allMXDevices), 'orgs': list(monitored_orgs.keys()),
+                                 'testers_down': [ip for ip, down in isTestConnDown.items() if down],
+                                 'pinned': dict(pinnedNetworks),
+                                 'load_shedding': shedder.stats() if shedder is not None else None,
+                                 'decision_latency': tracer.stats() if tracer is not None else None},
+                      'devices': {serial: device.status(now) for serial, device in allMXDevices.items()}}
+
+def run_control_command(command):
+    # runs a command queued by the control API, returns the (HTTP status, dict) to answer with
+    now=clock()
+    if command.name=='sla':
+        if sla is None:
+            return 404, {'error': 'SLA counters are not kept, set sla_dir'}
+        try:
+            start, end=period(command.arguments.get('start'), command.arguments.get('end'), now)
+        except ValueError:
+            return 400, {'error': 'start and end must be dates such as 2020-06-01'}
+        serials=command.arguments.get('serial')
+        return 200, sla.report(start, end, set(serials.split(',')) if serials else None)
+    if command.name=='evaluate':
+        if command.target is None:
+            devices=list(allMXDevices.values())
+        elif command.target in allMXDevices:
+            devices=[allMXDevices[command.target]]
+        else:
+            return 404, {'error': 'unknown device %s' % command.target}
+        for device in devices:
+            device.prune_reports(now)
+            device.evaluate(now)
+        return 200, {'evaluated': len(devices)}
+
+    networkId=command.target
+    device=next((device for serial, device in allMXDevices.items()
+                 if device.networkId==networkId and serial[0 : 6]!='tester'), None)
+    if device is None:
+        return 404, {'error': 'unknown network %s' % networkId}
+    if command.name=='pin':
+        uplink=command.arguments.get('uplink')
+        if uplink is not None and (uplink not in device.uplinks or uplink not in selectable_uplinks):
+            return 400, {'error': 'uplink must be one of %s' % ', '.join(name for name in device.uplinks
+                                                                           if name in selectable_uplinks)}
+        if uplink is not None:
+            set_uplink_selection(networkId, load_balancing=False, default_uplink=uplink)
+            device.isLoadbalancing=False
+            device.current_uplink=device.uplinks.index(uplink)+1
+        pinnedNetworks[networkId]=uplink
+        state_change('pinned', device.serial, networkId, 'pinned through the control API', uplink=uplink,
+                     current_uplink=device.current_uplink, load_balancing=device.isLoadbalancing)
+    elif networkId in pinnedNetworks:
+        del pinnedNetworks[networkId]
+        if device.away_from_normal():
+            # like after a failover, WAN1 is evaluated again after failback_wait_time
+            device.last_failover_time=now
+            device.schedule_failback()
+        state_change('unpinned', device.serial, networkId, 'unpinned through the control API',
+                     current_uplink=device.current_uplink, load_balancing=device.isLoadbalancing)
+    return 200, device.status(now)
+
+def run_control_commands(control):
+    commands=control.pending_commands()
+    for command in commands:
+        try:
+            result=run_control_command(command)
+        except Exception as error:
+            log.exception("control API command %s failed", command.name)
+            result=(500, {'error': str(error)})
+        if not command.future.done():
+            command.future.set_result(result)
+    if commands:
+        publish_control_snapshot()
+
+
+def log_task_stats(tasks, probes=None, handoff=None):
+    summary=tasks.stats_summary()
+    if probes is not None:
+        summary.update(probes.stats_summary())
+    log_event(log, logging.INFO, "task deadlines", tasks=summary)
+    if handoff is not None:
+        log_event(log, logging.INFO, "evaluation backlog", **handoff.stats())
+    if shedder is not None:
+        log_event(log, logging.INFO, "load shedding", **shedder.stats())
+    if tracer is not None:
+        log_event(log, logging.INFO, "decision latency", **tracer.stats())
+
+
+def checkpoint_sla():
+    sla.checkpoint(clock())
+
+def refresh_inventory():
+    # the Dashboard is read while the probe thread goes on pinging the current devices, only the swap holds it up
+    global inventory_version
+    inventory=read_inventory()
+    with inventory_lock:
+        install_inventory(*inventory)
+        inventory_version+=1
+
+def read_background_inventory(result):
+    # run on a thread of its own at startup when the devices were loaded from target_cache_file
+    try:
+        result.append(read_inventory())
+    except Exception:
+        log.exception("Error reading the inventory, going on with the cached devices until the next inventory refresh")
+        result.append(None)
+
+def install_background_inventory(result, install_task):
+    # task installing the inventory read by read_background_inventory() once it is there
+    global inventory_version
+    if not result:
+        return
+    install_task[0].cancel()
+    if result[0] is None:
+        return
+    with inventory_lock:
+        install_inventory(*result[0], keep_windows=True)
+        inventory_version+=1
+    log_event(log, logging.INFO, "Monitoring %d devices", len(allMXDevices), devices=list(allMXDevices.keys()))
+
+def load_config():
+    # reads config_file and the environment and swaps in all their settings at once if they are all valid, or none
+    # of them. Runs between the evaluations of the main thread, so every evaluation sees either the old or the new
+    # settings. Returns the names of the settings that changed
+    global config_defaults
+    if config_defaults is None:
+        config_defaults={name: globals()[name] for name in RELOADABLE_SETTINGS}
+    try:
+        settings=read_settings(config_file, RELOADABLE_SETTINGS, os.environ, config_env_prefix)
+    except (IOError, ValueError) as error:
+        log_event(log, logging.ERROR, "configuration not applied, keeping the current one: %s", error,
+                  config_file=config_file)
+        return set()
+    values=dict(config_defaults)
+    values.update(settings)
+    changed={name: value for name, value in values.items() if globals()[name]!=value}
+    globals().update(changed)
+    if correlator is not None:
+        correlator.threshold=shared_fate_threshold
+        correlator.min_degraded=shared_fate_min_degraded
+    if changed:
+        log_event(log, logging.WARNING, "configuration changed", config_file=config_file, **changed)
+    return set(changed)
+
+def reload_config(watcher):
+    # applies the changes to config_file and the whitelist files since the last call
+    global inventory_version
+    changed=watcher.changed()
+    if not changed:
+        return
+    changed_orgs=[monitored_org for monitored_org in monitored_orgs.values()
+                  if monitored_org.whitelist_file in changed or monitored_org.NLB_whitelist_file in changed]
+    if config_file in changed and 'useWhiteList' in load_config():
+        changed_orgs=list(monitored_orgs.values())
+    if not changed_orgs:
+        return
+    for monitored_org in changed_orgs:
+        load_whitelists(monitored_org)
+    with inventory_lock:
+        apply_whitelists(changed_orgs)
+        inventory_version+=1
+
+
+def main():
+    global recorder, history, sla, failback_timer, monitored_orgs, shedder, tracer
+    if record_file:
+        recorder = ProbeRecorder(record_file, 'icmp')
+    if history_dir:
+        history = HistoryStore(log, history_dir, history_segment_records, history_max_segments).start()
+    load_config()
+    probe_wait=longest_probe_wait()
+    if cycle_budget is not None:
+        shedder = LoadShedder(cycle_budget, probe_wait)
+    cached=load_target_cache() if target_cache_file else None
+    if cached is not None:
+        # the devices of the last inventory are pinged right away while the inventory is read in the background
+        monitored_orgs = load_orgs(orgs, api_key, org_id, dashboard, dashboard_base_url, dashboard_calls_per_second)
+        for monitored_org in monitored_orgs.values():
+            load_whitelists(monitored_org)
+        load_devices(cached)
+        background_inventory=[]
+        threading.Thread(target=read_background_inventory, args=(background_inventory,), name='inventory',
+                         daemon=True).start()
+    else:
+        refreshDevicesDict()
+    log_event(log, logging.INFO, "Monitoring %d devices", len(allMXDevices), devices=list(allMXDevices.keys()))
+    install_profile_signal(SamplingProfiler(log), profile_duration, profile_report_dir, 'MX_uplink_monitor_selector')
+    watchdog=None
+    if watchdog_stall_threshold is not None:
+        watchdog=LoopWatchdog(log, watchdog_stall_threshold).start()
+
+    # every task runs at its own deadline: the ping cycles at a fixed rate of one per ping_timeout*(ping_retry+1)
+    # (the longest multi_ping() can take, or the burst plus ping_timeout with burst_size>1) plus inter_ping_delay, the
+    # inventory refresh every inventory_refresh_interval seconds and the failback check of a device right when its
+    # failback_wait_time is over
+    probe_interval=probe_wait+inter_ping_delay
+    warned=[False]
+
+    def has_devices():
+        if len(allUplinkIPs)>0:
+            warned[0]=False
+            return True
+        if not warned[0]:
+            warned[0]=True
+            log.warning("No devices to ping...")
+        return False
+
+    if threaded_probing:
+        # the probe thread runs the ping cycles on a scheduler of its own, handing the results off to this thread,
+        # which evaluates them whenever it is not running one of its tasks
+        handoff=ProbeHandoff()
+        handoff.on_drop=reschedule_dropped
+
+        def probe_cycle():
+            if has_devices():
+                probe_into(handoff.back())
+                handoff.publish()
+
+        def evaluate_handoff(timeout):
+            result=handoff.take(timeout)
+            if result is not None:
+                try:
+                    evaluate_probe_result(result)
+                except Exception:
+                    # run as the scheduler's sleep, outside of its tasks
+                    log.exception("evaluation of ping cycle failed")
+                finally:
+                    handoff.release()
+
+        def run_probes():
+            while True:
+                try:
+                    probes.run()
+                except Exception:
+                    log.exception("ping cycle failed")
+
+        probes=TaskScheduler(miss_tolerance=task_miss_tolerance, log=log)
+        probes.every(probe_interval, probe_cycle, name='probe')
+        if watchdog is not None:
+            probes.every(watchdog_stall_threshold/10.0, watchdog.beat, 'probe', name='probe heartbeat')
+        tasks=TaskScheduler(miss_tolerance=task_miss_tolerance, sleep=evaluate_handoff, log=log)
+        tasks.every(inventory_refresh_interval, refresh_inventory, name='inventory', first_delay=inventory_refresh_interval)
+        tasks.every(task_stats_interval, log_task_stats, tasks, probes, handoff, name='stats',
+                    first_delay=task_stats_interval)
+        threading.Thread(target=run_probes, name='probe', daemon=True).start()
+    else:
+        def probe_cycle():
+            if has_devices():
+                ping_cycle()
+
+        tasks=TaskScheduler(miss_tolerance=task_miss_tolerance, log=log)
+        tasks.every(probe_interval, probe_cycle, name='probe')
+        tasks.every(inventory_refresh_interval, refreshDevicesDict, name='inventory', first_delay=inventory_refresh_interval)
+        tasks.every(task_stats_interval, log_task_stats, tasks, name='stats', first_delay=task_stats_interval)
+
+    def start_failback_timer(device, due):
+        # the failback checks need more than failback_wait_time to have passed
+        tasks.call_later(due-clock()+task_miss_tolerance, check_failback, device, name='failback')
+
+    failback_timer=start_failback_timer
+    if cached is not None:
+        install_task=[]
+        install_task.append(tasks.every(0.2, install_background_inventory, background_inventory, install_task,
+                                        name='inventory install'))
+    if watchdog is not None:
+        tasks.every(watchdog_stall_threshold/10.0, watchdog.beat, 'main', name='heartbeat')
+    if config_check_interval is not None:
+        watcher=FileWatcher([config_file]+[path for monitored_org in monitored_orgs.values()
+                                           for path in (monitored_org.whitelist_file, monitored_org.NLB_whitelist_file)])
+        tasks.every(config_check_interval, reload_config, watcher.start(), name='config')
+    if control_api_address is not None:
+        # imported here, asyncio takes longer to import than the rest of the script
+        from control_api import ControlAPI
+        control=ControlAPI(log, control_api_address, lambda: control_snapshot, control_api_token).start()
+        publish_control_snapshot()
+        tasks.every(control_snapshot_interval, publish_control_snapshot, name='control snapshot')
+        tasks.every(0.2, run_control_commands, control, name='control commands')
+    if reconcile_interval is not None:
+        if reconcile_policy not in RECONCILE_POLICIES:
+            raise ValueError("Unknown reconcile_policy %r, must be one of %s" % (reconcile_policy, RECONCILE_POLICIES))
+        # the reads run on the reconciler's threads, the results are applied on this one
+        reconciler=UplinkReconciler(log, dashboard_base_url, reconcile_concurrency, reconcile_batch_size)
+        tasks.every(reconcile_interval, reconcile_round, reconciler, name='reconcile', first_delay=reconcile_interval)
+        tasks.every(1.0, reconcile_uplink_selection, reconciler, name='reconcile apply')
     else:
-        print("No devices to ping...")
-        # sleep for a minute in case they want to keep it running to arrive at the top of the hour to check again
-        # for devices
-        time.sleep(60)
-
-    #check for new devices at the top of the hour
-    if ((time.time() % 3600) == 0):
-        refreshDevicesDict()
\ No newline at end of file
+        reconciler=None
+    if decision_tracing:
+        # the changes are confirmed by reading them back with the reconciler, if there is one
+        tracer=DecisionTracer(log, trouble_eval_window, confirm=reconciler is not None)
+        tasks.every(1.0, trace_decisions, reconciler, name='decision traces')
+    if sla_dir:
+        # evaluations further apart than a few probe intervals (or longest_probe_gap()) are not counted, the
+        # device was not being monitored in between
+        max_gap=3*max(probe_interval, longest_probe_gap())
+        sla=SLARollups(log, sla_dir, max_gap=max_gap, quiet_period=trouble_eval_window)
+        tasks.every(sla_checkpoint_interval, checkpoint_sla, name='sla checkpoint', first_delay=sla_checkpoint_interval)
+    tasks.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Simulated fleet benchmark for both selector scripts.
+#
+# A MockDashboard serving a synthetic org is started in this process and each selector script is then run in its
+# own child process against it (the ping variant with a FakeICMPSocket instead of a raw socket), so memory figures
+# are not polluted by the other script or by the mock itself. Reports inventory time, cycle time, device
+# evaluations (decisions) per second, peak memory and Dashboard API calls per operation.
+#
+# Examples:
+#     $ python benchmarks/bench_fleet.py
+#     $ python benchmarks/bench_fleet.py --sizes 100 1000 --cycles 20 --script icmp --api-latency 0.05 --rate-limit 10
+#     $ python benchmarks/bench_fleet.py --sizes 1000 --cycles 300 --script icmp --adaptive
+
+import argparse
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_dashboard import MockDashboard, synthetic_fleet
+
+SCRIPTS = {
+    'icmp': 'MX_uplink_monitor_selector',
+    'dashboard': 'MX_dashboard_uplink_monitor_selector',
+}
+RESULT_MARKER = 'BENCH_RESULT '
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * pct / 100.0), len(ordered) - 1)]
+
+
+def run_child(args):
+    # Runs inside the child process: import the selector without starting its main loop, re-point it at the
+    # mock Dashboard and the fake ICMP socket and time its cycles.
+    os.environ.setdefault('MERAKI_DASHBOARD_API_KEY', 'benchmark')
+    import meraki
+    import mping
+    from fake_icmp import FakeICMPSocket
+    from selector_logging import setup_logging
+
+    selector = __import__(SCRIPTS[args.script])
+    selector.log = setup_logging(selector.log.name, level='WARNING', log_file=os.devnull)
+    selector.dashboard_base_url = args.url
+    selector.dashboard = meraki.DashboardAPI('benchmark', base_url=args.url, output_log=False, suppress_logging=True,
+                                             nginx_429_retry_wait_time=1, maximum_retries=10)
+    selector.org_id = 'benchmark'
+    # the mock Dashboard is not limited unless --rate-limit is given, so do not pace the calls either
+    selector.dashboard_calls_per_second = None
+    selector.useWhiteList = False
+    selector.trouble_eval_window = args.eval_window
+
+    # with adaptive probing which devices get pinged depends on the time between cycles, so time is simulated: every
+    # cycle advances the selector's clock by ping_timeout+inter_ping_delay (plus the burst with --burst), the length of
+    # a real cycle with losses
+    virtual_now = [time.time()]
+    if args.adaptive:
+        selector.adaptive_probing = True
+        selector.clock = lambda: virtual_now[0]
+
+    fake_sock = None
+    if args.script == 'icmp':
+        per_target = {}
+        for device in synthetic_fleet(args.devices, args.bad_fraction):
+            if device['bad']:
+                per_target[device['wan1Ip']] = (args.bad_rtt, args.bad_loss)
+        fake_sock = FakeICMPSocket(default_rtt=args.rtt, default_loss=args.loss, per_target=per_target, seed=1)
+        if args.unreachable:
+            # a router on the way answers for the bad WAN1s with host unreachable, after the healthy round trip time
+            for addr in per_target:
+                fake_sock.set_target(addr, args.rtt, 0.0)
+                fake_sock.set_error(addr)
+        selector.multi_ping = functools.partial(mping.multi_ping, sock=fake_sock)
+        selector.burst_ping = functools.partial(mping.burst_ping, sock=fake_sock)
+        selector.burst_size = args.burst
+        if args.history:
+            from probe_history import HistoryStore
+            selector.history = HistoryStore(selector.log, args.history)
+        if args.cycle_budget is not None:
+            from load_shedding import LoadShedder
+            selector.shedder = LoadShedder(args.cycle_budget, (args.burst - 1) * selector.burst_interval +
+                                           selector.ping_timeout if args.burst > 1 else
+                                           selector.ping_timeout * (selector.ping_retry + 1))
+        cycle = selector.ping_cycle
+    else:
+        cycle = selector.dashboard_cycle
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    selector.refreshDevicesDict()
+    inventory_s = time.perf_counter() - start
+
+    durations = []
+    evaluations = 0
+    for _ in range(args.cycles):
+        start = time.perf_counter()
+        evaluations += cycle()
+        durations.append(time.perf_counter() - start)
+        if args.adaptive:
+            virtual_now[0] += (args.burst - 1) * selector.burst_interval + selector.ping_timeout + \
+                selector.inter_ping_delay
+
+    result = {
+        'script': args.script + ('-adaptive' if args.adaptive else '') +
+                  ('-burst%d' % args.burst if args.script == 'icmp' and args.burst > 1 else '') +
+                  ('-history' if args.script == 'icmp' and args.history else '') +
+                  ('-budget%g' % args.cycle_budget if args.script == 'icmp' and args.cycle_budget is not None else ''),
+        'devices': len(selector.allMXDevices),
+        'inventory_s': inventory_s,
+        'cycles': len(durations),
+        'cycle_mean_s': sum(durations) / len(durations) if durations else 0.0,
+        'cycle_p95_s': _percentile(durations, 95),
+        'cycle_max_s': max(durations) if durations else 0.0,
+        'decisions_per_s': evaluations / sum(durations) if durations and sum(durations) else 0.0,
+        'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'inventory_rss_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024.0,
+    }
+    if fake_sock is not None:
+        result['icmp_sent'] = fake_sock.sent
+    if getattr(selector, 'shedder', None) is not None:
+        result['deferred'] = selector.shedder.deferred
+    print(RESULT_MARKER + json.dumps(result))
+    sys.stdout.flush()
+    # skip interpreter teardown of thousands of device objects, it is not part of what we measure
+    os._exit(0)
+
+
+def run_parent(args):
+    results = []
+    for size in args.sizes:
+        mock = MockDashboard(size, bad_fraction=args.bad_fraction, latency=args.api_latency,
+                             rate_limit=args.rate_limit, error_429_rate=args.error_429_rate,
+                             retry_after=args.retry_after, seed=1).start()
+        try:
+            for script in args.script:
+                mock.reset_counts()
+                command = [sys.executable, os.path.abspath(__file__), '--child', '--url', mock.url,
+                           '--script', script, '--devices', str(size), '--cycles', str(args.cycles),
+                           '--eval-window', str(args.eval_window), '--bad-fraction', str(args.bad_fraction),
+                           '--rtt', str(args.rtt), '--loss', str(args.loss), '--bad-rtt', str(args.bad_rtt),
+                           '--bad-loss', str(args.bad_loss)] + (['--adaptive'] if args.adaptive else []) + \
+                          (['--unreachable'] if args.unreachable else []) + ['--burst', str(args.burst)] + \
+                          (['--history', args.history] if args.history else []) + \
+                          (['--cycle-budget', str(args.cycle_budget)] if args.cycle_budget is not None else [])
+                output = subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.PIPE, check=True,
+                                        universal_newlines=True).stdout
+                line = [l for l in output.splitlines() if l.startswith(RESULT_MARKER)][-1]
+                result = json.loads(line[len(RESULT_MARKER):])
+                result['org_size'] = size
+                result['api_calls'] = dict(mock.call_counts)
+                results.append(result)
+                _print_result(result)
+        finally:
+            mock.stop()
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+    return results
+
+
+def _print_result(result):
+    calls = result['api_calls']
+    print('%-9s org=%-6d devices=%-6d inventory=%7.2fs cycle mean=%.4fs p95=%.4fs max=%.4fs '
+          'decisions/s=%9.0f maxrss=%6.1fMB api_calls=%d (429s=%d, PUTs=%d)' % (
+              result['script'], result['org_size'], result['devices'], result['inventory_s'],
+              result['cycle_mean_s'], result['cycle_p95_s'], result['cycle_max_s'], result['decisions_per_s'],
+              result['maxrss_mb'], sum(v for k, v in calls.items() if k != '429'), calls.get('429', 0),
+              calls.get('updateNetworkApplianceTrafficShapingUplinkSelection', 0)) +
+          (' icmp_sent=%d' % result['icmp_sent'] if 'icmp_sent' in result else '') +
+          (' deferred=%d' % result['deferred'] if 'deferred' in result else ''))
+    sys.stdout.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the uplink selectors against a simulated fleet')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='synthetic org sizes (number of MX devices) to run')
+    parser.add_argument('--script', nargs='+', choices=sorted(SCRIPTS), default=sorted(SCRIPTS),
+                        help='which selector variants to benchmark')
+    parser.add_argument('--cycles', type=int, default=10, help='monitoring cycles to time per run')
+    parser.add_argument('--eval-window', type=float, default=2,
+                        help='trouble_eval_window used by the selectors (short so decisions happen in the run)')
+    parser.add_argument('--bad-fraction', type=float, default=0.01, help='fraction of devices with a bad WAN1')
+    parser.add_argument('--rtt', type=float, default=0.010, help='fake ICMP RTT of healthy uplinks (s)')
+    parser.add_argument('--loss', type=float, default=0.0, help='fake ICMP loss of healthy uplinks (0-1)')
+    parser.add_argument('--bad-rtt', type=float, default=0.450, help='fake ICMP RTT of bad uplinks (s)')
+    parser.add_argument('--bad-loss', type=float, default=0.5, help='fake ICMP loss of bad uplinks (0-1)')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='mock Dashboard latency per call (s)')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='mock Dashboard calls per second before answering 429')
+    parser.add_argument('--error-429-rate', type=float, default=0.0,
+                        help='fraction of mock Dashboard calls answered with 429 at random')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After header sent with 429s')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='turn on adaptive_probing in the ping variant (cycles then run on simulated time)')
+    parser.add_argument('--unreachable', action='store_true',
+                        help='bad WAN1s are answered with ICMP host unreachable instead of slow or lost replies')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='pings per uplink and cycle of the ping variant (its burst_size)')
+    parser.add_argument('--history', help='keep the probe history of the ping variant in this directory')
+    parser.add_argument('--cycle-budget', type=float, default=None,
+                        help='cycle_budget (s) of the ping variant, to see how many devices load shedding defers')
+    parser.add_argument('--json', help='also write the results to this file as JSON')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--devices', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        args.script = args.script[0] if isinstance(args.script, list) else args.script
+    return args
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.child:
+        run_child(arguments)
+    else:
+        run_parent(arguments)
@@ -0,0 +1,185 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Memory and garbage collection benchmark of the device model of MX_uplink_monitor_selector.py.
+#
+# For every size a child process loads that many uplinks (two per device) with load_devices(), without any Dashboard,
+# and evaluates them with synthetic ping results on a virtual clock advancing one second per cycle: first for
+# trouble_eval_window cycles to fill the evaluation windows, then for the measured cycles. Reports the resident memory
+# per uplink with full windows, the cycle times and the number, total and longest of the garbage collector pauses
+# during the measured cycles.
+#
+# Examples:
+#     $ python benchmarks/bench_memory.py
+#     $ python benchmarks/bench_memory.py --sizes 10000 50000 --cycles 60 --no-gc-tuning
+
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+RESULT_MARKER = 'BENCH_RESULT '
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * pct / 100.0), len(ordered) - 1)]
+
+
+def _rss_mb():
+    # current resident memory (the peak where /proc is not available)
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_child(args):
+    os.environ.setdefault('MERAKI_DASHBOARD_API_KEY', 'benchmark')
+    from selector_logging import setup_logging
+    import MX_uplink_monitor_selector as selector
+
+    selector.log = setup_logging(selector.log.name, level='WARNING', log_file=os.devnull)
+    selector.trouble_eval_window = args.eval_window
+    if args.no_gc_tuning:
+        selector.gc_thresholds = None
+        selector.gc_freeze_devices = False
+    virtual_now = [1000000.0]
+    selector.clock = lambda: virtual_now[0]
+
+    rss_before = _rss_mb()
+    devices = {}
+    ips = []
+    for i in range(args.uplinks // 2):
+        serial = 'Q2BN-%04X-%04X' % (i >> 16, i & 0xffff)
+        wan1 = '10.%d.%d.%d' % (i >> 15 & 0xff, i >> 7 & 0xff, (i & 0x7f) * 2)
+        wan2 = '10.%d.%d.%d' % (i >> 15 & 0xff, i >> 7 & 0xff, (i & 0x7f) * 2 + 1)
+        devices[serial] = selector.WAN_device(networkId='N_%d' % i, serial=serial, my_org_number='benchmark',
+                                              uplink1_ip=wan1, uplink2_ip=wan2, current_uplink=1,
+                                              is_load_balancing=True, is_NLB=False)
+        ips.extend((wan1, wan2))
+    selector.load_devices(devices)
+    del devices
+
+    rng = random.Random(1)
+
+    def cycle():
+        responses = {}
+        no_responses = []
+        for ip in ips:
+            if rng.random() < args.loss:
+                no_responses.append(ip)
+            else:
+                responses[ip] = args.rtt * (0.5 + rng.random())
+        start = time.perf_counter()
+        selector.evaluate_cycle(responses, no_responses)
+        duration = time.perf_counter() - start
+        virtual_now[0] += 1.0
+        return duration
+
+    for _ in range(args.eval_window):
+        cycle()
+    rss_full = _rss_mb()
+
+    pauses = []
+    started = [0.0]
+
+    def on_gc(phase, info):
+        if phase == 'start':
+            started[0] = time.perf_counter()
+        else:
+            pauses.append((info['generation'], time.perf_counter() - started[0]))
+
+    gc.callbacks.append(on_gc)
+    durations = [cycle() for _ in range(args.cycles)]
+    gc.callbacks.remove(on_gc)
+
+    result = {
+        'gc_tuning': not args.no_gc_tuning,
+        'uplinks': len(selector.allUplinkIPs),
+        'rss_mb': rss_full,
+        'bytes_per_uplink': (rss_full - rss_before) * 1048576.0 / max(len(selector.allUplinkIPs), 1),
+        'cycles': len(durations),
+        'cycle_p50_s': _percentile(durations, 50),
+        'cycle_p99_s': _percentile(durations, 99),
+        'cycle_max_s': max(durations) if durations else 0.0,
+        'gc_pauses': len(pauses),
+        'gc_full_pauses': sum(1 for generation, _ in pauses if generation == 2),
+        'gc_pause_total_s': sum(pause for _, pause in pauses),
+        'gc_pause_max_s': max(pause for _, pause in pauses) if pauses else 0.0,
+    }
+    print(RESULT_MARKER + json.dumps(result))
+
+
+def run_size(args, uplinks):
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--uplinks', str(uplinks),
+               '--cycles', str(args.cycles), '--eval-window', str(args.eval_window), '--rtt', str(args.rtt),
+               '--loss', str(args.loss)]
+    if args.no_gc_tuning:
+        command.append('--no-gc-tuning')
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    for line in output.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    raise RuntimeError('no result from the child process:\n' + output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the memory and GC pauses of the device model')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000], help='numbers of uplinks to load')
+    parser.add_argument('--cycles', type=int, default=30, help='measured cycles per size')
+    parser.add_argument('--eval-window', type=int, default=20,
+                        help='trouble_eval_window (s), also the number of warm up cycles filling the windows')
+    parser.add_argument('--rtt', type=float, default=0.02, help='mean fake RTT (s)')
+    parser.add_argument('--loss', type=float, default=0.01, help='fraction of fake pings lost')
+    parser.add_argument('--no-gc-tuning', action='store_true',
+                        help='keep the default garbage collector thresholds and do not freeze the devices')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--uplinks', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    results = []
+    for uplinks in args.sizes:
+        result = run_size(args, uplinks)
+        results.append(result)
+        print('uplinks=%-7d rss=%7.1fMB bytes/uplink=%6.0f cycle p50=%.4fs p99=%.4fs max=%.4fs '
+              'gc pauses=%d (full=%d) total=%.4fs max=%.4fs'
+              % (result['uplinks'], result['rss_mb'], result['bytes_per_uplink'], result['cycle_p50_s'],
+                 result['cycle_p99_s'], result['cycle_max_s'], result['gc_pauses'], result['gc_full_pauses'],
+                 result['gc_pause_total_s'], result['gc_pause_max_s']))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Startup benchmark of MX_uplink_monitor_selector.py.
+#
+# A MockDashboard serving a synthetic org (with --api-latency added to every call) is started in this process and the
+# script's main() is run in a child process against it until its first ping cycle, which ends the child before any
+# ping is sent. It is run twice per size: cold, with no target_cache_file so the first cycle waits for the inventory,
+# and then warm, with the target_cache_file written by the cold run. Reports the time to import the script (and
+# whether the Dashboard SDK got imported with it) and the time from the start of the child to the first ping cycle,
+# with the number of uplinks pinged in it.
+#
+# Examples:
+#     $ python benchmarks/bench_startup.py
+#     $ python benchmarks/bench_startup.py --sizes 100 1000 --api-latency 0.05
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CHILD_START = time.perf_counter()
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+RESULT_MARKER = 'BENCH_RESULT '
+
+
+def run_child(args):
+    # Runs inside the child process: times the import of the selector, then runs its main() until the first ping
+    # cycle, which prints the result and ends the process.
+    os.environ.setdefault('MERAKI_DASHBOARD_API_KEY', 'benchmark')
+    start = time.perf_counter()
+    import MX_uplink_monitor_selector as selector
+    import_s = time.perf_counter() - start
+    sdk_imported = 'meraki' in sys.modules
+
+    from dashboard_orgs import LazyDashboardAPI
+    from selector_logging import setup_logging
+
+    selector.log = setup_logging(selector.log.name, level='WARNING', log_file=os.devnull)
+    selector.dashboard_base_url = args.url
+    selector.dashboard = LazyDashboardAPI('benchmark', base_url=args.url, output_log=False, suppress_logging=True)
+    selector.org_id = 'benchmark'
+    selector.dashboard_calls_per_second = None
+    selector.useWhiteList = False
+    selector.target_cache_file = args.cache
+
+    def first_ping(uplinkIPs, **kwargs):
+        result = {
+            'run': args.run,
+            'import_s': import_s,
+            'sdk_imported_with_script': sdk_imported,
+            'first_probe_s': time.perf_counter() - CHILD_START,
+            'uplinks_pinged': len(uplinkIPs),
+        }
+        print(RESULT_MARKER + json.dumps(result))
+        sys.stdout.flush()
+        os._exit(0)
+
+    selector.multi_ping = first_ping
+    selector.main()
+
+
+def run_parent(args):
+    from mock_dashboard import MockDashboard
+
+    results = []
+    for size in args.sizes:
+        mock = MockDashboard(size, latency=args.api_latency, seed=1).start()
+        directory = tempfile.mkdtemp(prefix='bench_startup_')
+        cache = os.path.join(directory, 'targets.json')
+        try:
+            for run in ('cold', 'warm'):
+                # the cold run writes the cache the warm run starts from. The whitelist files are looked for in the
+                # working directory
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', '--run', run,
+                                         '--url', mock.url, '--cache', cache],
+                                        cwd=directory, stdout=subprocess.PIPE, check=True,
+                                        universal_newlines=True).stdout
+                line = [l for l in output.splitlines() if l.startswith(RESULT_MARKER)][-1]
+                result = json.loads(line[len(RESULT_MARKER):])
+                result['org_size'] = size
+                results.append(result)
+                print('org=%-6d %-4s import=%.3fs (sdk imported: %s) first probe=%7.3fs uplinks pinged=%d' % (
+                    size, run, result['import_s'],
+                    'yes' if result['sdk_imported_with_script'] else 'no', result['first_probe_s'],
+                    result['uplinks_pinged']))
+                sys.stdout.flush()
+        finally:
+            mock.stop()
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the time to the first ping cycle of the ICMP selector')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                        help='synthetic org sizes (number of MX devices) to run')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='latency added to every Dashboard call (s)')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--cache', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+    else:
+        run_parent(args)
+
+
+if __name__ == '__main__':
+    main()
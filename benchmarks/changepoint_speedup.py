@@ -0,0 +1,117 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Compares the time to fail over of the windowed average rule against the CUSUM and Page-Hinkley change point
+# detectors of MX_uplink_monitor_selector.py on a synthetic ping trace.
+#
+# The synthetic trace has a number of healthy devices with jittery latency and rare isolated losses, plus a
+# fraction of devices whose WAN1 suffers a sustained loss or latency incident starting at a known time. Reports
+# for each rule how many incidents were caught, the time from incident start to failover and the number of false
+# failovers (on healthy devices, or before the incident started).
+#
+# Example:
+#     $ python benchmarks/changepoint_speedup.py --devices 200 --duration 1800
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replay import load_selector, replay, percentile
+
+
+def synthetic_trace(devices, duration, incident_fraction, seed=1, cycle=1.0, warmup=300):
+    """
+    Returns (records, incidents) where records are in the read_log() format and incidents maps the serial of
+    every device with a WAN1 incident to the time it started.
+    """
+    rnd = random.Random(seed)
+    start = 1000000.0
+    records = []
+    incidents = {}
+    kinds = {}
+    for i in range(devices):
+        serial = 'SYN-%05d' % i
+        records.append(('V', serial, 'N_%05d' % i, '10.0.%d.1' % i, '10.1.%d.1' % i, 1, True, False))
+        if i < devices * incident_fraction:
+            incidents[serial] = start + warmup + rnd.random() * (duration - warmup * 2)
+            kinds[serial] = 'loss' if i % 2 == 0 else 'latency'
+
+    def sample(serial, uplink, t):
+        if uplink == 1 and serial in incidents and t >= incidents[serial]:
+            if kinds[serial] == 'loss':
+                return -1 if rnd.random() < 0.5 else max(rnd.gauss(0.030, 0.010), 0.001)
+            return max(rnd.gauss(0.450, 0.050), 0.001)
+        if rnd.random() < 0.01:
+            return -1
+        return max(rnd.gauss(0.030, 0.010), 0.001)
+
+    t = start
+    while t < start + duration:
+        records.append(('C', t))
+        for i in range(devices):
+            serial = 'SYN-%05d' % i
+            records.append(('P', serial, 1, sample(serial, 1, t)))
+            records.append(('P', serial, 2, sample(serial, 2, t)))
+        t += cycle
+    return records, incidents
+
+
+def evaluate(result, incidents):
+    detect_times = []
+    false_failovers = 0
+    detected = set()
+    for t, serial, default_uplink, load_balancing in result['actions']:
+        if load_balancing:
+            continue
+        incident_start = incidents.get(serial)
+        if incident_start is None or t < incident_start:
+            false_failovers += 1
+        elif serial not in detected:
+            detected.add(serial)
+            detect_times.append(t - incident_start)
+    return detect_times, false_failovers, len(detected)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Windowed average vs change point detection time to failover')
+    parser.add_argument('--devices', type=int, default=200, help='synthetic devices')
+    parser.add_argument('--duration', type=float, default=1800, help='synthetic trace length (seconds)')
+    parser.add_argument('--incident-fraction', type=float, default=0.2, help='fraction of devices with an incident')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    records, incidents = synthetic_trace(args.devices, args.duration, args.incident_fraction, args.seed)
+    selector = load_selector('icmp')
+
+    baseline = None
+    for detector in (None, 'cusum', 'page_hinkley'):
+        result = replay(selector, 'icmp', records, {'changepoint_detector': detector}, keep_actions=True)
+        detect_times, false_failovers, detected = evaluate(result, incidents)
+        median = percentile(detect_times, 50)
+        if detector is None:
+            baseline = median
+        print('%-13s detected %3d/%d incidents, time to failover median=%5.1fs p95=%5.1fs, false failovers=%d%s' % (
+            detector or 'window-avg', detected, len(incidents), median or 0, percentile(detect_times, 95) or 0,
+            false_failovers,
+            '' if detector is None or not median or not baseline else ', %.1fx faster' % (baseline / median)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Loopback demo of probe_aggregator.py with several probe_agent.py agents running as local processes.
+#
+# A MockDashboard serves a synthetic org whose first bad_fraction devices have a really bad WAN1, which every agent
+# sees. Agent 0 additionally sees heavy loss towards the WAN1 of the next --path-bad devices, as if the path between
+# its location and those MXs was broken. The aggregator is run once with agent 0 only (a single vantage point, like
+# MX_uplink_monitor_selector.py) and once with all agents, and the failovers of each run are reported: the single
+# vantage point fails over the devices behind the broken path as well, the aggregated results do not.
+#
+# Example:
+#     $ python benchmarks/distributed_demo.py --devices 50 --agents 3 --duration 20
+
+import argparse
+import functools
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_dashboard import MockDashboard, synthetic_fleet
+
+TOKEN = 'demo'
+
+
+def run_agent(args):
+    # Runs inside an agent process: a probe_agent pinging through a FakeICMPSocket with this agent's view of the fleet
+    import mping
+    import probe_agent
+    from fake_icmp import FakeICMPSocket
+    from selector_logging import setup_logging
+
+    setup_logging('probe_agent', level='WARNING', log_file=os.devnull)
+    per_target = {}
+    fleet = synthetic_fleet(args.devices, args.bad_fraction)
+    bad = sum(1 for device in fleet if device['bad'])
+    for i, device in enumerate(fleet):
+        if device['bad']:
+            per_target[device['wan1Ip']] = (0.450, 0.5)
+        elif args.agent == 0 and i < bad + args.path_bad:
+            per_target[device['wan1Ip']] = (0.020, 0.8)
+    sock = FakeICMPSocket(default_rtt=0.010, default_loss=0.0, per_target=per_target, seed=args.agent + 1)
+    probe_agent.multi_ping = functools.partial(mping.multi_ping, sock=sock)
+    probe_agent.run('127.0.0.1', args.port, 'agent-%d' % args.agent, TOKEN, reconnect_delay=1)
+
+
+def run_aggregation(args, mock, agents):
+    os.environ.setdefault('MERAKI_DASHBOARD_API_KEY', 'demo')
+    import meraki
+    import probe_aggregator
+    from selector_logging import setup_logging
+
+    selector = probe_aggregator.selector
+    selector.log = setup_logging(selector.log.name, level='WARNING', log_file=os.devnull)
+    selector.dashboard_base_url = mock.url
+    selector.dashboard = meraki.DashboardAPI('demo', base_url=mock.url, output_log=False, suppress_logging=True)
+    selector.org_id = 'demo'
+    selector.useWhiteList = False
+    selector.dashboard_calls_per_second = None
+    selector.adaptive_probing = False
+    selector.trouble_eval_window = args.eval_window
+    selector.period_loss_report_tolerance = args.loss_tolerance
+
+    failovers = set()
+    write = selector.set_uplink_selection
+
+    def note_uplink_selection(networkId, load_balancing, default_uplink):
+        if not load_balancing:
+            failovers.add(networkId)
+        write(networkId, load_balancing, default_uplink)
+    selector.set_uplink_selection = note_uplink_selection
+
+    aggregator = probe_aggregator.Aggregator(('127.0.0.1', 0), TOKEN, args.aggregation, args.quorum).start()
+    probe_aggregator.refresh_targets(aggregator)
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--agent', str(index),
+                                   '--port', str(aggregator.address[1]), '--devices', str(args.devices),
+                                   '--bad-fraction', str(args.bad_fraction), '--path-bad', str(args.path_bad)],
+                                  cwd=REPO_DIR)
+                 for index in range(agents)]
+    try:
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            time.sleep(1.0)
+            aggregator.cycle()
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+        aggregator.stop()
+        selector.set_uplink_selection = write
+    return failovers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Probe agents and aggregator over loopback')
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--agents', type=int, default=3)
+    parser.add_argument('--bad-fraction', type=float, default=0.1, help='fraction of devices with a really bad WAN1')
+    parser.add_argument('--path-bad', type=int, default=5,
+                        help='devices whose WAN1 only agent 0 sees as bad (broken path from its location)')
+    parser.add_argument('--aggregation', default='median', choices=('median', 'quorum'))
+    parser.add_argument('--quorum', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=20, help='seconds to run each aggregation')
+    parser.add_argument('--eval-window', type=float, default=5)
+    parser.add_argument('--loss-tolerance', type=int, default=2)
+    parser.add_argument('--agent', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.agent is not None:
+        run_agent(args)
+        return
+
+    fleet = synthetic_fleet(args.devices, args.bad_fraction)
+    bad = set(device['networkId'] for device in fleet if device['bad'])
+    for label, agents in (('single vantage point', 1), ('%d agents, %s' % (args.agents, args.aggregation),
+                                                        args.agents)):
+        # a fresh mock per run, the uplink changes of the previous run would otherwise still be in effect
+        mock = MockDashboard(args.devices, bad_fraction=args.bad_fraction, seed=1).start()
+        try:
+            failovers = run_aggregation(args, mock, agents)
+        finally:
+            mock.stop()
+        print('%-22s failovers=%d: %d of %d really bad devices, %d false' % (
+            label, len(failovers), len(failovers & bad), len(bad), len(failovers - bad)))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# A stand-in for the raw ICMP socket used by mping.MultiPing, so the ping variant of the selector can be
+# benchmarked without root privileges or real MX devices. Pass an instance as MultiPing(sock=...) or
+# multi_ping(..., sock=...). Every echo request "sent" is turned into an echo reply that becomes readable after
+# the configured round trip time, unless it is randomly dropped according to the configured loss, or into an ICMP
+# error message about the request for targets set up with set_error().
+
+import errno
+import heapq
+import random
+import socket
+import struct
+import time
+
+_ICMP_HDR_PACK_FORMAT = "!BBHHH"
+_ICMP_ECHO_REPLY = 0
+# minimal IPv4 header in front of the ICMP reply, MultiPing only looks past it
+_FAKE_IP_HEADER = bytes([0x45]) + bytes(19)
+_ICMP_PROTO = 1
+
+
+class FakeICMPSocket(object):
+
+    def __init__(self, default_rtt=0.010, default_loss=0.0, per_target=None, seed=None):
+        """
+        default_rtt and default_loss (0.0 to 1.0) apply to every target not found in per_target, which maps
+        an IP address to a (rtt, loss) tuple. rtt may also be a callable returning a value in seconds, to model
+        jitter or changing conditions.
+
+        """
+        self.default_rtt = default_rtt
+        self.default_loss = default_loss
+        self.per_target = per_target if per_target is not None else {}
+        # (ICMP type, code) of the error message sent back instead of a reply, by target
+        self.error_targets = {}
+        self._random = random.Random(seed)
+        self._pending = []
+        self._seq = 0
+        self._timeout = None
+        self.sent = 0
+        self.received = 0
+
+    def set_target(self, addr, rtt, loss):
+        self.per_target[addr] = (rtt, loss)
+
+    def set_error(self, addr, icmp_type=3, code=1):
+        # answers the echo requests to addr with an ICMP error (host unreachable by default) after the round trip
+        # time, as a router on the way would. None as icmp_type goes back to normal replies
+        if icmp_type is None:
+            self.error_targets.pop(addr, None)
+        else:
+            self.error_targets[addr] = (icmp_type, code)
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def close(self):
+        pass
+
+    def sendto(self, pkt, dest):
+        self.sent += 1
+        rtt, loss = self.per_target.get(dest[0], (self.default_rtt, self.default_loss))
+        if loss and self._random.random() < loss:
+            return len(pkt)
+        if callable(rtt):
+            rtt = rtt()
+        _type, code, _checksum, pkt_id, ident = struct.unpack(_ICMP_HDR_PACK_FORMAT, bytes(pkt[:8]))
+        # checksum is not verified by the receive path so it is left as zero
+        error = self.error_targets.get(dest[0])
+        if error is not None:
+            # the error quotes the IP header of the request (protocol and destination are all MultiPing checks) and
+            # the first 8 bytes of the request itself
+            quoted_ip = bytes([0x45]) + bytes(8) + bytes([_ICMP_PROTO]) + bytes(6) + socket.inet_aton(dest[0])
+            reply = _FAKE_IP_HEADER + struct.pack(_ICMP_HDR_PACK_FORMAT, error[0], error[1], 0, 0, 0) + \
+                quoted_ip + bytes(pkt[:8])
+        else:
+            reply = _FAKE_IP_HEADER + struct.pack(_ICMP_HDR_PACK_FORMAT, _ICMP_ECHO_REPLY, code, 0, pkt_id, ident) + \
+                bytes(pkt[8:])
+        self._seq += 1
+        heapq.heappush(self._pending, (time.time() + rtt, self._seq, reply))
+        return len(pkt)
+
+    def recv(self, bufsize):
+        now = time.time()
+        if self._pending and self._pending[0][0] <= now:
+            return self._pop(bufsize)
+        if self._timeout == 0:
+            raise BlockingIOError(errno.EWOULDBLOCK, "Resource temporarily unavailable")
+        deadline = now + self._timeout if self._timeout is not None else None
+        if self._pending and (deadline is None or self._pending[0][0] <= deadline):
+            time.sleep(max(self._pending[0][0] - now, 0))
+            return self._pop(bufsize)
+        if deadline is None:
+            raise MultiPingDeadlock("recv() would block forever, nothing pending on the fake socket")
+        time.sleep(self._timeout)
+        raise socket.timeout("timed out")
+
+    def _pop(self, bufsize):
+        self.received += 1
+        return heapq.heappop(self._pending)[2][:bufsize]
+
+
+class MultiPingDeadlock(Exception):
+    """
+    Raised when a blocking recv() without timeout is issued and no reply will ever arrive.
+
+    """
+    pass
@@ -0,0 +1,189 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# A local mock of the handful of Meraki Dashboard API endpoints both selector scripts use, serving a synthetic
+# organization of any size. Point a selector at it by setting its dashboard_base_url to MockDashboard.url.
+# Response latency and 429 (rate limit) behavior are configurable and every call is counted per operation.
+
+import collections
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def synthetic_fleet(num_devices, bad_fraction=0.01):
+    """
+    Returns a deterministic list of device dicts for a synthetic org. The first bad_fraction of the devices have
+    a degraded WAN1 (high latency and loss), all others are healthy on both uplinks.
+    """
+    num_bad = int(num_devices * bad_fraction)
+    fleet = []
+    for i in range(num_devices):
+        fleet.append({
+            'serial': 'Q2BN-%04X-%04X' % (i >> 16, i & 0xffff),
+            'networkId': 'N_%d' % i,
+            'wan1Ip': '10.%d.%d.1' % ((i >> 8) & 0xff, i & 0xff) if i < 65536 else None,
+            'wan2Ip': '10.%d.%d.2' % ((i >> 8) & 0xff, i & 0xff) if i < 65536 else None,
+            'bad': i < num_bad,
+        })
+    return fleet
+
+
+class MockDashboard(object):
+
+    def __init__(self, num_devices, bad_fraction=0.01, latency=0.0, rate_limit=None, error_429_rate=0.0,
+                 retry_after=1, seed=None):
+        """
+        latency is added to every response (seconds). rate_limit is the number of calls per second allowed before
+        answering 429, like the Dashboard does per organization (None disables it). error_429_rate additionally
+        answers that fraction of calls with 429 at random. retry_after is the value of the Retry-After header sent
+        along with every 429.
+        """
+        self.fleet = synthetic_fleet(num_devices, bad_fraction)
+        self.by_serial = {d['serial']: d for d in self.fleet}
+        self.by_network = {d['networkId']: d for d in self.fleet}
+        self.uplink_selection = {d['networkId']: {'defaultUplink': 'wan1', 'loadBalancingEnabled': True}
+                                 for d in self.fleet}
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_429_rate = error_429_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit or 0
+        self._last_refill = time.monotonic()
+        self.call_counts = collections.Counter()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%d/api/v1' % (host, port)
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock._handle(self, 'GET')
+
+            def do_PUT(self):
+                mock._handle(self, 'PUT')
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def reset_counts(self):
+        with self._lock:
+            self.call_counts.clear()
+
+    def _allow(self):
+        with self._lock:
+            if self.error_429_rate and self._random.random() < self.error_429_rate:
+                return False
+            if self.rate_limit is None:
+                return True
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._last_refill) * self.rate_limit)
+            self._last_refill = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _handle(self, request, method):
+        path = request.path.split('?')[0]
+        operation, status, body = self._route(method, path, request)
+        with self._lock:
+            self.call_counts[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if status == 200 and not self._allow():
+            with self._lock:
+                self.call_counts['429'] += 1
+            status, body = 429, {'errors': ['API rate limit exceeded for organization']}
+        payload = json.dumps(body).encode('utf8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        if status == 429:
+            request.send_header('Retry-After', str(self.retry_after))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def _route(self, method, path, request):
+        m = re.match(r'^/api/v1/organizations/[^/]+/devices/uplinksLossAndLatency$', path)
+        if m and method == 'GET':
+            return 'getOrganizationDevicesUplinksLossAndLatency', 200, self._loss_and_latency()
+        m = re.match(r'^/api/v1/devices/([^/]+)$', path)
+        if m and method == 'GET':
+            device = self.by_serial.get(m.group(1))
+            if device is None:
+                return 'getDevice', 404, {'errors': ['Not found']}
+            return 'getDevice', 200, {'serial': device['serial'], 'networkId': device['networkId'],
+                                      'model': 'MX68', 'wan1Ip': device['wan1Ip'], 'wan2Ip': device['wan2Ip']}
+        m = re.match(r'^/api/v1/networks/([^/]+)/appliance/warmSpare$', path)
+        if m and method == 'GET':
+            device = self.by_network.get(m.group(1))
+            return 'getNetworkApplianceWarmSpare', 200, {'enabled': False,
+                                                         'primarySerial': device['serial'] if device else None,
+                                                         'spareSerial': None}
+        m = re.match(r'^/api/v1/networks/([^/]+)/appliance/trafficShaping/uplinkSelection$', path)
+        if m and method == 'GET':
+            return 'getNetworkApplianceTrafficShapingUplinkSelection', 200, \
+                self.uplink_selection.get(m.group(1), {'defaultUplink': 'wan1', 'loadBalancingEnabled': True})
+        if m and method == 'PUT':
+            length = int(request.headers.get('Content-Length', 0))
+            update = json.loads(request.rfile.read(length) or b'{}')
+            with self._lock:
+                selection = self.uplink_selection.setdefault(m.group(1), {})
+                selection.update(update)
+            return 'updateNetworkApplianceTrafficShapingUplinkSelection', 200, selection
+        m = re.match(r'^/api/v0/networks/([^/]+)/devices/([^/]+)/uplink$', path)
+        if m and method == 'GET':
+            return 'getNetworkDeviceUplink', 200, []
+        return 'unknown', 404, {'errors': ['Not found']}
+
+    def _loss_and_latency(self):
+        # 5 minutes of 1 minute samples ending 2 minutes in the past, same as the real endpoint
+        now = datetime.utcnow()
+        stamps = [(now - timedelta(seconds=120 + 60 * k)).strftime('%Y-%m-%dT%H:%M:%SZ') for k in range(4, -1, -1)]
+        healthy = [{'ts': ts, 'lossPercent': 0, 'latencyMs': 20.0} for ts in stamps]
+        degraded = [{'ts': ts, 'lossPercent': 50, 'latencyMs': 500.0} for ts in stamps]
+        entries = []
+        for device in self.fleet:
+            for uplink, ip in (('wan1', device['wan1Ip']), ('wan2', device['wan2Ip'])):
+                entries.append({'networkId': device['networkId'], 'serial': device['serial'], 'uplink': uplink,
+                                'ip': ip, 'timeSeries': degraded if device['bad'] and uplink == 'wan1' else healthy})
+        return entries
@@ -0,0 +1,116 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Sequential change point detectors run on every ping result of an uplink. Instead of waiting for a full
+# trouble_eval_window of bad averages they accumulate evidence of an upward shift in latency or loss sample by
+# sample and raise an alarm as soon as that evidence crosses a threshold.
+#
+# Both detectors look for an increase of more than 'drift' over the in-control baseline. The threshold sets the
+# false alarm rate: for a one sided CUSUM the average number of in-control samples between false alarms grows
+# exponentially with threshold (roughly exp(2 * drift * threshold / variance)), while the detection delay after a
+# real shift of size d only grows linearly (about threshold / (d - drift) samples).
+
+CHANGEPOINT_DETECTORS = ('cusum', 'page_hinkley')
+
+
+class CUSUM(object):
+    """
+    One sided (upward) CUSUM: g = max(0, g + x - baseline - drift), alarm while g > threshold.
+    The baseline is the mean of the first 'warmup' samples and then follows the samples with an EWMA of the given
+    half life (in samples) but only while g is zero, so a shift being accumulated does not drag the baseline up.
+    """
+
+    def __init__(self, drift, threshold, warmup=10, baseline_half_life=300):
+        self.drift = drift
+        self.threshold = threshold
+        self.warmup = warmup
+        self._alpha = 1.0 - 0.5 ** (1.0 / baseline_half_life)
+        self.baseline = 0.0
+        self.samples = 0
+        self.g = 0.0
+        self.alarm = False
+
+    def update(self, x):
+        self.samples += 1
+        if self.samples <= self.warmup:
+            self.baseline += (x - self.baseline) / self.samples
+            return False
+        self.g = max(0.0, self.g + x - self.baseline - self.drift)
+        if self.g == 0.0:
+            self.baseline += self._alpha * (x - self.baseline)
+        self.alarm = self.g > self.threshold
+        return self.alarm
+
+
+class PageHinkley(object):
+    """
+    Page-Hinkley test: m = sum(x - mean - drift) and alarm while m - min(m) > threshold, where mean is the running
+    mean of the in-control samples. Once samples go back to normal m falls back towards its minimum and the alarm
+    clears.
+    """
+
+    def __init__(self, drift, threshold, warmup=10):
+        self.drift = drift
+        self.threshold = threshold
+        self.warmup = warmup
+        self.mean = 0.0
+        self._in_control = 0
+        self.samples = 0
+        self.m = 0.0
+        self.m_min = 0.0
+        self.alarm = False
+
+    def update(self, x):
+        self.samples += 1
+        if self.samples <= self.warmup or (not self.alarm and self.m == self.m_min):
+            self._in_control += 1
+            self.mean += (x - self.mean) / self._in_control
+        if self.samples <= self.warmup:
+            return False
+        self.m += x - self.mean - self.drift
+        self.m_min = min(self.m_min, self.m)
+        self.alarm = self.m - self.m_min > self.threshold
+        return self.alarm
+
+
+class UplinkChangeDetector(object):
+    """
+    A latency and a loss detector for one uplink, fed with the same values WAN_device.uplink_selector() receives:
+    the RTT in seconds, or -1 for a lost ping. Latency is only tracked on replies, loss as 1 for a lost ping and 0
+    for a reply.
+    """
+
+    def __init__(self, kind, latency_drift, latency_threshold, loss_drift, loss_threshold):
+        if kind not in CHANGEPOINT_DETECTORS:
+            raise ValueError("Unknown change point detector %r, must be one of %s" % (kind, CHANGEPOINT_DETECTORS))
+        detector = CUSUM if kind == 'cusum' else PageHinkley
+        self.latency = detector(latency_drift, latency_threshold)
+        self.loss = detector(loss_drift, loss_threshold)
+
+    def update(self, value):
+        if value is None:
+            return self.alarm
+        if value >= 0:
+            self.latency.update(value)
+            self.loss.update(0.0)
+        else:
+            self.loss.update(1.0)
+        return self.alarm
+
+    @property
+    def alarm(self):
+        return self.latency.alarm or self.loss.alarm
@@ -0,0 +1,201 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Small local HTTP API to look at and steer a running MX_uplink_monitor_selector.py, served by an asyncio event loop
+# on a thread of its own:
+#   GET  /status                    overall state: number of devices, testers down, pinned networks, load shedding,
+#                                   decision latency histograms, snapshot time
+#   GET  /devices                   current uplink and load balancing of every device
+#   GET  /devices/<serial>          everything the script knows about one device: evaluation windows, averages,
+#                                   latency statistics, current uplink, time to the next failback check, ...
+#   POST /networks/<id>/pin         stop making uplink decisions for the network. With a {"uplink": "wan2"} body
+#                                   (any of the selectable uplinks of the device) its uplink selection is set to that
+#                                   uplink first (to force a failover during maintenance, for example)
+#   POST /networks/<id>/unpin       resume making uplink decisions for the network
+#   POST /devices/<serial>/evaluate evaluate the device right now with its current windows
+#   POST /evaluate                  evaluate all devices right now
+#   GET  /sla?start=&end=&serial=   availability and SLA counters of every device (or the comma separated serials) from
+#                                   the start to the end date (YYYY-MM-DD, UTC, end excluded), by default of this month
+# Reads are answered from the latest snapshot the script published (a plain reference, so no lock is taken), and
+# commands are queued for the script's main thread, so the API never holds up probing or evaluation.
+
+import asyncio
+import concurrent.futures
+import hmac
+import json
+import logging
+import queue
+import re
+import threading
+import urllib.parse
+
+from selector_logging import log_event
+
+_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+MAX_BODY = 65536
+
+
+class Command(object):
+
+    def __init__(self, name, target, arguments):
+        self.name = name
+        self.target = target
+        self.arguments = arguments
+        self.future = concurrent.futures.Future()
+
+
+class ControlAPI(object):
+    """
+    snapshot is a callable returning the latest published snapshot: a dict with 'status' (a dict) and 'devices' (a
+    dict of device status dicts by serial). Commands are put on the commands queue; whoever runs them sets the result
+    of their future to the (HTTP status, dict) to answer with.
+    """
+
+    def __init__(self, log, address, snapshot, token='', command_timeout=5.0):
+        self.log = log
+        self.requested_address = address
+        self.address = None
+        self.snapshot = snapshot
+        self.token = token
+        self.command_timeout = command_timeout
+        self.commands = queue.Queue()
+        self._loop = None
+        self._server = None
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='control-api', daemon=True).start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+
+    async def _serve(self):
+        host, port = self.requested_address
+        self._server = await asyncio.start_server(self._client, host, port)
+        self.address = self._server.sockets[0].getsockname()[:2]
+        log_event(self.log, logging.INFO, "control API listening on %s:%d", self.address[0], self.address[1])
+        self._ready.set()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def _client(self, reader, writer):
+        try:
+            status, body = await self._request(reader)
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            status, body = 400, {'error': 'malformed request'}
+        payload = json.dumps(body, default=str).encode('utf-8')
+        try:
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                          'Connection: close\r\n\r\n' % (status, _REASONS.get(status, ''), len(payload))).encode('ascii'))
+            writer.write(payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError(request_line)
+        method, (path, _, query) = request_line[0], request_line[1].partition('?')
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY:
+            return 413, {'error': 'request body too large'}
+        body = await reader.readexactly(length) if length else b''
+        if self.token and not hmac.compare_digest(headers.get('x-control-token', '').encode('utf-8'),
+                                                  self.token.encode('utf-8')):
+            return 401, {'error': 'missing or wrong X-Control-Token'}
+        arguments = json.loads(body.decode('utf-8')) if body else {}
+        if not isinstance(arguments, dict):
+            return 400, {'error': 'request body must be a JSON object'}
+        arguments.update(urllib.parse.parse_qsl(query))
+        return await self._route(method, path, arguments)
+
+    async def _route(self, method, path, arguments):
+        snapshot = self.snapshot()
+        if method == 'GET':
+            if path == '/sla':
+                # the counters change with every evaluation, so they are read by the main thread
+                return await self._command('sla', None, arguments)
+            if snapshot is None:
+                return 404, {'error': 'no snapshot published yet'}
+            if path == '/status':
+                return 200, snapshot['status']
+            if path == '/devices':
+                return 200, {serial: {key: device[key] for key in ('networkId', 'current_uplink', 'load_balancing',
+                                                                    'pinned')}
+                             for serial, device in snapshot['devices'].items()}
+            m = re.match(r'^/devices/([^/]+)$', path)
+            if m:
+                device = snapshot['devices'].get(m.group(1))
+                if device is None:
+                    return 404, {'error': 'unknown device %s' % m.group(1)}
+                return 200, device
+            return 404, {'error': 'unknown path %s' % path}
+        if method == 'POST':
+            m = re.match(r'^/networks/([^/]+)/(pin|unpin)$', path)
+            if m:
+                if m.group(2) == 'pin' and not isinstance(arguments.get('uplink', ''), str):
+                    return 400, {'error': 'uplink must be an uplink name such as wan2'}
+                return await self._command(m.group(2), m.group(1), arguments)
+            m = re.match(r'^/devices/([^/]+)/evaluate$', path)
+            if m:
+                return await self._command('evaluate', m.group(1), arguments)
+            if path == '/evaluate':
+                return await self._command('evaluate', None, arguments)
+            return 404, {'error': 'unknown path %s' % path}
+        return 405, {'error': 'method %s not allowed' % method}
+
+    async def _command(self, name, target, arguments):
+        # queued for the main thread; answered with its result, or 202 if it did not get to it in command_timeout
+        command = Command(name, target, arguments)
+        self.commands.put(command)
+        done, _ = await asyncio.wait({asyncio.wrap_future(command.future)}, timeout=self.command_timeout)
+        if done:
+            return done.pop().result()
+        return 202, {'queued': name, 'target': target}
+
+    def pending_commands(self):
+        # returns the commands queued since the last call, for the main thread to run
+        commands = []
+        while True:
+            try:
+                commands.append(self.commands.get_nowait())
+            except queue.Empty:
+                return commands
@@ -1,2 +1,8 @@
 api_key= ''
 org_id=''
+
+# orgs: to monitor several organizations from one instance of the scripts, list them here instead of using org_id, e.g.
+# orgs=[{'org_id': '123456'}, {'org_id': '654321', 'api_key': 'key for this org'}]
+# Every entry can have its own 'api_key' (api_key above is used if not given) and its own whitelist files in
+# 'whitelist' and 'NLB_whitelist' (default networks_whitelist_<org_id>.txt and NLB_networks_whitelist_<org_id>.txt)
+orgs=[]
@@ -0,0 +1,181 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# The organizations monitored by one instance of the selector scripts. Each one has its own Dashboard client (and API
+# key, if configured), its own API call rate limiter and its own whitelist files, while the devices of all of them
+# are probed and evaluated together.
+
+import threading
+import time
+
+
+class LazyDashboardAPI(object):
+    """
+    Stands in for meraki.DashboardAPI(*args, **kwargs). The meraki SDK (and requests with it) is only imported, and
+    the client only created, the first time it is used, so the selector scripts start probing without waiting for
+    either. Safe to share between threads.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import meraki
+                self._client = meraki.DashboardAPI(*self._args, **self._kwargs)
+            return self._client
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            # not an API section, and keeps copy and pickle from looking for the client
+            raise AttributeError(name)
+        section = getattr(self.client(), name)
+        setattr(self, name, section)
+        return section
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing 'rate' calls per second on average with bursts of up to 'burst' calls. acquire() blocks
+    until a call is allowed. Safe to share between threads.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                time.sleep((1 - self._tokens) / self.rate)
+                self._last = time.monotonic()
+                self._tokens = 1
+            self._tokens -= 1
+
+
+class _RateLimitedSection(object):
+
+    def __init__(self, section, limiter):
+        self._section = section
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        method = getattr(self._section, name)
+
+        def call(*args, **kwargs):
+            self._limiter.acquire()
+            return method(*args, **kwargs)
+        setattr(self, name, call)
+        return call
+
+
+class RateLimitedDashboard(object):
+    """
+    Wraps a meraki.DashboardAPI so every call made through it, for instance
+    dashboard.appliance.getNetworkApplianceWarmSpare(...), first waits for the limiter.
+    """
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        section = _RateLimitedSection(getattr(self._client, name), self._limiter)
+        setattr(self, name, section)
+        return section
+
+
+class OrgContext(object):
+
+    def __init__(self, org_id, api_key, client, whitelist_file, NLB_whitelist_file, calls_per_second):
+        self.org_id = org_id
+        self.api_key = api_key
+        self.whitelist_file = whitelist_file
+        self.NLB_whitelist_file = NLB_whitelist_file
+        # the network IDs in the whitelist files, read by the selector scripts
+        self.whitelist = frozenset()
+        self.NLB_whitelist = frozenset()
+        self.limiter = RateLimiter(calls_per_second) if calls_per_second else None
+        # client is not rate limited, see throttle()
+        self.client = client
+        self.dashboard = RateLimitedDashboard(client, self.limiter) if self.limiter is not None else client
+        # time of the last org wide loss and latency poll, see poll_order()
+        self.last_polled = 0.0
+
+    def __repr__(self):
+        return 'Org: %s' % self.org_id
+
+    def throttle(self):
+        # for Dashboard calls not made through self.dashboard
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+
+def read_network_list(path):
+    # the network IDs in a whitelist file, one per line, as a set so that checking a network takes the same time
+    # however long the list is
+    with open(path) as network_file:
+        return frozenset(line.strip() for line in network_file if line.strip())
+
+
+def load_orgs(orgs, api_key, org_id, default_client, base_url, calls_per_second, existing=None):
+    """
+    Returns a dict of OrgContext by org id for the 'orgs' list of credentials.py, or for just org_id with
+    default_client and the whitelist files of a single organization if that list is empty. The contexts in existing
+    (a dict returned before) are reused for the organizations still there with the same API key, so their clients,
+    rate limiters and poll times carry over from one inventory refresh to the next; only the organizations new to
+    the list get new ones.
+    """
+    existing = existing or {}
+    if not orgs:
+        context = existing.get(org_id)
+        if context is None or context.client is not default_client:
+            context = OrgContext(org_id, api_key, default_client, 'networks_whitelist.txt',
+                                 'NLB_networks_whitelist.txt', calls_per_second)
+        return {org_id: context}
+    contexts = {}
+    for entry in orgs:
+        the_org_id = entry['org_id']
+        the_api_key = entry.get('api_key') or api_key
+        whitelist_file = entry.get('whitelist', 'networks_whitelist_%s.txt' % the_org_id)
+        NLB_whitelist_file = entry.get('NLB_whitelist', 'NLB_networks_whitelist_%s.txt' % the_org_id)
+        context = existing.get(the_org_id)
+        if context is not None and context.api_key == the_api_key:
+            context.whitelist_file = whitelist_file
+            context.NLB_whitelist_file = NLB_whitelist_file
+        else:
+            client = LazyDashboardAPI(the_api_key, base_url=base_url, output_log=False, suppress_logging=True)
+            context = OrgContext(the_org_id, the_api_key, client, whitelist_file, NLB_whitelist_file,
+                                 calls_per_second)
+        contexts[the_org_id] = context
+    return contexts
+
+
+def poll_order(contexts):
+    # least recently polled organizations first, so when polling falls behind it is not always the same
+    # organizations that wait
+    return sorted(contexts.values(), key=lambda context: context.last_polled)
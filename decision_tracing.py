@@ -0,0 +1,249 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Decision latency tracing for MX_uplink_monitor_selector.py when decision_tracing is on. Every failover is traced as
+# an incident, from the first bad ping result of the device to its new uplink selection read back from the Dashboard,
+# with a time.monotonic() timestamp for each stage it goes through:
+#   first_anomaly      start of the ping cycle of the first bad result (lost ping or latency over the tolerance)
+#   threshold_crossed  evaluation of the device deciding to fail over
+#   action_queued      the uplink selection change is about to wait for the organization's rate limiter
+#   request_sent       the PUT is sent to the Dashboard
+#   acknowledged       the Dashboard answered the PUT
+#   confirmed          the uplink selection read back from the Dashboard is the new one
+# The time spent in each stage (from the stage before it) goes into a histogram per stage, so the slowest stage shows
+# and can be compared release over release. Run as a script to summarize the traces logged in selector log files:
+#     $ python decision_tracing.py selector.log [other.log ...]
+# All methods are called from the script's main thread.
+
+import argparse
+import bisect
+import json
+import logging
+
+from selector_logging import log_event
+
+STAGES = ('first_anomaly', 'threshold_crossed', 'action_queued', 'request_sent', 'acknowledged', 'confirmed')
+
+# upper bounds (seconds) of the histogram buckets, the last bucket has no upper bound
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+TRACE_MESSAGE = 'decision trace'
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # the upper bound of the bucket holding the q quantile (the largest value seen for the last bucket)
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99), 'max': self.max}
+
+
+class Incident(object):
+    __slots__ = ('serial', 'networkId', 'uplink', 'stamps', 'last_anomaly', 'confirming')
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.networkId = None
+        self.uplink = None
+        self.stamps = {}
+        self.last_anomaly = None
+        # whether a read back of the uplink selection was asked for
+        self.confirming = False
+
+
+class DecisionTracer(object):
+
+    def __init__(self, log, anomaly_window, confirm=True, confirm_timeout=300):
+        """
+        An incident whose last bad result is more than anomaly_window seconds old before the device fails over is
+        dropped as recovered. With confirm, incidents end when the uplink selection read back confirms the change,
+        otherwise when the Dashboard acknowledges it; those not ended confirm_timeout seconds after the device failed
+        over are dropped by expire().
+        """
+        self.log = log
+        self.anomaly_window = anomaly_window
+        self.confirm = confirm
+        self.confirm_timeout = confirm_timeout
+        self._open = {}
+        self._deciding = {}
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES[1:]}
+        self.histograms['total'] = LatencyHistogram()
+        self.completed = 0
+        self.recovered = 0
+        self.abandoned = {}
+
+    def anomaly(self, serial, now):
+        # a bad result of the device in the ping cycle that started at now
+        incident = self._open.get(serial)
+        if incident is not None and now - incident.last_anomaly > self.anomaly_window:
+            self.recovered += 1
+            incident = None
+        if incident is None:
+            incident = self._open[serial] = Incident(serial)
+            incident.stamps['first_anomaly'] = now
+        incident.last_anomaly = now
+
+    def decision(self, serial, networkId, uplink, now):
+        # the device decided to fail over to uplink. Without a bad result before (a change point alarm), the trace
+        # starts here
+        incident = self._open.pop(serial, None)
+        if incident is None or now - incident.last_anomaly > self.anomaly_window:
+            if incident is not None:
+                self.recovered += 1
+            incident = Incident(serial)
+        incident.networkId = networkId
+        incident.uplink = uplink
+        incident.stamps['threshold_crossed'] = now
+        previous = self._deciding.get(networkId)
+        if previous is not None:
+            self._abandon(previous, 'superseded')
+        self._deciding[networkId] = incident
+
+    def stage(self, networkId, stage, now):
+        incident = self._deciding.get(networkId)
+        if incident is None:
+            return
+        incident.stamps[stage] = now
+        if stage == 'acknowledged' and not self.confirm:
+            self._finish(incident)
+
+    def abandon(self, networkId, reason):
+        # the change of the network's uplink selection was not made (the PUT failed, or it was already set)
+        incident = self._deciding.get(networkId)
+        if incident is not None:
+            self._abandon(incident, reason)
+
+    def _abandon(self, incident, reason):
+        del self._deciding[incident.networkId]
+        self.abandoned[reason] = self.abandoned.get(reason, 0) + 1
+        log_event(self.log, logging.DEBUG, "decision trace of %s abandoned: %s", incident.serial, reason,
+                  serial=incident.serial, networkId=incident.networkId, reason=reason)
+
+    def expire(self, now):
+        # drops the incidents of devices that recovered without failing over, and those that did fail over but were
+        # not confirmed (or acknowledged) within confirm_timeout seconds
+        for serial, incident in list(self._open.items()):
+            if now - incident.last_anomaly > self.anomaly_window:
+                del self._open[serial]
+                self.recovered += 1
+        for incident in list(self._deciding.values()):
+            if now - incident.stamps['threshold_crossed'] > self.confirm_timeout:
+                self._abandon(incident, 'unconfirmed' if 'acknowledged' in incident.stamps else 'unacknowledged')
+
+    def awaiting_confirmation(self):
+        # the networks whose change was acknowledged and needs to be read back, each returned once
+        networks = []
+        for incident in self._deciding.values():
+            if 'acknowledged' in incident.stamps and not incident.confirming:
+                incident.confirming = True
+                networks.append(incident.networkId)
+        return networks
+
+    def read_back(self, networkId, load_balancing, default_uplink, read_time):
+        # an uplink selection read back from the Dashboard at read_time
+        incident = self._deciding.get(networkId)
+        if incident is None or 'acknowledged' not in incident.stamps or read_time < incident.stamps['acknowledged']:
+            return
+        if load_balancing or default_uplink != incident.uplink:
+            self._abandon(incident, 'overwritten')
+            return
+        incident.stamps['confirmed'] = read_time
+        self._finish(incident)
+
+    def _finish(self, incident):
+        del self._deciding[incident.networkId]
+        stamps = incident.stamps
+        stages = [stage for stage in STAGES if stage in stamps]
+        spans = {}
+        for before, stage in zip(stages, stages[1:]):
+            spans[stage] = stamps[stage] - stamps[before]
+            self.histograms[stage].add(spans[stage])
+        total = stamps[stages[-1]] - stamps[stages[0]]
+        self.histograms['total'].add(total)
+        self.completed += 1
+        log_event(self.log, logging.INFO, TRACE_MESSAGE, serial=incident.serial, networkId=incident.networkId,
+                  uplink=incident.uplink, stamps={stage: stamps[stage] for stage in stages}, spans=spans,
+                  total=total)
+
+    def stats(self):
+        return {'completed': self.completed, 'open': len(self._open), 'deciding': len(self._deciding),
+                'recovered': self.recovered, 'abandoned': dict(self.abandoned),
+                'stages': {stage: histogram.summary() for stage, histogram in self.histograms.items()
+                           if histogram.count}}
+
+
+def summarize(paths):
+    # the per stage histograms of the decision traces logged in the given selector log files
+    histograms = {stage: LatencyHistogram() for stage in STAGES[1:] + ('total',)}
+    for path in paths:
+        with open(path) as log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(entry, dict) or entry.get('msg') != TRACE_MESSAGE:
+                    continue
+                for stage, seconds in entry.get('spans', {}).items():
+                    if stage in histograms:
+                        histograms[stage].add(seconds)
+                histograms['total'].add(entry['total'])
+    return histograms
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize the decision traces in MX_uplink_monitor_selector.py '
+                                                 'log files, one summary per file')
+    parser.add_argument('log_files', nargs='+', help='log files (JSON lines) of the selector')
+    args = parser.parse_args(argv)
+    for path in args.log_files:
+        print(path)
+        print('  %-18s %7s %9s %9s %9s %9s %9s' % ('stage', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+        for stage, histogram in summarize([path]).items():
+            summary = histogram.summary()
+            if not summary['count']:
+                continue
+            print('  %-18s %7d %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs' % (
+                stage, summary['count'], summary['mean'], summary['p50'], summary['p90'], summary['p99'],
+                summary['max']))
+
+
+if __name__ == '__main__':
+    main()
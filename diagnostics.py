@@ -0,0 +1,176 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Production diagnostics for the selector scripts:
+#   LoopWatchdog     : the main loops beat a heartbeat; when one of them has not beaten for stall_threshold seconds
+#                      (a Dashboard call hanging in uplink_selector() or refreshDevicesDict(), for example) it logs an
+#                      alert with the stack of every thread, and logs again when the loop recovers
+#   SamplingProfiler : samples the stacks of all threads for a number of seconds and writes a report of where the time
+#                      went. install_profile_signal() starts a session on SIGUSR1, so a running monitor can be
+#                      profiled without restarting it:
+#                          $ kill -USR1 <pid>
+
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from selector_logging import log_event
+
+
+def thread_stacks(exclude=None):
+    # returns the current stack of every thread by thread name
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = {}
+    for ident, frame in sys._current_frames().items():
+        if ident == exclude:
+            continue
+        stacks['%s (%d)' % (names.get(ident, 'unknown'), ident)] = ''.join(traceback.format_stack(frame))
+    return stacks
+
+
+class LoopWatchdog(object):
+
+    def __init__(self, log, stall_threshold, check_interval=None, clock=time.monotonic):
+        self.log = log
+        self.stall_threshold = stall_threshold
+        self.check_interval = check_interval or stall_threshold / 4.0
+        self.clock = clock
+        self._beats = {}
+        self._stalled = set()
+        self._stop = threading.Event()
+        self.stalls = 0
+
+    def beat(self, name='main'):
+        self._beats[name] = self.clock()
+        if name in self._stalled:
+            self._stalled.discard(name)
+            log_event(self.log, logging.WARNING, "%s loop recovered", name, loop=name)
+
+    def start(self):
+        threading.Thread(target=self._run, name='watchdog', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        # returns the names of the loops that just stalled
+        now = self.clock()
+        stalled = []
+        for name, last in list(self._beats.items()):
+            if name not in self._stalled and now - last > self.stall_threshold:
+                self._stalled.add(name)
+                stalled.append(name)
+                self.stalls += 1
+                log_event(self.log, logging.ERROR, "%s loop stalled: no heartbeat for %.1f seconds", name, now - last,
+                          loop=name, stalled_for=now - last, stacks=thread_stacks(exclude=threading.get_ident()))
+        return stalled
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            self.check()
+
+
+class SamplingProfiler(object):
+    """
+    Counts, over all threads, how many samples each function was running in (self) or on the stack of (cumulative).
+    """
+
+    def __init__(self, log, interval=0.005, top=40):
+        self.log = log
+        self.interval = interval
+        self.top = top
+        self._lock = threading.Lock()
+        self.running = False
+
+    def start(self, duration, report_file):
+        # starts a session in the background unless one is already running, returns whether it did
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+        threading.Thread(target=self._session, args=(duration, report_file), name='profiler', daemon=True).start()
+        return True
+
+    def _session(self, duration, report_file):
+        try:
+            log_event(self.log, logging.WARNING, "profiling for %d seconds", duration, report_file=report_file)
+            own = threading.get_ident()
+            self_counts = collections.Counter()
+            cumulative_counts = collections.Counter()
+            samples = 0
+            end = time.monotonic() + duration
+            while time.monotonic() < end:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    seen = set()
+                    leaf = True
+                    while frame is not None:
+                        code = frame.f_code
+                        key = (code.co_filename, code.co_firstlineno, code.co_name)
+                        if leaf:
+                            self_counts[key] += 1
+                            leaf = False
+                        if key not in seen:
+                            seen.add(key)
+                            cumulative_counts[key] += 1
+                        frame = frame.f_back
+                samples += 1
+                time.sleep(self.interval)
+            self.write_report(report_file, duration, samples, self_counts, cumulative_counts)
+            log_event(self.log, logging.WARNING, "profile written to %s", report_file, report_file=report_file,
+                      samples=samples)
+        except Exception:
+            self.log.exception("profiling failed")
+        finally:
+            with self._lock:
+                self.running = False
+
+    def write_report(self, report_file, duration, samples, self_counts, cumulative_counts):
+        with open(report_file, 'w') as report:
+            report.write('%d samples of all threads over %d seconds, every %.3f seconds\n' % (samples, duration,
+                                                                                             self.interval))
+            # every sample covers all threads, so the percentages of functions of different threads add up to more
+            report.write('%% is of the samples, each of them covering every thread\n')
+            for title, counts in (('self', self_counts), ('cumulative', cumulative_counts)):
+                report.write('\n%-10s %7s  function\n' % (title, '%'))
+                for (filename, line, function), count in counts.most_common(self.top):
+                    report.write('%10d %6.1f%%  %s (%s:%d)\n' % (count, 100.0 * count / max(samples, 1), function,
+                                                                 os.path.basename(filename), line))
+
+
+def install_profile_signal(profiler, duration, report_dir, prefix):
+    """
+    Starts a profiler session of duration seconds on SIGUSR1, writing the report to report_dir. Returns whether the
+    signal handler could be installed (not on platforms without SIGUSR1, nor outside the main thread).
+    """
+    if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+        return False
+
+    def handler(signum, frame):
+        report_file = os.path.join(report_dir, '%s-profile-%s.txt' % (prefix, time.strftime('%Y%m%d-%H%M%S')))
+        # a signal arriving while a session is running is ignored
+        profiler.start(duration, report_file)
+
+    signal.signal(signal.SIGUSR1, handler)
+    return True
@@ -0,0 +1,281 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Bounded memory streaming latency estimators kept per uplink next to the plain window average:
+# sliding window percentiles, an exponentially weighted moving average and RFC 3550 interarrival jitter.
+# Every add() only touches the newest time slot; memory does not grow with the number of samples in the window.
+# They are kept for every uplink of fleets of tens of thousands of devices, so they use __slots__ and keep their
+# counts and samples in arrays of machine numbers rather than in lists of Python objects.
+
+import array
+import math
+
+# latency statistics that can be selected as failover criteria in the selector scripts
+LATENCY_CRITERIA = ('mean', 'p50', 'p95', 'p99', 'ewma')
+
+
+class ReportWindow(object):
+    """
+    The reports of one uplink in the evaluation window, each a (time, value, weight) triple, stored one after the
+    other in a single array of doubles. Reports are appended in time order and the old ones dropped from the front by
+    moving an offset, the array is only compacted once the dropped ones make up half of it.
+    """
+    __slots__ = ('_data', '_start')
+
+    def __init__(self):
+        self._data = array.array('d')
+        self._start = 0
+
+    def __len__(self):
+        return (len(self._data) - self._start) // 3
+
+    def append(self, t, value, weight=1.0):
+        self._data.extend((t, value, weight))
+
+    def prune(self, now, window):
+        # drops the reports more than window seconds older than now
+        data = self._data
+        start = self._start
+        end = len(data)
+        while start < end and now - data[start] > window:
+            start += 3
+        if start == end:
+            del data[:]
+            start = 0
+        elif start * 2 >= end:
+            del data[:start]
+            start = 0
+        self._start = start
+
+    def weighted_sum(self):
+        # the sum of value*weight and the sum of the weights of the reports
+        data = self._data
+        value_sum = 0
+        weight_sum = 0
+        for i in range(self._start, len(data), 3):
+            value_sum += data[i + 1] * data[i + 2]
+            weight_sum += data[i + 2]
+        return value_sum, weight_sum
+
+    def value_sum(self):
+        data = self._data
+        return sum(data[i] for i in range(self._start + 1, len(data), 3))
+
+
+class SlidingQuantile(object):
+    """
+    Approximate quantiles over the last 'window' seconds of samples.
+
+    Samples are counted in logarithmically spaced buckets (each 'growth' times wider than the previous, so any
+    quantile is accurate to within that relative error) and the counts are kept per time slot of window/slots
+    seconds. Whole slots expire once they fall out of the window, so the effective window is between
+    window - window/slots and window seconds. Only buckets that actually received samples are stored, and the counts
+    of all the slots in the window are kept merged as samples are added and slots expire, so a query only walks the
+    buckets in use.
+    """
+    __slots__ = ('window', 'slot_width', '_log_growth', '_growth', '_min_value', '_slots', '_last', '_merged',
+                 '_merged_base', '_total')
+
+    def __init__(self, window, slots=8, growth=1.05, min_value=0.0001):
+        self.window = float(window)
+        self.slot_width = self.window / slots
+        self._log_growth = math.log(growth)
+        self._growth = growth
+        self._min_value = min_value
+        # the slots in the window, oldest first, one after the other: slot id<<16|n for its number of buckets n, then
+        # n times bucket<<32|count. _last is the offset of the newest slot
+        self._slots = array.array('q')
+        self._last = 0
+        # the count of bucket _merged_base+i in all the slots is _merged[i], _total their sum
+        self._merged = array.array('I')
+        self._merged_base = 0
+        self._total = 0
+
+    def _bucket(self, value):
+        if value <= self._min_value:
+            return 0
+        return int(math.log(value / self._min_value) / self._log_growth) + 1
+
+    def _bucket_value(self, bucket):
+        if bucket == 0:
+            return self._min_value
+        # geometric middle of the bucket
+        return self._min_value * self._growth ** (bucket - 0.5)
+
+    def _expire(self, now):
+        oldest_slot = math.floor((now - self.window) / self.slot_width)
+        slots = self._slots
+        end = len(slots)
+        if not end or slots[0] >> 16 > oldest_slot:
+            return
+        merged = self._merged
+        base = self._merged_base
+        first = 0
+        while first < end and slots[first] >> 16 <= oldest_slot:
+            stop = first + 1 + (slots[first] & 0xffff)
+            for i in range(first + 1, stop):
+                count = slots[i] & 0xffffffff
+                merged[(slots[i] >> 32) - base] -= count
+                self._total -= count
+            first = stop
+        del slots[:first]
+        self._last -= first
+        if first == end:
+            del merged[:]
+            self._last = 0
+            return
+        # the buckets no slot uses any more at either end are dropped
+        low = 0
+        while merged[low] == 0:
+            low += 1
+        high = len(merged)
+        while merged[high - 1] == 0:
+            high -= 1
+        del merged[high:]
+        del merged[:low]
+        self._merged_base = base + low
+
+    def add(self, t, value):
+        slot_id = math.floor(t / self.slot_width)
+        slots = self._slots
+        if not len(slots) or slots[self._last] >> 16 != slot_id:
+            self._expire(t)
+            self._last = len(slots)
+            slots.append(slot_id << 16)
+        bucket = self._bucket(value)
+        last = self._last
+        for i in range(last + 1, len(slots)):
+            if slots[i] >> 32 == bucket:
+                slots[i] += 1
+                break
+        else:
+            slots.append(bucket << 32 | 1)
+            slots[last] += 1
+        merged = self._merged
+        index = bucket - self._merged_base
+        if not 0 <= index < len(merged):
+            if not len(merged):
+                merged.append(0)
+                self._merged_base = bucket
+            elif index < 0:
+                self._merged = merged = array.array('I', [0]) * -index + merged
+                self._merged_base = bucket
+            else:
+                merged.extend(array.array('I', [0]) * (index - len(merged) + 1))
+            index = bucket - self._merged_base
+        merged[index] += 1
+        self._total += 1
+
+    def count(self, now):
+        self._expire(now)
+        return self._total
+
+    def quantiles(self, now, qs):
+        """
+        Returns a list with the estimated value for each quantile in qs (0.0 to 1.0), or zeros when there are no
+        samples in the window.
+        """
+        self._expire(now)
+        total = self._total
+        if total == 0:
+            return [0.0] * len(qs)
+        results = []
+        for q in qs:
+            rank = max(math.ceil(q * total), 1)
+            seen = 0
+            for index, count in enumerate(self._merged):
+                seen += count
+                if seen >= rank:
+                    results.append(self._bucket_value(self._merged_base + index))
+                    break
+        return results
+
+    def quantile(self, now, q):
+        return self.quantiles(now, (q,))[0]
+
+
+class EWMA(object):
+    """
+    Time aware exponentially weighted moving average: a sample's weight halves every half_life seconds, so the
+    smoothing means the same thing regardless of how often samples arrive.
+    """
+    __slots__ = ('half_life', 'value', '_last_t')
+
+    def __init__(self, half_life):
+        self.half_life = float(half_life)
+        self.value = None
+        self._last_t = None
+
+    def add(self, t, value):
+        if self.value is None:
+            self.value = value
+        else:
+            alpha = 1.0 - 0.5 ** (max(t - self._last_t, 0.0) / self.half_life)
+            self.value += alpha * (value - self.value)
+        self._last_t = t
+
+
+class Jitter(object):
+    """
+    Interarrival jitter as defined in RFC 3550 section 6.4.1, applied to consecutive round trip times:
+    J = J + (|D| - J) / 16 where D is the difference between two consecutive RTTs.
+    """
+    __slots__ = ('value', '_last')
+
+    def __init__(self):
+        self.value = 0.0
+        self._last = None
+
+    def add(self, t, value):
+        if self._last is not None:
+            self.value += (abs(value - self._last) - self.value) / 16.0
+        self._last = value
+
+
+class UplinkLatencyStats(object):
+    """
+    The streaming estimators kept for one uplink. 'window' is the evaluation window in seconds; the EWMA half life
+    is half of it.
+    """
+    __slots__ = ('quantiles', 'ewma', 'jitter')
+
+    def __init__(self, window):
+        self.quantiles = SlidingQuantile(window)
+        self.ewma = EWMA(window / 2.0)
+        self.jitter = Jitter()
+
+    def add(self, t, latency):
+        self.quantiles.add(t, latency)
+        self.ewma.add(t, latency)
+        self.jitter.add(t, latency)
+
+    def value(self, criterion, now, mean):
+        """
+        Returns the latency statistic named by criterion (one of LATENCY_CRITERIA) as of 'now'. The plain window
+        mean is computed by the caller and passed through for 'mean'.
+        """
+        if criterion not in LATENCY_CRITERIA:
+            raise ValueError("Unknown latency criterion %r, must be one of %s" % (criterion, LATENCY_CRITERIA))
+        if criterion == 'mean':
+            return mean
+        if criterion == 'ewma':
+            return self.ewma.value or 0.0
+        return self.quantiles.quantile(now, int(criterion[1:]) / 100.0)
+
+    def summary(self, now):
+        p50, p95, p99 = self.quantiles.quantiles(now, (0.50, 0.95, 0.99))
+        return {'p50': p50, 'p95': p95, 'p99': p99, 'ewma': self.ewma.value, 'jitter': self.jitter.value}
@@ -0,0 +1,196 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Settings that can be changed while a selector script runs. They are read from a JSON file of {"name": value} and
+# from environment variables (<prefix><NAME>, the value as JSON or a plain string, taking precedence over the file),
+# validated all together and only handed back if every one of them is valid, so the script swaps them in at once or
+# not at all. FileWatcher tells which of the watched files (the settings file, the whitelists) changed since it was
+# last asked, with inotify on Linux and by comparing their modification time and size elsewhere.
+
+import ctypes
+import ctypes.util
+import json
+import os
+import struct
+import threading
+
+# inotify_event: wd, mask, cookie, len, followed by len bytes of NUL padded name
+_EVENT = struct.Struct('iIII')
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+
+
+def positive(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError("must be a number over 0")
+    return value
+
+
+def non_negative(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError("must be a number of at least 0")
+    return value
+
+
+def positive_int(value):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError("must be a whole number of at least 1")
+    return value
+
+
+def fraction(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value <= 1:
+        raise ValueError("must be a number over 0 and at most 1")
+    return value
+
+
+def percent(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 100:
+        raise ValueError("must be a percentage from 0 to 100")
+    return value
+
+
+def boolean(value):
+    if not isinstance(value, bool):
+        raise ValueError("must be true or false")
+    return value
+
+
+def optional(check):
+    # the check of a setting that can also be None (null in JSON)
+    def check_optional(value):
+        return None if value is None else check(value)
+    return check_optional
+
+
+def one_of(*choices):
+    def check_choice(value):
+        if value not in choices:
+            raise ValueError("must be one of %s" % ', '.join(repr(choice) for choice in choices))
+        return value
+    return check_choice
+
+
+def read_settings(path, checks, environ=None, env_prefix=None):
+    """
+    Returns the validated settings of the JSON file at path (None for no file) and of the environment variables
+    env_prefix+NAME in environ, for the settings named in checks, a dict of the check of every setting that returns
+    its value or raises ValueError. Raises ValueError naming every invalid or unknown setting if any.
+    """
+    raw = {}
+    if path:
+        with open(path) as settings_file:
+            raw = json.load(settings_file)
+        if not isinstance(raw, dict):
+            raise ValueError("%s: expected a JSON object of settings" % path)
+    if environ is not None and env_prefix:
+        for name in checks:
+            text = environ.get(env_prefix + name.upper())
+            if text is None:
+                continue
+            try:
+                raw[name] = json.loads(text)
+            except ValueError:
+                raw[name] = text
+    settings = {}
+    problems = []
+    for name, value in raw.items():
+        check = checks.get(name)
+        if check is None:
+            problems.append("%s is not a setting that can be changed while running" % name)
+            continue
+        try:
+            settings[name] = check(value)
+        except ValueError as error:
+            problems.append("%s %s, not %r" % (name, error, value))
+    if problems:
+        raise ValueError('; '.join(problems))
+    return settings
+
+
+class FileWatcher(object):
+    """
+    Watches a set of files. changed() returns the paths of those created, written, replaced or deleted since the last
+    call. With inotify the directories of the files are watched (so files replaced by renaming another one over them,
+    as editors do, are seen too) by a thread of its own; without it every call compares the modification time and
+    size of the files.
+    """
+
+    def __init__(self, paths):
+        self.paths = {os.path.abspath(path): path for path in paths if path}
+        self._changed = set()
+        self._lock = threading.Lock()
+        self._fd = None
+        self._watches = {}
+        self._stats = {path: self._stat(path) for path in self.paths}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def start(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return self
+        if fd < 0:
+            return self
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            wd = libc.inotify_add_watch(fd, directory.encode(), mask)
+            if wd < 0:
+                os.close(fd)
+                return self
+            self._watches[wd] = directory
+        self._fd = fd
+        threading.Thread(target=self._read_events, name='config-watch', daemon=True).start()
+        return self
+
+    def _read_events(self):
+        while True:
+            data = os.read(self._fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0').decode()
+                offset += _EVENT.size + length
+                path = os.path.join(self._watches.get(wd, ''), name)
+                if path in self.paths:
+                    with self._lock:
+                        self._changed.add(self.paths[path])
+
+    def changed(self):
+        if self._fd is not None:
+            with self._lock:
+                changed, self._changed = self._changed, set()
+            return changed
+        changed = set()
+        for path, name in self.paths.items():
+            stat = self._stat(path)
+            if stat != self._stats[path]:
+                self._stats[path] = stat
+                changed.add(name)
+        return changed
@@ -0,0 +1,137 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Overload policy of MX_uplink_monitor_selector.py when cycle_budget is set. When pinging and evaluating the devices
+# takes longer than the budget, every device would otherwise see its detection delayed alike. A cycle is modelled as a
+# fixed part, the wait for the replies (at most the floor: ping_timeout per try, after the burst with burst_size>1),
+# plus a cost per device for sending its pings and evaluating it, measured on the cycles just run. While the devices
+# due would take the cycles over the budget, the priority ones (unstable, failed over, waiting to fail back, or left
+# out for too long) are always pinged and the calm ones take turns filling what is left. Shedding ends once the
+# cycles fit in the budget again with all the devices due. With threaded_probing the probe thread selects the devices
+# while the main thread reports the cycle times, so the estimate is kept under a lock.
+
+import threading
+
+
+class LoadShedder(object):
+
+    def __init__(self, budget, floor, headroom=0.9, smoothing=0.3):
+        """
+        budget is the number of seconds a cycle may take to ping and evaluate its devices, floor the longest it waits
+        for the replies whatever the number of devices; the budget must be larger. While shedding, the capacity is
+        estimated so that the devices take headroom (a fraction) of the budget left over the floor, leaving room for
+        the priority devices to come and go. smoothing is the weight of the last cycle in the per device cost.
+        """
+        if budget <= floor:
+            raise ValueError("cycle_budget %.3fs must be larger than the %.3fs a ping cycle waits for the replies"
+                             % (budget, floor))
+        self.budget = budget
+        self.floor = floor
+        self.headroom = headroom
+        self.smoothing = smoothing
+        # the number of devices to ping per cycle while shedding, None while all the devices due are pinged
+        self.capacity = None
+        # seconds per device of a cycle besides the wait for the replies, None until a cycle was run
+        self.device_cost = None
+        self._candidates = 0
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self.cycles = 0
+        self.overruns = 0
+        self.shed_cycles = 0
+        self.deferred = 0
+        self.last_deferred = 0
+        self.max_duration = 0.0
+
+    @property
+    def shedding(self):
+        return self.capacity is not None
+
+    def select(self, candidates, is_priority):
+        """
+        Returns the keys of the list candidates (the devices due this cycle) to ping now and those deferred. While
+        shedding, every key for which is_priority(key) is true is pinged, and the others, from where the previous
+        cycle left off, as long as there is capacity left.
+        """
+        with self._lock:
+            capacity = self.capacity
+            self._candidates = len(candidates)
+        if capacity is None or len(candidates) <= capacity:
+            self.last_deferred = 0
+            return candidates, []
+        selected = []
+        calm = []
+        for key in candidates:
+            (selected if is_priority(key) else calm).append(key)
+        room = max(capacity - len(selected), 0)
+        if room >= len(calm):
+            self.last_deferred = 0
+            return candidates, []
+        start = self._cursor % len(calm)
+        rotated = calm[start:] + calm[:start]
+        selected.extend(rotated[:room])
+        self._cursor = start + room
+        with self._lock:
+            self.shed_cycles += 1
+            self.deferred += len(rotated) - room
+            self.last_deferred = len(rotated) - room
+        return selected, rotated[room:]
+
+    def cycle_done(self, duration, waited, devices):
+        """
+        Takes the number of seconds the last cycle took to ping and evaluate its number of devices, of which it
+        waited (sending the pings included) in the ICMP call. Returns 'started' or 'ended' when shedding just started
+        or ended, None otherwise.
+        """
+        with self._lock:
+            self.cycles += 1
+            self.max_duration = max(self.max_duration, duration)
+            if duration > self.budget:
+                self.overruns += 1
+            if devices <= 0 or duration <= 0:
+                return None
+            # past the floor the ICMP call was sending, which is part of the cost of the devices
+            cost = max(duration - min(waited, self.floor), 0.0) / devices
+            if self.device_cost is None:
+                self.device_cost = cost
+            else:
+                self.device_cost += self.smoothing * (cost - self.device_cost)
+            fits = self.floor + self._candidates * self.device_cost <= self.budget
+            if self.capacity is None:
+                if duration <= self.budget or fits:
+                    return None
+                self.capacity = self._fitting()
+                return 'started'
+            if duration <= self.budget and fits:
+                self.capacity = None
+                return 'ended'
+            self.capacity = min(self._fitting(), 2 * self.capacity)
+            return None
+
+    def _fitting(self):
+        # the number of devices whose cost takes headroom of the budget left over the floor
+        room = (self.budget - self.floor) * self.headroom
+        if self.device_cost <= 0:
+            return max(self._candidates, 1)
+        return max(1, int(room / self.device_cost))
+
+    def stats(self):
+        with self._lock:
+            return {'shedding': self.capacity is not None, 'capacity': self.capacity, 'budget': self.budget,
+                    'floor': self.floor, 'device_cost': self.device_cost, 'cycles': self.cycles,
+                    'overruns': self.overruns, 'shed_cycles': self.shed_cycles, 'deferred': self.deferred,
+                    'last_deferred': self.last_deferred, 'max_duration': self.max_duration}
@@ -50,6 +50,30 @@ _IPPROTO_ICMPV6        = (socket.IPPROTO_ICMPV6
                           if hasattr(socket, 'IPPROTO_ICMPV6')
                           else 58)
 
+# ICMP error messages carry the IP header and the first 8 bytes of the packet
+# that caused them, so an error caused by one of our echo requests can be
+# matched back to its packet id. The kinds of error they are reported as:
+ICMP_UNREACHABLE       = 'unreachable'
+ICMP_ADMIN_PROHIBITED  = 'admin_prohibited'
+ICMP_TIME_EXCEEDED     = 'time_exceeded'
+ICMP_PARAMETER_PROBLEM = 'parameter_problem'
+
+_ICMP_ERROR_KINDS      = {3: ICMP_UNREACHABLE, 11: ICMP_TIME_EXCEEDED,
+                          12: ICMP_PARAMETER_PROBLEM}
+# Destination Unreachable codes for communication administratively prohibited
+# (by the network, by the host, or filtered)
+_ICMP_ADMIN_PROHIBITED_CODES = (9, 10, 13)
+_ICMP_PROTO            = 1
+
+_ICMPV6_ERROR_KINDS    = {1: ICMP_UNREACHABLE, 3: ICMP_TIME_EXCEEDED,
+                          4: ICMP_PARAMETER_PROBLEM}
+# Destination Unreachable codes for administratively prohibited, source
+# address failed ingress/egress policy and reject route to destination
+_ICMPV6_ADMIN_PROHIBITED_CODES = (1, 5, 6)
+# The quoted IPv6 header is 40 bytes, followed by the original ICMPv6 header
+_ICMPV6_QUOTED_OFFSET  = 8
+_ICMPV6_QUOTED_ECHO_OFFSET = _ICMPV6_QUOTED_OFFSET + 40
+
 
 class MultiPingError(Exception):
     """
@@ -70,6 +94,57 @@ class MultiPingSocketError(socket.gaierror):
     pass
 
 
+class BurstStats(object):
+    """
+    The results of a burst of echo requests to one address.
+
+    'rtts' holds the round trip time of every request in the order they were
+    sent, -1 for those without a reply. The rest is computed from it in one
+    pass: the number of requests sent and replies received, the loss in
+    percent, the min/avg/max RTT and the jitter, the mean absolute difference
+    between the RTTs of consecutive replies (RTT stats are None without
+    replies, the jitter also with a single one). 'error' is the kind of ICMP
+    error message that ended the burst early, if any.
+
+    """
+    __slots__ = ('rtts', 'sent', 'received', 'loss', 'min', 'avg', 'max',
+                 'jitter', 'error')
+
+    def __init__(self, rtts, error=None):
+        self.rtts = rtts
+        self.sent = len(rtts)
+        self.error = error
+        received = 0
+        total = 0.0
+        rtt_min = None
+        rtt_max = None
+        deltas = 0.0
+        previous = None
+        for rtt in rtts:
+            if rtt < 0:
+                continue
+            received += 1
+            total += rtt
+            if rtt_min is None or rtt < rtt_min:
+                rtt_min = rtt
+            if rtt_max is None or rtt > rtt_max:
+                rtt_max = rtt
+            if previous is not None:
+                deltas += abs(rtt - previous)
+            previous = rtt
+        self.received = received
+        self.loss = 100.0 * (self.sent - received) / self.sent \
+            if self.sent else 0.0
+        self.min = rtt_min
+        self.max = rtt_max
+        self.avg = total / received if received else None
+        self.jitter = deltas / (received - 1) if received > 1 else None
+
+    def __repr__(self):
+        return "BurstStats(sent=%d, received=%d, loss=%.1f%%, avg=%s)" % (
+            self.sent, self.received, self.loss, self.avg)
+
+
 class MultiPing(object):
 
     def __init__(self, dest_addrs, sock=None, ignore_lookup_errors=False):
@@ -153,6 +228,11 @@ class MultiPing(object):
         self._receive_has_been_called = False
         self._ipv6_address_present    = False
 
+        # Addresses whose echo request was answered with an ICMP error
+        # message, with the kind of error (ICMP_UNREACHABLE, ...). They are
+        # done: reported as no result right away and never sent to again.
+        self.errors = {}
+
         # use pid as identifier to filter receive pack from different
         # process echo
         self.ident = os.getpid() & 0xffff
@@ -303,7 +383,14 @@ class MultiPing(object):
         else:
             all_addrs = [a for (i, a) in list(self._id_to_addr.items())
                          if i in self._remaining_ids]
+        self._send_batch(all_addrs)
+
+    def _send_batch(self, all_addrs):
+        """
+        Send one ICMPecho request to every address in all_addrs, returns the
+        list of IDs used for them (in the same order).
 
+        """
         if self._last_used_id is None:
             # Will attempt to continue at the last request ID we used. But if
             # we never sent anything before then we create a first ID
@@ -312,16 +399,19 @@ class MultiPing(object):
             self._last_used_id = int(time.time()) & 0xffff
 
         # Send ICMPecho to all addresses...
+        ids = []
         for addr in all_addrs:
             # Make a unique ID, wrapping around at 65535.
             self._last_used_id = (self._last_used_id + 1) & 0xffff
             # Remember the address for each ID so we can produce meaningful
             # result lists later on.
             self._id_to_addr[self._last_used_id] = addr
+            ids.append(self._last_used_id)
             # Send an ICMPecho request packet. We specify a payload consisting
             # of the current time stamp. This is returned to us in the
             # response and allows us to calculate the 'ping time'.
             self._send_ping(addr, payload=struct.pack("d", time.time()))
+        return ids
 
     def _read_all_from_socket(self, timeout):
         """
@@ -345,7 +435,8 @@ class MultiPing(object):
         try:
             self._sock.settimeout(timeout)
             while True:
-                p = self._sock.recv(64)
+                # large enough for an ICMP error quoting our echo request
+                p = self._sock.recv(128)
                 # Store the packet and the current time
                 pkts.append((bytearray(p), time.time()))
                 # Continue the loop to receive any additional packets that
@@ -387,6 +478,167 @@ class MultiPing(object):
 
         return pkts
 
+    def _parse_error(self, pkt):
+        """
+        Returns the packet id of the echo request an ICMP or ICMPv6 error
+        message was caused by and the kind of error, or None if the packet is
+        not an error message about one of our echo requests.
+
+        IPv4 packets come with their IP header, which starts with a version
+        nibble of 4. ICMPv6 packets come without it and start with the type,
+        which never looks like that for the error types.
+
+        """
+        if pkt[_ICMP_VER_OFFSET] >> 4 == 4:
+            icmp = (pkt[_ICMP_VER_OFFSET] & 0x0f) * 4
+            kind = _ICMP_ERROR_KINDS.get(pkt[icmp])
+            if kind is None:
+                return None
+            if kind == ICMP_UNREACHABLE and \
+               pkt[icmp + 1] in _ICMP_ADMIN_PROHIBITED_CODES:
+                kind = ICMP_ADMIN_PROHIBITED
+            quoted = icmp + 8
+            if pkt[quoted + 9] != _ICMP_PROTO:
+                return None
+            family = socket.AF_INET
+            dest = bytes(pkt[quoted + 16:quoted + 20])
+            echo = quoted + (pkt[quoted] & 0x0f) * 4
+            echo_request = _ICMP_ECHO_REQUEST
+        else:
+            kind = _ICMPV6_ERROR_KINDS.get(pkt[_ICMPV6_HDR_OFFSET])
+            if kind is None:
+                return None
+            if kind == ICMP_UNREACHABLE and \
+               pkt[_ICMPV6_HDR_OFFSET + 1] in _ICMPV6_ADMIN_PROHIBITED_CODES:
+                kind = ICMP_ADMIN_PROHIBITED
+            # next header of the quoted IPv6 header
+            if pkt[_ICMPV6_QUOTED_OFFSET + 6] != _IPPROTO_ICMPV6:
+                return None
+            family = socket.AF_INET6
+            dest = bytes(pkt[_ICMPV6_QUOTED_OFFSET + 24:
+                             _ICMPV6_QUOTED_OFFSET + 40])
+            echo = _ICMPV6_QUOTED_ECHO_OFFSET
+            echo_request = _ICMPV6_ECHO_REQUEST
+
+        if pkt[echo] != echo_request or len(pkt) < echo + 8:
+            return None
+        pkt_id = (pkt[echo + 4] << 8) + pkt[echo + 5]
+        pkt_ident = (pkt[echo + 6] << 8) + pkt[echo + 7]
+        if pkt_ident != self.ident or pkt_id not in self._remaining_ids:
+            return None
+        # The quoted destination has to be the one we sent that id to, so an
+        # error about some other packet can't make us drop a target.
+        try:
+            if socket.inet_pton(family, self._id_to_addr[pkt_id]) != dest:
+                return None
+        except (OSError, ValueError):
+            return None
+        return pkt_id, kind
+
+    def _match_packet(self, pkt, resp_receive_time):
+        """
+        Matches a received packet to one of the remaining requests. Returns
+        (pkt_id, rtt, None) for an echo reply, (pkt_id, None, kind) for an
+        ICMP error message about the request, and None for anything else.
+
+        """
+        try:
+            pkt_id = None
+            pkt_ident = None
+            if pkt[_ICMPV6_HDR_OFFSET] == _ICMPV6_ECHO_REPLY:
+
+                pkt_id = (pkt[_ICMPV6_ID_OFFSET] << 8) + \
+                    pkt[_ICMPV6_ID_OFFSET + 1]
+                pkt_ident = (pkt[_ICMPV6_IDENT_OFFSET] << 8) + \
+                    pkt[_ICMPV6_IDENT_OFFSET + 1]
+                payload = pkt[_ICMPV6_PAYLOAD_OFFSET:]
+
+            elif pkt[_ICMP_HDR_OFFSET] == _ICMP_ECHO_REPLY:
+
+                pkt_id = (pkt[_ICMP_ID_OFFSET] << 8) + \
+                    pkt[_ICMP_ID_OFFSET + 1]
+                pkt_ident = (pkt[_ICMP_IDENT_OFFSET] << 8) + \
+                    pkt[_ICMP_IDENT_OFFSET + 1]
+                payload = pkt[_ICMP_PAYLOAD_OFFSET:]
+
+            else:
+                # An upstream router (or the target) telling us the echo
+                # request will never be answered: fail it now instead of
+                # waiting for the timeout.
+                error = self._parse_error(pkt)
+                if error is None:
+                    return None
+                return error[0], None, error[1]
+
+            if pkt_ident == self.ident and pkt_id in self._remaining_ids:
+                # The sending timestamp was encoded in the echo request body
+                # and is now returned to us in the response. Note that network
+                # byte order doesn't matter here, since we get exactly the
+                # order of bytes back that we originally sent from this host.
+                req_sent_time = struct.unpack(
+                    "d", payload[:self._time_stamp_size])[0]
+                return pkt_id, resp_receive_time - req_sent_time, None
+        except (IndexError, struct.error):
+            # Silently ignore malformed packets
+            pass
+        return None
+
+    def burst(self, count, interval, timeout):
+        """
+        Send count echo requests to every address, interval seconds apart,
+        and collect the replies until timeout seconds after the last ones
+        were sent. Every request carries its own packet ID, which tags it
+        with its sequence number within the burst.
+
+        Returns a dict with the BurstStats of every address (names that
+        could not be looked up are left out). No more requests are sent to an
+        address after an ICMP error message about it, and this returns early
+        once every request of the last round has been answered or failed.
+
+        """
+        if count < 1:
+            raise MultiPingError("A burst needs at least one request")
+        if count * len(self._dest_addrs) > 65535:
+            raise MultiPingError("Cannot have more than 65535 echo requests "
+                                 "outstanding at the same time.")
+
+        self._receive_has_been_called = True
+        self._remaining_ids = set()
+        sequence = {}
+        rtts = {addr: [-1] * count for addr in self._dest_addrs}
+
+        for seq in range(count):
+            for pkt_id in self._send_batch([a for a in self._dest_addrs
+                                            if a not in self.errors]):
+                sequence[pkt_id] = seq
+                self._remaining_ids.add(pkt_id)
+
+            # Collect whatever comes back until the next round is due (or the
+            # timeout of the last round is over). Replies to earlier rounds
+            # arriving late are still matched to their sequence number.
+            last_round = seq == count - 1
+            deadline = time.time() + (timeout if last_round else interval)
+            while True:
+                remaining_time = deadline - time.time()
+                if remaining_time <= 0 or \
+                   (last_round and not self._remaining_ids):
+                    break
+                for pkt, resp_receive_time in \
+                        self._read_all_from_socket(remaining_time):
+                    match = self._match_packet(pkt, resp_receive_time)
+                    if match is None:
+                        continue
+                    pkt_id, rtt, kind = match
+                    addr = self._id_to_addr[pkt_id]
+                    if kind is None:
+                        rtts[addr][sequence[pkt_id]] = rtt
+                    else:
+                        self.errors[addr] = kind
+                    self._remaining_ids.discard(pkt_id)
+
+        return {addr: BurstStats(addr_rtts, self.errors.get(addr))
+                for addr, addr_rtts in rtts.items()}
+
     def receive(self, timeout):
         """
         Receive ping responses from the socket. Attempts to read responses for
@@ -397,7 +649,9 @@ class MultiPing(object):
         - Dict contains IP addresses for which we received a response and the
           time
         - List contains IP addresses for which we have not received a response,
-          yet
+          yet, including those answered with an ICMP error message (see
+          self.errors). Those are done without waiting for the timeout, so
+          this returns as soon as every address has either answered or failed.
 
         """
         if not self._id_to_addr:
@@ -424,50 +678,22 @@ class MultiPing(object):
             pkts = self._read_all_from_socket(remaining_time)
 
             for pkt, resp_receive_time in pkts:
-                # Extract the ICMP ID of the response
-
-                try:
-                    pkt_id = None
-                    pkt_ident = None
-                    if pkt[_ICMPV6_HDR_OFFSET] == _ICMPV6_ECHO_REPLY:
-
-                        pkt_id = (pkt[_ICMPV6_ID_OFFSET] << 8) + \
-                            pkt[_ICMPV6_ID_OFFSET + 1]
-                        pkt_ident = (pkt[_ICMPV6_IDENT_OFFSET] << 8) + \
-                            pkt[_ICMPV6_IDENT_OFFSET + 1]
-                        payload = pkt[_ICMPV6_PAYLOAD_OFFSET:]
-
-                    elif pkt[_ICMP_HDR_OFFSET] == _ICMP_ECHO_REPLY:
-
-                        pkt_id = (pkt[_ICMP_ID_OFFSET] << 8) + \
-                            pkt[_ICMP_ID_OFFSET + 1]
-                        pkt_ident = (pkt[_ICMP_IDENT_OFFSET] << 8) + \
-                            pkt[_ICMP_IDENT_OFFSET + 1]
-                        payload = pkt[_ICMP_PAYLOAD_OFFSET:]
-
-
-                    if pkt_ident == self.ident and \
-                       pkt_id in self._remaining_ids:
-                        # The sending timestamp was encoded in the echo request
-                        # body and is now returned to us in the response. Note
-                        # that network byte order doesn't matter here, since we
-                        # get exactly the order of bytes back that we
-                        # originally sent from this host.
-                        req_sent_time = struct.unpack(
-                            "d", payload[:self._time_stamp_size])[0]
-                        results[self._id_to_addr[pkt_id]] = \
-                            resp_receive_time - req_sent_time
-
-                        self._remaining_ids.remove(pkt_id)
-                except IndexError:
-                    # Silently ignore malformed packets
-                    pass
+                match = self._match_packet(pkt, resp_receive_time)
+                if match is None:
+                    continue
+                pkt_id, rtt, kind = match
+                if kind is None:
+                    results[self._id_to_addr[pkt_id]] = rtt
+                else:
+                    self.errors[self._id_to_addr[pkt_id]] = kind
+                self._remaining_ids.remove(pkt_id)
 
             # Calculate how much of the available overall timeout time is left
             end_time = time.time()
             remaining_time = remaining_time - (end_time - start_time)
 
         no_results_so_far = [self._id_to_addr[i] for i in self._remaining_ids]
+        no_results_so_far.extend(self.errors)
         if self._ignore_lookup_errors:
             # With this flag set, names/addresses that we couldn't look up will
             # just be added to the no-results return list. Without the flag
@@ -484,7 +710,66 @@ class MultiPing(object):
             self._sock6.close()
 
 
-def multi_ping(dest_addrs, timeout, retry=0, ignore_lookup_errors=False):
+def burst_ping(dest_addrs, count, interval, timeout, ignore_lookup_errors=False,
+               sock=None, errors=None):
+    """
+    Send a burst of 'count' echo requests to every address, 'interval'
+    seconds apart, and wait up to 'timeout' seconds after the last ones for
+    the replies.
+
+    Returns a tuple with a dict and a list, like multi_ping():
+
+    - Dict contains the BurstStats (loss percentage, min/avg/max RTT, jitter)
+      of every address the burst was sent to, including those that did not
+      answer at all
+    - List contains the addresses without a single reply (and, with
+      'ignore_lookup_errors', those that could not be looked up)
+
+    Addresses answered with an ICMP error message are not sent any more
+    requests, and are added to the 'errors' dict with the kind of error if
+    one is passed in.
+
+    The 16 bit packet ID allows at most 65535 requests outstanding at the
+    same time, so the addresses are split into chunks of 65535 // count
+    that get their bursts one after the other. Each chunk adds the time of
+    a burst.
+
+    """
+    count = int(count)
+    if count < 1:
+        raise MultiPingError("A burst needs at least one request")
+    interval = float(interval)
+    if interval < 0:
+        raise MultiPingError("Negative interval between burst requests")
+    timeout = float(timeout)
+    if timeout < 0.1:
+        raise MultiPingError("Timeout < 0.1 seconds not allowed")
+
+    dest_addrs = list(dest_addrs)
+    chunk_size = 65535 // count
+    results = {}
+    no_results = []
+    last_used_id = None
+    for start in range(0, len(dest_addrs), chunk_size):
+        mp = MultiPing(dest_addrs[start:start + chunk_size], sock=sock,
+                       ignore_lookup_errors=ignore_lookup_errors)
+        # Go on with the IDs after those of the previous chunk, so its late
+        # replies are not taken for replies to this one.
+        mp._last_used_id = last_used_id
+        chunk_results = mp.burst(count, interval, timeout)
+        last_used_id = mp._last_used_id
+        results.update(chunk_results)
+        no_results.extend(addr for addr, stats in chunk_results.items()
+                          if stats.received == 0)
+        if ignore_lookup_errors:
+            no_results.extend(mp._unprocessed_targets)
+        if errors is not None:
+            errors.update(mp.errors)
+    return results, no_results
+
+
+def multi_ping(dest_addrs, timeout, retry=0, ignore_lookup_errors=False, sock=None,
+               errors=None):
     """
     Combine send and receive measurement into single function.
 
@@ -502,6 +787,15 @@ def multi_ping(dest_addrs, timeout, retry=0, ignore_lookup_errors=False):
     names or looking up their address information will silently be ignored.
     Those targets simply appear in the 'no_results' return list.
 
+    An already opened socket (or an object behaving like one, for testing) can
+    be passed in via 'sock', it is handed over to MultiPing as is.
+
+    Addresses whose echo request is answered with an ICMP error message
+    (unreachable, administratively prohibited, time exceeded or parameter
+    problem) are in the 'no_results' return list as soon as the error arrives
+    and are not retried. If a dict is passed in via 'errors', they are added
+    to it with the kind of error.
+
     """
     retry = int(retry)
     if retry < 0:
@@ -515,7 +809,7 @@ def multi_ping(dest_addrs, timeout, retry=0, ignore_lookup_errors=False):
     if retry_timeout < 0.1:
         raise MultiPingError("Time between ping retries < 0.1 seconds")
 
-    mp = MultiPing(dest_addrs, ignore_lookup_errors=ignore_lookup_errors)
+    mp = MultiPing(dest_addrs, sock=sock, ignore_lookup_errors=ignore_lookup_errors)
 
     results = {}
     retry_count = 0
@@ -525,9 +819,11 @@ def multi_ping(dest_addrs, timeout, retry=0, ignore_lookup_errors=False):
         single_results, no_results = mp.receive(retry_timeout)
         # Add the results from the last sending of pings to the overall results
         results.update(single_results)
-        if not no_results:
-            # No addresses left? We are done.
+        if not mp._remaining_ids:
+            # No addresses left without an answer or an error? We are done.
             break
         retry_count += 1
 
+    if errors is not None:
+        errors.update(mp.errors)
     return results, no_results
\ No newline at end of file
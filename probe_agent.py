@@ -0,0 +1,101 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Lightweight probe agent: pings the uplink IPs it is given by probe_aggregator.py and streams the results back to it
+# in binary batches (see probe_protocol.py), one batch per ping cycle. Run agents in several locations so the
+# aggregator can tell problems of an MX uplink apart from problems of the path between one location and the MX.
+# Agents need no Meraki API key, only the address of the aggregator and its agent token.
+#
+# Example (as root, to be able to send ICMP packets):
+#     $ sudo python probe_agent.py --aggregator monitor.example.com:7611 --name branch-dc-2 --token s3cret
+
+import argparse
+import logging
+import select
+import socket
+import time
+
+from mping import multi_ping
+from probe_protocol import HELLO, TARGETS, RESULTS, send_frame, recv_frame, encode_hello, decode_targets, \
+    encode_results
+from selector_logging import setup_logging, log_event
+
+log = logging.getLogger('probe_agent')
+
+
+def probe_session(sock, name, token, ping_timeout, ping_retry, inter_ping_delay):
+    # runs until the connection to the aggregator fails
+    send_frame(sock, HELLO, encode_hello(name, token))
+    version = None
+    targets = None
+    while True:
+        # pick up target list updates between cycles, waiting for the first one
+        while targets is None or select.select([sock], [], [], 0)[0]:
+            frame_type, payload = recv_frame(sock)
+            if frame_type == TARGETS:
+                version, targets = decode_targets(payload)
+                log_event(log, logging.INFO, "received %d targets", len(targets), version=version,
+                          targets=len(targets))
+
+        if len(targets) == 0:
+            time.sleep(1)
+            continue
+        cycle_time = time.time()
+        icmp_errors = {}
+        responses, no_responses = multi_ping(targets, timeout=ping_timeout, retry=ping_retry,
+                                             ignore_lookup_errors=True, errors=icmp_errors)
+        send_frame(sock, RESULTS, encode_results(version, cycle_time, [responses.get(ip, -1) for ip in targets]))
+        log_event(log, logging.DEBUG, "ping cycle", responses=len(responses), no_responses=len(no_responses),
+                  icmp_errors=icmp_errors)
+        time.sleep(inter_ping_delay)
+
+
+def run(host, port, name, token, ping_timeout=.5, ping_retry=0, inter_ping_delay=.5, reconnect_delay=5):
+    while True:
+        try:
+            sock = socket.create_connection((host, port), timeout=10)
+            sock.settimeout(None)
+            log_event(log, logging.INFO, "connected to aggregator %s:%d", host, port, agent=name)
+            try:
+                probe_session(sock, name, token, ping_timeout, ping_retry, inter_ping_delay)
+            finally:
+                sock.close()
+        except (OSError, ConnectionError) as error:
+            log_event(log, logging.WARNING, "aggregator connection failed: %s, retrying in %d seconds", error,
+                      reconnect_delay, agent=name)
+        time.sleep(reconnect_delay)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Probe agent pinging uplinks for probe_aggregator.py')
+    parser.add_argument('--aggregator', required=True, help='host:port of the aggregator')
+    parser.add_argument('--name', default=socket.gethostname(), help='name of this vantage point')
+    parser.add_argument('--token', default='', help='agent token configured in the aggregator')
+    parser.add_argument('--ping-timeout', type=float, default=.5)
+    parser.add_argument('--ping-retry', type=int, default=0)
+    parser.add_argument('--inter-ping-delay', type=float, default=.5)
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--log-file', default=None)
+    args = parser.parse_args(argv)
+
+    setup_logging('probe_agent', level=args.log_level, log_file=args.log_file)
+    host, _, port = args.aggregator.rpartition(':')
+    run(host, int(port), args.name, args.token, args.ping_timeout, args.ping_retry, args.inter_ping_delay)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Central aggregator for probe_agent.py agents running in several locations.
+#
+# It reads the inventory from the Dashboard like MX_uplink_monitor_selector.py, hands the list of uplink IPs to every
+# connected agent and collects their ping results. The latest batch of every agent is kept, and every
+# aggregation_interval seconds, once every connected agent sent a batch since the previous evaluation, the batches
+# are combined per uplink IP and the devices are evaluated with the combined values by the same WAN_device logic and
+# settings as MX_uplink_monitor_selector.py, so a problem on the path between a single agent and an MX does not
+# trigger a failover. An agent that sent nothing for agent_max_age seconds counts as missing rather than holding up
+# the others, but at least loss_quorum agents (all of them if fewer are connected) have to take part:
+#   'median' : the median of the agents' results, where a lost ping counts as infinitely slow. An uplink is lost only
+#              when more than half of the agents lost it
+#   'quorum' : the uplink is lost when at least loss_quorum agents lost it (all of them if fewer agents reported),
+#              otherwise its RTT is the median of the replies
+#
+# Example:
+#     $ python probe_aggregator.py
+# and then in every location:
+#     $ sudo python probe_agent.py --aggregator <this host>:7611 --name <location> --token <agent_token>
+
+import hmac
+import logging
+import socketserver
+import statistics
+import threading
+import time
+
+import MX_uplink_monitor_selector as selector
+from probe_protocol import HELLO, TARGETS, RESULTS, send_frame, recv_frame, decode_hello, encode_targets, \
+    decode_results
+from selector_logging import log_event
+
+# address and TCP port the aggregator listens on for agents
+aggregator_address=('0.0.0.0', 7611)
+
+# agent_token: agents have to present this token to be accepted. It is sent in the clear, so also restrict access to
+# the port to the agents' addresses
+agent_token=''
+
+# aggregation is 'median' or 'quorum', see above
+aggregation='median'
+loss_quorum=2
+
+# number of seconds between evaluations of the devices with the results received from the agents
+aggregation_interval=1.0
+
+# number of seconds after its last batch of results (or connecting) a connected agent is left out of the evaluations
+# until it sends results again
+agent_max_age=5.0
+
+# number of seconds between inventory refreshes from the Dashboard
+inventory_refresh_interval=3600
+
+AGGREGATIONS = ('median', 'quorum')
+
+log = selector.log
+
+
+def combine_results(values, mode='median', quorum=2):
+    """
+    Combines the results of one uplink IP from several agents (RTT in seconds, or a negative value if lost) into the
+    single value WAN_device.uplink_selector() expects: an RTT or -1.
+    """
+    replies = sorted(value for value in values if value >= 0)
+    lost = len(values) - len(replies)
+    if mode == 'quorum':
+        if lost >= min(quorum, len(values)):
+            return -1
+        return statistics.median(replies)
+    if mode != 'median':
+        raise ValueError("Unknown aggregation %r, must be one of %s" % (mode, AGGREGATIONS))
+    # lost pings sort after every reply; for an even number of agents the lower middle value is used
+    middle = (len(values) - 1) // 2
+    return replies[middle] if middle < len(replies) else -1
+
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.send_lock = threading.Lock()
+
+    def send(self, frame_type, payload):
+        with self.send_lock:
+            send_frame(self.request, frame_type, payload)
+
+    def handle(self):
+        aggregator = self.server.aggregator
+        try:
+            frame_type, payload = recv_frame(self.request)
+            if frame_type != HELLO:
+                return
+            name, token = decode_hello(payload)
+            if not hmac.compare_digest(token.encode('utf-8'), aggregator.token.encode('utf-8')):
+                log.warning("agent %s at %s presented a wrong token, disconnecting", name, self.client_address[0])
+                return
+            aggregator.register(name, self)
+            try:
+                while True:
+                    frame_type, payload = recv_frame(self.request)
+                    if frame_type == RESULTS:
+                        aggregator.submit(name, *decode_results(payload))
+            finally:
+                aggregator.unregister(name, self)
+        except (ConnectionError, OSError, ValueError):
+            pass
+
+
+class _AgentServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Aggregator(object):
+
+    def __init__(self, address, token, mode='median', quorum=2, max_age=5.0, clock=time.monotonic):
+        if mode not in AGGREGATIONS:
+            raise ValueError("Unknown aggregation %r, must be one of %s" % (mode, AGGREGATIONS))
+        self.token = token
+        self.mode = mode
+        self.quorum = quorum
+        self.max_age = max_age
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.targets = []
+        self.version = 0
+        self.agents = {}
+        # per agent, its latest batch of results as [cycle_time, values, fresh], fresh until it is combined
+        self._latest = {}
+        # per agent, clock() when its latest batch arrived or it connected
+        self._seen = {}
+        # whether the last evaluation was held back for missing the quorum of agents
+        self._short = False
+        self.server = _AgentServer(address, _AgentHandler)
+        self.server.aggregator = self
+        self.address = self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='agent-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def register(self, name, handler):
+        with self._lock:
+            self.agents[name] = handler
+            self._seen[name] = self.clock()
+            handler.send(TARGETS, encode_targets(self.version, self.targets))
+        log_event(log, logging.INFO, "agent %s connected", name, agent=name, address=handler.client_address[0])
+
+    def unregister(self, name, handler):
+        with self._lock:
+            if self.agents.get(name) is handler:
+                del self.agents[name]
+                self._latest.pop(name, None)
+                self._seen.pop(name, None)
+        log_event(log, logging.WARNING, "agent %s disconnected", name, agent=name)
+
+    def set_targets(self, targets):
+        with self._lock:
+            self.version += 1
+            self.targets = list(targets)
+            self._latest = {}
+            payload = encode_targets(self.version, self.targets)
+            for handler in list(self.agents.values()):
+                try:
+                    handler.send(TARGETS, payload)
+                except OSError:
+                    pass
+
+    def submit(self, name, version, cycle_time, values):
+        with self._lock:
+            # results for an older target list can not be matched to the current one
+            if version == self.version and len(values) == len(self.targets) and name in self.agents:
+                self._latest[name] = [cycle_time, values, True]
+                self._seen[name] = self.clock()
+
+    def combine(self):
+        """
+        Returns (responses, no_responses, agents) in the form multi_ping() returns them, combining the batches of the
+        agents, or None while a connected agent that is not stale has yet to send a batch newer than the one last
+        combined, or fewer than quorum agents (all of them if fewer are connected) have.
+        """
+        with self._lock:
+            now = self.clock()
+            batches = []
+            for name in self.agents:
+                if now - self._seen[name] > self.max_age:
+                    # stale, missing from this evaluation
+                    continue
+                latest = self._latest.get(name)
+                if latest is None or not latest[2]:
+                    # its next batch is still to come
+                    return None
+                batches.append(latest)
+            if not batches or len(batches) < min(self.quorum, len(self.agents)):
+                if batches and not self._short:
+                    self._short = True
+                    log_event(log, logging.WARNING, "only %d of %d agents sent results, not evaluating the devices",
+                              len(batches), len(self.agents), agents=len(batches), connected=len(self.agents))
+                return None
+            self._short = False
+            for latest in batches:
+                latest[2] = False
+            batches = [values for _, values, _ in batches]
+            targets = self.targets
+        responses = {}
+        no_responses = []
+        for index, target in enumerate(targets):
+            value = combine_results([batch[index] for batch in batches], self.mode, self.quorum)
+            if value >= 0:
+                responses[target] = value
+            else:
+                no_responses.append(target)
+        return responses, no_responses, len(batches)
+
+    def cycle(self):
+        # evaluates every device with the combined results, returns the number of devices evaluated
+        combined = self.combine()
+        if combined is None:
+            return 0
+        responses, no_responses, agents = combined
+        log_event(log, logging.INFO, "aggregation cycle", agents=agents, responses=len(responses),
+                  no_responses=len(no_responses))
+        return selector.evaluate_cycle(responses, no_responses)
+
+
+def refresh_targets(aggregator):
+    selector.refreshDevicesDict()
+    aggregator.set_targets(selector.allUplinkIPs)
+    log_event(log, logging.INFO, "Monitoring %d devices", len(selector.allMXDevices), devices=len(selector.allMXDevices),
+              targets=len(selector.allUplinkIPs))
+
+
+def main():
+    # agents ping every uplink in every cycle, so adaptive probing does not apply here
+    selector.adaptive_probing = False
+    aggregator = Aggregator(aggregator_address, agent_token, aggregation, loss_quorum, agent_max_age).start()
+    refresh_targets(aggregator)
+    last_refresh = time.monotonic()
+    while True:
+        time.sleep(aggregation_interval)
+        aggregator.cycle()
+        if time.monotonic() - last_refresh >= inventory_refresh_interval:
+            refresh_targets(aggregator)
+            last_refresh = time.monotonic()
+
+
+if __name__ == '__main__':
+    main()
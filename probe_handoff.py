@@ -0,0 +1,125 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Double-buffered hand-off of ping results from the probe thread of MX_uplink_monitor_selector.py to the evaluation of
+# the devices in the main thread. The probe thread fills one of two preallocated ProbeResult buffers per ping cycle
+# and publishes it, while the main thread evaluates the other one, so the ping cadence does not depend on how long
+# evaluation and logging take. When evaluation falls behind, the results it did not get to are replaced by newer
+# ones; how many were dropped and how old results were when evaluated is kept as the evaluation backlog.
+
+import threading
+import time
+
+
+class ProbeResult(object):
+    __slots__ = ('cycle_time', 'started', 'waited', 'published', 'inventory', 'dueSerials', 'responses', 'no_responses')
+
+    def __init__(self):
+        self.cycle_time = 0.0
+        # time.monotonic() at the start of the ping cycle, for cycle_budget
+        self.started = 0.0
+        # seconds spent in the ICMP call, for cycle_budget
+        self.waited = 0.0
+        self.published = 0.0
+        self.inventory = 0
+        self.dueSerials = None
+        self.responses = {}
+        self.no_responses = []
+
+
+class ProbeHandoff(object):
+    """
+    The probe thread calls back() to get the buffer to fill and publish() when done with it, the evaluating thread
+    calls take() to get the latest published buffer and release() when done with it.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buffers = (ProbeResult(), ProbeResult())
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._writing = None
+        self._pending = None
+        self._reading = None
+        # on_drop, if set, is called with every ProbeResult that gets replaced before it was evaluated
+        self.on_drop = None
+        self.published = 0
+        self.evaluated = 0
+        self.dropped = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def back(self):
+        with self._lock:
+            free = 1 if self._reading == 0 else 0
+            if free == self._pending and self._reading is None:
+                free = 1 - free
+            if free == self._pending:
+                # the only buffer not being evaluated holds results nobody got to yet
+                self._pending = None
+                self._ready.clear()
+                self._drop(self._buffers[free])
+            self._writing = free
+            return self._buffers[free]
+
+    def publish(self):
+        with self._lock:
+            if self._pending is not None:
+                self._drop(self._buffers[self._pending])
+            self._pending = self._writing
+            self._writing = None
+            self._buffers[self._pending].published = self.clock()
+            self.published += 1
+            self._ready.set()
+
+    def _drop(self, result):
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(result)
+
+    def take(self, timeout=None):
+        """
+        Waits up to timeout seconds for published results, returns them or None.
+        """
+        if not self._ready.wait(timeout):
+            return None
+        with self._lock:
+            if self._pending is None:
+                return None
+            self._reading = self._pending
+            self._pending = None
+            self._ready.clear()
+            result = self._buffers[self._reading]
+        lag = self.clock() - result.published
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        return result
+
+    def release(self):
+        with self._lock:
+            self._reading = None
+            self.evaluated += 1
+
+    def backlog(self):
+        # number of published results waiting to be evaluated (0 or 1)
+        with self._lock:
+            return 0 if self._pending is None else 1
+
+    def stats(self):
+        return {'published': self.published, 'evaluated': self.evaluated, 'dropped': self.dropped,
+                'backlog': self.backlog(),
+                'mean_lag': self.total_lag / self.evaluated if self.evaluated else 0.0, 'max_lag': self.max_lag}
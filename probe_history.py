@@ -0,0 +1,382 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Probe history of MX_uplink_monitor_selector.py: the ping results of every uplink and every uplink decision are
+# appended as fixed size records to memory-mapped segment files, so the history of an incident is still around long
+# after it left the trouble_eval_window. A history directory holds four series:
+#   raw/     one sample per uplink and ping cycle: pings sent and received, min/avg/max RTT of the replies
+#   1m/      the raw samples aggregated per minute and uplink by a background downsampler
+#   1h/      the minute aggregates aggregated per hour
+#   events/  failovers, failbacks, load balancing toggles and the other state changes of the devices
+# Appending is a struct.pack_into() into the mapped segment, so it costs the monitoring loop a few microseconds and
+# no system call. A series rotates to a new segment file every segment_records records and keeps the newest
+# max_segments of them, so the aggregates go back 60 and 3600 times further than the raw samples.
+# Records are appended in time order, so range queries bisect the mapped segments and only touch the pages holding
+# the records asked for, without reading the files in.
+#
+# Example, everything kept about a device during an incident, per minute:
+#     $ python probe_history.py history/ Q2XX-XXXX-XXXX --start 2020-06-01T10:00:00 --end 2020-06-01T12:00:00 \
+#           --resolution 1m
+
+import argparse
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+from selector_logging import log_event
+
+RESOLUTIONS = {'raw': None, '1m': 60, '1h': 3600}
+
+_MAGIC = b'MXHS'
+_VERSION = 1
+# magic, version, record size and number of records written
+_SEGMENT_HEADER = struct.Struct('<4sBxHQ')
+# time, serial, uplink (1, 2, ...), pings sent and received, min/avg/max RTT of the replies (NaN without replies).
+# Aggregates use the same record with the start of their minute or hour as time
+_SAMPLE = struct.Struct('<d24sB3xIIfff')
+# time, serial, event, default uplink ('' if not part of the event), load balancing (-1 if not part of the event)
+_EVENT = struct.Struct('<d24s24s12sb3x')
+_TIME = struct.Struct('<d')
+
+_NAN = float('nan')
+
+
+class _Segment(object):
+
+    def __init__(self, path, record_size, records=None):
+        """
+        Maps the segment file at path, creating it with room for records records if records is given.
+        """
+        if records is not None:
+            with open(path, 'wb') as segment_file:
+                segment_file.write(_SEGMENT_HEADER.pack(_MAGIC, _VERSION, record_size, 0))
+                segment_file.truncate(_SEGMENT_HEADER.size + records * record_size)
+        with open(path, 'r+b') as segment_file:
+            self.map = mmap.mmap(segment_file.fileno(), 0)
+        magic, version, size, self.count = _SEGMENT_HEADER.unpack_from(self.map, 0)
+        if magic != _MAGIC or version != _VERSION or size != record_size:
+            self.map.close()
+            raise ValueError("%s is not a history segment with %d byte records" % (path, record_size))
+        self.path = path
+        self.record_size = record_size
+        self.capacity = (len(self.map) - _SEGMENT_HEADER.size) // record_size
+
+    def offset(self, index):
+        return _SEGMENT_HEADER.size + index * self.record_size
+
+    def time_at(self, index):
+        return _TIME.unpack_from(self.map, self.offset(index))[0]
+
+    def search(self, t):
+        # index of the first record at or after t
+        count = self.count
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.time_at(middle) < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def commit(self, count):
+        # the record is written before the count that makes it visible to readers
+        self.count = count
+        struct.pack_into('<Q', self.map, 8, count)
+
+
+class Series(object):
+    """
+    An append-only, time ordered series of fixed size records in rotating memory-mapped segment files. A single
+    thread appends, any number of threads can query at the same time.
+    """
+
+    def __init__(self, directory, record, segment_records, max_segments):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.record = record
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._segments = []
+        self._sequences = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.seg'):
+                self._segments.append(_Segment(os.path.join(directory, name), record.size))
+                self._sequences.append(int(name[:-4]))
+
+    def _rotate(self):
+        sequence = self._sequences[-1] + 1 if self._sequences else 0
+        segment = _Segment(os.path.join(self.directory, '%012d.seg' % sequence), self.record.size,
+                           self.segment_records)
+        with self._lock:
+            self._segments.append(segment)
+            self._sequences.append(sequence)
+            while len(self._segments) > self.max_segments:
+                # a query still going through the oldest segment keeps its mapping, unlinking the file is enough
+                os.remove(self._segments.pop(0).path)
+                self._sequences.pop(0)
+        return segment
+
+    def append(self, *values):
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.count >= segment.capacity:
+            segment = self._rotate()
+        self.record.pack_into(segment.map, segment.offset(segment.count), *values)
+        segment.commit(segment.count + 1)
+
+    def segments(self):
+        with self._lock:
+            return list(zip(self._sequences, self._segments))
+
+    def last(self):
+        for _, segment in reversed(self.segments()):
+            if segment.count:
+                return self.record.unpack_from(segment.map, segment.offset(segment.count - 1))
+        return None
+
+    def range(self, start, end, key=None, key_offset=8):
+        """
+        Yields the records from start (included) to end (excluded) as tuples. With key, only the records whose bytes
+        at key_offset equal key (a serial padded like the records, for example) are unpacked.
+        """
+        unpack_from = self.record.unpack_from
+        size = self.record.size
+        for _, segment in self.segments():
+            count = segment.count
+            if count == 0 or segment.time_at(count - 1) < start:
+                continue
+            if segment.time_at(0) >= end:
+                break
+            data = segment.map
+            offset = segment.offset(segment.search(start))
+            stop = segment.offset(count)
+            while offset < stop:
+                if _TIME.unpack_from(data, offset)[0] >= end:
+                    return
+                if key is None or data[offset + key_offset:offset + key_offset + len(key)] == key:
+                    yield unpack_from(data, offset)
+                offset += size
+
+    def read_from(self, cursor):
+        """
+        Returns the records appended since cursor, a (segment sequence, index) tuple, and the cursor to continue from.
+        """
+        sequence, index = cursor
+        records = []
+        for segment_sequence, segment in self.segments():
+            if segment_sequence < sequence:
+                continue
+            if segment_sequence > sequence:
+                # the rest of the segment the cursor was in was read, or it was rotated out before it could be
+                sequence, index = segment_sequence, 0
+            count = segment.count
+            offset = segment.offset(index)
+            for _ in range(count - index):
+                records.append(self.record.unpack_from(segment.map, offset))
+                offset += self.record.size
+            index = count
+        return records, (sequence, index)
+
+    def cursor_at(self, t):
+        # the cursor of the first record at or after t
+        segments = self.segments()
+        for sequence, segment in segments:
+            if segment.count and segment.time_at(segment.count - 1) >= t:
+                return sequence, segment.search(t)
+        if segments:
+            return segments[-1][0], segments[-1][1].count
+        return 0, 0
+
+    def close(self):
+        for _, segment in self.segments():
+            segment.map.flush()
+            segment.map.close()
+
+
+def _padded(value, size):
+    return ('' if value is None else value).encode('utf8')[:size].ljust(size, b'\0')
+
+
+def _text(value):
+    return value.rstrip(b'\0').decode('utf8', 'replace')
+
+
+class _Rollup(object):
+    """
+    Aggregates the sample records of the source series into buckets of width seconds of the target series. A bucket is
+    written once a source record at or after its end has been read, so the target stays in time order.
+    """
+
+    def __init__(self, source, target, width):
+        self.source = source
+        self.target = target
+        self.width = width
+        last = target.last()
+        # start over from the first source record not aggregated yet
+        self.cursor = source.cursor_at(0 if last is None else last[0] + width)
+        self.buckets = {}
+
+    def run(self):
+        records, self.cursor = self.source.read_from(self.cursor)
+        if not records:
+            return 0
+        buckets = self.buckets
+        width = self.width
+        for t, serial, uplink, sent, received, rtt_min, rtt_avg, rtt_max in records:
+            key = (t // width * width, serial, uplink)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [0, 0, _NAN, 0.0, _NAN]
+            bucket[0] += sent
+            if received:
+                # min() and max() ignore the NaN of an empty bucket when it comes first
+                bucket[2] = rtt_min if math.isnan(bucket[2]) else min(bucket[2], rtt_min)
+                bucket[4] = rtt_max if math.isnan(bucket[4]) else max(bucket[4], rtt_max)
+                bucket[3] += rtt_avg * received
+                bucket[1] += received
+        complete = records[-1][0] // width * width
+        written = 0
+        for key in sorted(key for key in buckets if key[0] < complete):
+            sent, received, rtt_min, rtt_sum, rtt_max = buckets.pop(key)
+            self.target.append(key[0], key[1], key[2], sent, received, rtt_min,
+                               rtt_sum / received if received else _NAN, rtt_max)
+            written += 1
+        return written
+
+
+class HistoryStore(object):
+
+    def __init__(self, log, directory, segment_records=262144, max_segments=16, downsample_interval=30):
+        self.log = log
+        self.directory = directory
+        self.downsample_interval = downsample_interval
+        self.series = {resolution: Series(os.path.join(directory, resolution), _SAMPLE, segment_records, max_segments)
+                       for resolution in RESOLUTIONS}
+        self.events = Series(os.path.join(directory, 'events'), _EVENT, segment_records, max_segments)
+        self._raw = self.series['raw']
+        self._serials = {}
+        self._rollups = [_Rollup(self.series['raw'], self.series['1m'], RESOLUTIONS['1m']),
+                         _Rollup(self.series['1m'], self.series['1h'], RESOLUTIONS['1h'])]
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _serial(self, serial):
+        padded = self._serials.get(serial)
+        if padded is None:
+            padded = self._serials[serial] = _padded(serial, 24)
+        return padded
+
+    def record_sample(self, t, serial, uplink, sent, replies):
+        # replies are the RTTs of the pings answered out of the sent ones
+        if replies:
+            self._raw.append(t, self._serial(serial), uplink, sent, len(replies), min(replies),
+                             sum(replies) / len(replies), max(replies))
+        else:
+            self._raw.append(t, self._serial(serial), uplink, sent, 0, _NAN, _NAN, _NAN)
+
+    def record_event(self, t, serial, event, uplink=None, load_balancing=None):
+        self.events.append(t, self._serial(serial), _padded(event, 24), _padded(uplink, 12),
+                           -1 if load_balancing is None else int(bool(load_balancing)))
+
+    def samples(self, serial, start, end, resolution='raw', uplink=None):
+        """
+        Returns the samples of serial from start to end at the given resolution ('raw', '1m' or '1h') as dicts.
+        """
+        samples = []
+        for t, _, sample_uplink, sent, received, rtt_min, rtt_avg, rtt_max in \
+                self.series[resolution].range(start, end, self._serial(serial)):
+            if uplink is not None and sample_uplink != uplink:
+                continue
+            samples.append({'t': t, 'uplink': sample_uplink, 'sent': sent, 'received': received,
+                            'loss_percent': 100.0 * (sent - received) / sent if sent else 0.0,
+                            'rtt_min': None if received == 0 else rtt_min,
+                            'rtt_avg': None if received == 0 else rtt_avg,
+                            'rtt_max': None if received == 0 else rtt_max})
+        return samples
+
+    def device_events(self, serial, start, end):
+        # the events of serial from start to end as dicts, all devices' if serial is None
+        return [{'t': t, 'serial': _text(event_serial), 'event': _text(event), 'uplink': _text(uplink) or None,
+                 'load_balancing': None if load_balancing < 0 else bool(load_balancing)}
+                for t, event_serial, event, uplink, load_balancing in
+                self.events.range(start, end, None if serial is None else self._serial(serial))]
+
+    def downsample(self):
+        # rolls the raw samples appended since the last call into minute aggregates, and those into hour aggregates
+        return sum(rollup.run() for rollup in self._rollups)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='history-downsampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.downsample_interval):
+            try:
+                self.downsample()
+            except Exception:
+                log_event(self.log, logging.ERROR, "downsampling the probe history failed", exc_info=True)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for series in list(self.series.values()) + [self.events]:
+            series.close()
+
+
+def parse_time(value):
+    # seconds since the epoch or an ISO 8601 local time such as 2020-06-01T10:00:00
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the probe history kept by MX_uplink_monitor_selector.py')
+    parser.add_argument('directory', help='history directory of the selector (history_dir)')
+    parser.add_argument('serial', help='serial of the device')
+    parser.add_argument('--start', type=parse_time, default=0.0, help='epoch seconds or ISO 8601 local time')
+    parser.add_argument('--end', type=parse_time, default=None, help='epoch seconds or ISO 8601 local time')
+    parser.add_argument('--resolution', choices=sorted(RESOLUTIONS), default='raw')
+    parser.add_argument('--uplink', type=int, default=None, help='only this uplink number (1 for WAN1, ...)')
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(logging.getLogger('probe_history'), args.directory)
+    end = time.time() if args.end is None else args.end
+    rows = [(sample['t'], 'sample', 'uplink%d sent=%d received=%d loss=%.1f%% rtt min/avg/max=%s/%s/%s' % (
+                sample['uplink'], sample['sent'], sample['received'], sample['loss_percent'],
+                *('-' if value is None else '%.1fms' % (value * 1000)
+                  for value in (sample['rtt_min'], sample['rtt_avg'], sample['rtt_max']))))
+            for sample in store.samples(args.serial, args.start, end, args.resolution, args.uplink)]
+    rows += [(event['t'], 'event', '%s uplink=%s load_balancing=%s' % (event['event'], event['uplink'],
+                                                                       event['load_balancing']))
+             for event in store.device_events(args.serial, args.start, end)]
+    for t, kind, text in sorted(rows, key=lambda row: row[0]):
+        print('%s %-6s %s' % (datetime.fromtimestamp(t).isoformat(timespec='milliseconds'), kind, text))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Binary framing used between probe_agent.py and probe_aggregator.py over TCP.
+#
+# Every frame is a 1 byte type and a 4 byte payload length (network byte order) followed by the payload:
+#   HELLO   agent -> aggregator: UTF-8 "<agent name>\n<token>"
+#   TARGETS aggregator -> agent: 4 byte target list version, then the uplink IPs to ping as UTF-8, one per line
+#   RESULTS agent -> aggregator: 4 byte target list version, 8 byte cycle start time (double), then one 4 byte float
+#           per target in target list order: the RTT in seconds, or -1 if the target did not answer
+# so a batch of results for 10000 uplinks is about 40KB.
+
+import struct
+
+HELLO = 1
+TARGETS = 2
+RESULTS = 3
+
+# frames larger than this are treated as a protocol error
+MAX_FRAME = 16 * 1024 * 1024
+
+_HEADER = struct.Struct('!BI')
+_VERSION = struct.Struct('!I')
+_RESULTS_HEADER = struct.Struct('!Id')
+
+
+def send_frame(sock, frame_type, payload):
+    sock.sendall(_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    """
+    Returns (frame type, payload) of the next frame, raising ConnectionError when the connection is closed.
+    """
+    frame_type, size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionError("frame of %d bytes is too large" % size)
+    return frame_type, _recv_exactly(sock, size)
+
+
+def encode_hello(name, token):
+    return ('%s\n%s' % (name, token)).encode('utf-8')
+
+
+def decode_hello(payload):
+    name, _, token = payload.decode('utf-8').partition('\n')
+    return name, token
+
+
+def encode_targets(version, targets):
+    return _VERSION.pack(version) + '\n'.join(targets).encode('utf-8')
+
+
+def decode_targets(payload):
+    version, = _VERSION.unpack_from(payload)
+    text = payload[_VERSION.size:].decode('utf-8')
+    return version, text.split('\n') if text else []
+
+
+def encode_results(version, cycle_time, values):
+    return _RESULTS_HEADER.pack(version, cycle_time) + struct.pack('!%df' % len(values), *values)
+
+
+def decode_results(payload):
+    version, cycle_time = _RESULTS_HEADER.unpack_from(payload)
+    count = (len(payload) - _RESULTS_HEADER.size) // 4
+    return version, cycle_time, struct.unpack_from('!%df' % count, payload, _RESULTS_HEADER.size)
@@ -0,0 +1,234 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Compact binary log of everything the selectors base their decisions on, so those decisions can be replayed
+# later (see replay.py) with different thresholds.
+#
+# A log is a header followed by fixed size, little endian records, each starting with a one byte record type:
+#   'S' string table entry:  id, length, utf8 bytes  (serials, network IDs and IPs are only written once)
+#   'V' device:              serial, networkId, uplink1 IP, uplink2 IP (string ids), current uplink, LB, NLB flags
+#   'U' extra uplink:        serial, uplink (3 and up), name and IP (string ids) of a device's uplinks after WAN2
+#   'C' cycle:               time of a monitoring cycle, the records that follow belong to it
+#   'P' ping result:         serial, uplink (1, 2, ...), RTT in seconds, -1 for loss, NaN when not configured
+#   'B' burst result:        serial, uplink, number of pings and the RTT of each of them, -1 for loss
+#   'D' Dashboard sample:    serial, uplink, sample timestamp, loss percent and latency ms (NaN for null)
+#   'A' uplink change:       time, networkId, default uplink (the N of wanN), load balancing flag
+#
+# The only record without a fixed size is 'B', its RTTs follow it. Version 1 logs (written before 'U' records existed)
+# and version 2 logs (before 'B' records) are still read.
+#
+# A selector restarting with the same record_file appends to it, numbering its string ids from 0 again: a string
+# table entry replaces the earlier one with the same id for the records after it. Logs written by separate runs can
+# also be concatenated, the headers of the later ones start a new string table.
+
+import math
+import struct
+
+LOG_MAGIC = b'MXRL'
+LOG_VERSION = 3
+READ_VERSIONS = (1, 2, 3)
+
+_HEADER = struct.Struct('<4sB10s')
+_STRING = struct.Struct('<cIH')
+_DEVICE = struct.Struct('<cIIIIBBB')
+_UPLINK = struct.Struct('<cIBII')
+_CYCLE = struct.Struct('<cd')
+_PING = struct.Struct('<cIBf')
+_BURST = struct.Struct('<cIBH')
+_POINT = struct.Struct('<cIBdff')
+_ACTION = struct.Struct('<cdIBB')
+
+_NONE = float('nan')
+
+
+class ProbeRecorderError(Exception):
+    pass
+
+
+class ProbeRecorder(object):
+
+    def __init__(self, path, kind, buffer_size=1 << 20):
+        """
+        Opens path for appending records. kind is 'icmp' or 'dashboard' and tells replay.py which selector the
+        log belongs to; the header saying so is written when the file is new or empty, an existing log must be of
+        the same kind. Records are collected in a large write buffer, call flush() to force them to disk.
+        """
+        kind = kind.encode('ascii')
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(_HEADER.pack(LOG_MAGIC, LOG_VERSION, kind))
+        else:
+            with open(path, 'rb') as log_file:
+                header = log_file.read(_HEADER.size)
+            if len(header) < _HEADER.size or _HEADER.unpack(header)[0] != LOG_MAGIC or \
+                    _HEADER.unpack(header)[2].rstrip(b'\0') != kind:
+                self._file.close()
+                raise ProbeRecorderError("%s is not a %s probe log to append to" % (path, kind.decode('ascii')))
+        self._string_ids = {}
+        self._last_point_ts = {}
+
+    def _string_id(self, value):
+        value = '' if value is None else value
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = len(self._string_ids)
+            self._string_ids[value] = string_id
+            encoded = value.encode('utf8')
+            self._file.write(_STRING.pack(b'S', string_id, len(encoded)) + encoded)
+        return string_id
+
+    def record_device(self, serial, networkId, uplink1_ip, uplink2_ip, current_uplink=1, is_load_balancing=True,
+                      is_NLB=False):
+        self._file.write(_DEVICE.pack(b'V', self._string_id(serial), self._string_id(networkId),
+                                      self._string_id(uplink1_ip), self._string_id(uplink2_ip), current_uplink,
+                                      bool(is_load_balancing), bool(is_NLB)))
+
+    def record_uplink(self, serial, uplink, name, ip):
+        self._file.write(_UPLINK.pack(b'U', self._string_id(serial), uplink, self._string_id(name),
+                                      self._string_id(ip)))
+
+    def record_cycle(self, t):
+        self._file.write(_CYCLE.pack(b'C', t))
+
+    def record_pings(self, responsesPerSerial):
+        # responsesPerSerial is the same dict handed to WAN_device.uplink_selector() in the ping variant, the values
+        # are RTTs or, with bursts, mping.BurstStats
+        write = self._file.write
+        pack = _PING.pack
+        for serial, values in responsesPerSerial.items():
+            serial_id = self._string_id(serial)
+            for uplink, value in enumerate(values, 1):
+                rtts = getattr(value, 'rtts', None)
+                if rtts is not None:
+                    write(_BURST.pack(b'B', serial_id, uplink, len(rtts)) + struct.pack('<%df' % len(rtts), *rtts))
+                else:
+                    write(pack(b'P', serial_id, uplink, _NONE if value is None else value))
+
+    def record_points(self, serial, uplink, timeSeries, parse_ts):
+        # Dashboard samples repeat in every call for 5 minutes, only the ones newer than what we already wrote
+        # for this serial and uplink are recorded. The ISO 8601 'ts' strings sort chronologically so they can be
+        # compared as is, parse_ts turns new ones into the timestamps the selector compares against.
+        if not timeSeries:
+            return
+        key = (serial, uplink)
+        last_ts = self._last_point_ts.get(key, '')
+        newest_ts = last_ts
+        serial_id = self._string_id(serial)
+        for tsEntry in timeSeries:
+            ts = tsEntry['ts']
+            if ts <= last_ts:
+                continue
+            loss = tsEntry.get('lossPercent')
+            latency = tsEntry.get('latencyMs')
+            self._file.write(_POINT.pack(b'D', serial_id, uplink, parse_ts(ts), _NONE if loss is None else loss,
+                                         _NONE if latency is None else latency))
+            if ts > newest_ts:
+                newest_ts = ts
+        self._last_point_ts[key] = newest_ts
+
+    def record_action(self, t, networkId, default_uplink, load_balancing):
+        self._file.write(_ACTION.pack(b'A', t, self._string_id(networkId), int(default_uplink[3:]),
+                                      bool(load_balancing)))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _none_if_nan(value):
+    return None if math.isnan(value) else value
+
+
+def read_log(path):
+    """
+    Returns the kind of the log ('icmp' or 'dashboard') and a list of decoded records as tuples, with all string
+    ids resolved:
+        ('V', serial, networkId, uplink1_ip, uplink2_ip, current_uplink, is_load_balancing, is_NLB)
+        ('U', serial, uplink, name, ip)
+        ('C', t)
+        ('P', serial, uplink, value)          value is the RTT, -1 for loss or None
+        ('B', serial, uplink, rtts)           rtts is the list of RTTs of a burst, -1 for loss
+        ('D', serial, uplink, ts, loss, latency)
+        ('A', t, networkId, default_uplink, load_balancing)
+    """
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+    if len(data) < _HEADER.size:
+        raise ProbeRecorderError("%s is not a probe log" % path)
+    magic, version, kind = _HEADER.unpack_from(data, 0)
+    if magic != LOG_MAGIC or version not in READ_VERSIONS:
+        raise ProbeRecorderError("%s is not a version %s probe log" % (path, ' or '.join(map(str, READ_VERSIONS))))
+
+    strings = {}
+    records = []
+    append = records.append
+    offset = _HEADER.size
+    end = len(data)
+    try:
+        while offset < end:
+            record_type = data[offset:offset + 1]
+            if record_type == b'P':
+                _, serial_id, uplink, value = _PING.unpack_from(data, offset)
+                offset += _PING.size
+                append(('P', strings[serial_id], uplink, _none_if_nan(value)))
+            elif record_type == b'B':
+                _, serial_id, uplink, count = _BURST.unpack_from(data, offset)
+                offset += _BURST.size
+                rtts = list(struct.unpack_from('<%df' % count, data, offset))
+                offset += 4 * count
+                append(('B', strings[serial_id], uplink, rtts))
+            elif record_type == b'C':
+                append(('C', _CYCLE.unpack_from(data, offset)[1]))
+                offset += _CYCLE.size
+            elif record_type == b'D':
+                _, serial_id, uplink, ts, loss, latency = _POINT.unpack_from(data, offset)
+                offset += _POINT.size
+                append(('D', strings[serial_id], uplink, ts, _none_if_nan(loss), _none_if_nan(latency)))
+            elif record_type == b'S':
+                _, string_id, length = _STRING.unpack_from(data, offset)
+                offset += _STRING.size
+                strings[string_id] = data[offset:offset + length].decode('utf8')
+                offset += length
+            elif record_type == LOG_MAGIC[:1]:
+                # the header of a log appended to this one: its string ids are its own
+                magic, version, appended_kind = _HEADER.unpack_from(data, offset)
+                if magic != LOG_MAGIC or version not in READ_VERSIONS or appended_kind != kind:
+                    raise ProbeRecorderError("Unexpected header at offset %d in %s" % (offset, path))
+                offset += _HEADER.size
+                strings = {}
+            elif record_type == b'V':
+                _, serial_id, network_id, ip1_id, ip2_id, current_uplink, is_lb, is_nlb = \
+                    _DEVICE.unpack_from(data, offset)
+                offset += _DEVICE.size
+                append(('V', strings[serial_id], strings[network_id], strings[ip1_id] or None,
+                        strings[ip2_id] or None, current_uplink, bool(is_lb), bool(is_nlb)))
+            elif record_type == b'U':
+                _, serial_id, uplink, name_id, ip_id = _UPLINK.unpack_from(data, offset)
+                offset += _UPLINK.size
+                append(('U', strings[serial_id], uplink, strings[name_id], strings[ip_id] or None))
+            elif record_type == b'A':
+                _, t, network_id, default_uplink, load_balancing = _ACTION.unpack_from(data, offset)
+                offset += _ACTION.size
+                append(('A', t, strings[network_id], default_uplink, bool(load_balancing)))
+            else:
+                raise ProbeRecorderError("Unknown record type %r at offset %d in %s" % (record_type, offset, path))
+    except struct.error:
+        # a log that is still being written (or was cut short by a crash) can end in a partial record
+        pass
+    return kind.rstrip(b'\0').decode('ascii'), records
@@ -0,0 +1,90 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Decides which devices get pinged in each cycle of MX_uplink_monitor_selector.py when adaptive_probing is on.
+# Devices that have been calm are only probed every base_interval seconds, while devices showing any trouble or
+# waiting to fail back are probed in every cycle. With threaded_probing the probe thread takes the due devices while
+# the main thread reschedules them, so every operation holds a lock.
+
+import heapq
+import threading
+
+
+class AdaptiveProbeScheduler(object):
+
+    def __init__(self, base_interval):
+        """
+        base_interval is the number of seconds between probes of a calm device. Boosted devices are due again in
+        the very next cycle.
+        """
+        self.base_interval = base_interval
+        self._heap = []
+        self._next_due = {}
+        self.boosted = set()
+        self._lock = threading.Lock()
+
+    def add(self, key, now):
+        # new devices are probed right away
+        with self._lock:
+            self._schedule(key, now)
+
+    def remove(self, key):
+        # the stale heap entry is skipped when it comes up
+        with self._lock:
+            self._next_due.pop(key, None)
+            self.boosted.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+            self._next_due = {}
+            self.boosted = set()
+
+    def _schedule(self, key, due):
+        self._next_due[key] = due
+        heapq.heappush(self._heap, (due, key))
+
+    def due(self, now):
+        """
+        Pops and returns all keys due at or before now. Every returned key must be rescheduled with reschedule().
+        """
+        keys = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                due, key = heapq.heappop(heap)
+                if self._next_due.get(key) == due:
+                    del self._next_due[key]
+                    keys.append(key)
+        return keys
+
+    def reschedule(self, key, now, boosted):
+        with self._lock:
+            if boosted:
+                self.boosted.add(key)
+                self._schedule(key, now)
+            else:
+                self.boosted.discard(key)
+                self._schedule(key, now + self.base_interval)
+
+    def defer(self, key, now):
+        # a key returned by due() that was not probed after all is due again in the next cycle, boosted or not as it was
+        with self._lock:
+            self._schedule(key, now)
+
+    def __len__(self):
+        return len(self._next_due)
@@ -0,0 +1,349 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Replays a probe log recorded by either selector script (see record_file in the scripts) through the very same
+# WAN_device.uplink_selector() logic, driven by a virtual clock instead of real time and with uplink changes
+# captured instead of sent to the Dashboard. A grid of threshold values can be swept in parallel across all CPU
+# cores to see how each combination would have behaved on the recorded traffic.
+#
+# Example:
+#     $ python replay.py capture.mxrl --grid trouble_eval_window=10,20,30 average_latency_tolerance=0.3,0.4 \
+#           period_loss_report_tolerance=8,12 failback_wait_time=60,120
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+from probe_recorder import read_log
+
+SELECTORS = {
+    'icmp': 'MX_uplink_monitor_selector',
+    'dashboard': 'MX_dashboard_uplink_monitor_selector',
+}
+
+# the Dashboard only returns samples from between 7 and 2 minutes ago
+DASHBOARD_OLDEST_SAMPLE = 420
+DASHBOARD_NEWEST_SAMPLE = 120
+
+_worker_log = None
+
+
+class VirtualClock(object):
+    """
+    Stands in for the selectors' clock(). Time only moves when the replay sets it.
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def load_selector(kind):
+    """
+    Imports the selector module a log was recorded with, without any of its side effects reaching the console.
+    """
+    os.environ.setdefault('MERAKI_DASHBOARD_API_KEY', 'replay')
+    selector = __import__(SELECTORS[kind])
+    selector.log.disabled = True
+    selector.recorder = None
+    return selector
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(int(len(ordered) * pct / 100.0), len(ordered) - 1)]
+
+
+def _is_bad_ping(selector, value):
+    return value == -1 or (value is not None and value > selector.average_latency_tolerance)
+
+
+def _is_bad_burst(selector, stats):
+    return stats.loss > selector.burst_loss_tolerance or \
+           (stats.avg is not None and stats.avg > selector.average_latency_tolerance)
+
+
+def _is_bad_point(selector, loss, latency):
+    return (loss is not None and loss > selector.average_loss_tolerance) or \
+           (latency is not None and latency / 1000 > selector.average_latency_tolerance)
+
+
+def replay(selector, kind, records, params, flap_window=600, keep_actions=False):
+    """
+    Runs the recorded records through selector with the module level thresholds overridden by params and returns
+    a dict of results: number of failovers and failbacks, flaps (a failover within flap_window seconds of the last
+    failback of the same device) and time to detect statistics, measured from the first bad sample of an episode
+    on the uplink that was failed away from. With keep_actions the uplink changes made are returned as well, as a
+    list of (time, serial, default uplink, load balancing) tuples under 'actions'.
+    """
+    for name, value in params.items():
+        setattr(selector, name, value)
+    eval_window = selector.trouble_eval_window
+
+    clock = VirtualClock()
+    selector.clock = clock
+    actions = []
+    if kind == 'icmp':
+        selector.isTestConnDown.clear()
+        selector.correlator = None
+
+    first_cycle = next((r[1] for r in records if r[0] == 'C'), 0.0)
+    clock.now = first_cycle
+    devices = {}
+    serial_of_network = {}
+    # per (serial, uplink): start of the current run of bad samples and time of the last bad sample
+    onset = {}
+    last_bad = {}
+    # dashboard variant: per (serial, uplink) list of (ts, loss, latency) samples seen so far
+    points = {}
+    pending = {}
+    # the devices changed since the last evaluation, the correlation index of the ping variant has to be rebuilt
+    devices_changed = True
+    cycle_time = None
+    cycles = 0
+
+    def capture_action(networkId, load_balancing, default_uplink):
+        # the onset of the bad samples on the uplinks being failed away from is taken right now, later good samples
+        # would otherwise clear it
+        serial = serial_of_network.get(networkId)
+        actions.append((clock.now, networkId, default_uplink, load_balancing,
+                        failed_onset(serial, devices.get(serial), default_uplink)))
+
+    def failed_onset(serial, device, default_uplink):
+        # the selectors change the uplink selection before their device state, which still tells the uplinks in use:
+        # all the selectable ones while load balancing, the current one otherwise. The earliest onset of those other
+        # than the new default uplink counts
+        if device is None:
+            return None
+        if getattr(device, 'isLoadbalancing', device.current_uplink == 1):
+            failed = [uplink for uplink in range(1, len(device.uplinks) + 1)
+                      if device.uplinks[uplink - 1] in selector.selectable_uplinks]
+        else:
+            failed = (device.current_uplink,)
+        onsets = [onset[(serial, uplink)] for uplink in failed
+                  if device.uplinks[uplink - 1] != default_uplink and (serial, uplink) in onset]
+        return min(onsets) if onsets else None
+
+    selector.set_uplink_selection = capture_action
+
+    def note_sample(key, t, bad):
+        if bad:
+            if key not in onset:
+                onset[key] = t
+            last_bad[key] = t
+        elif key in onset and t - last_bad[key] > eval_window:
+            del onset[key]
+
+    def evaluate(t):
+        nonlocal devices_changed
+        clock.now = t
+        if kind == 'icmp':
+            if devices_changed:
+                selector.allMXDevices = devices
+                selector.build_correlation_index()
+                devices_changed = False
+            # devices without results in a cycle were not pinged in it (adaptive_probing), just like in ping_cycle()
+            selector.evaluate_devices(pending, [serial for serial in devices if serial in pending])
+        else:
+            for serial, device in devices.items():
+                ulinks = [None] * len(device.uplinks)
+                for uplink in range(1, len(ulinks) + 1):
+                    samples = points.get((serial, uplink))
+                    if samples is None:
+                        continue
+                    while samples and samples[0][0] < t - DASHBOARD_OLDEST_SAMPLE:
+                        samples.pop(0)
+                    ulinks[uplink - 1] = [{'ts': datetime.fromtimestamp(ts).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                           'lossPercent': loss, 'latencyMs': latency}
+                                          for ts, loss, latency in samples if ts <= t - DASHBOARD_NEWEST_SAMPLE]
+                device.uplink_selector(ulinks)
+
+    for record in records:
+        record_type = record[0]
+        if record_type == 'P' or record_type == 'B':
+            _, serial, uplink, value = record
+            if record_type == 'B':
+                value = selector.BurstStats(value)
+            values = pending.get(serial)
+            if values is None:
+                values = pending[serial] = [None] * (len(devices[serial].uplinks) if serial in devices else 2)
+            if uplink <= len(values):
+                values[uplink - 1] = value
+            note_sample((serial, uplink), cycle_time, _is_bad_burst(selector, value) if record_type == 'B'
+                        else _is_bad_ping(selector, value))
+        elif record_type == 'D':
+            _, serial, uplink, ts, loss, latency = record
+            points.setdefault((serial, uplink), []).append((ts, loss, latency))
+            note_sample((serial, uplink), ts, _is_bad_point(selector, loss, latency))
+        elif record_type == 'C':
+            if cycle_time is not None:
+                evaluate(cycle_time)
+                cycles += 1
+            cycle_time = record[1]
+            pending = {}
+        elif record_type == 'V':
+            _, serial, networkId, ip1, ip2, current_uplink, is_lb, is_nlb = record
+            if kind == 'icmp':
+                devices[serial] = selector.WAN_device(networkId=networkId, serial=serial, my_org_number='replay',
+                                                      uplink1_ip=ip1, uplink2_ip=ip2, current_uplink=current_uplink,
+                                                      is_load_balancing=is_lb, is_NLB=is_nlb)
+                if serial.startswith('tester'):
+                    selector.isTestConnDown[ip1] = False
+            else:
+                devices[serial] = selector.WAN_device(networkId=networkId, serial=serial, my_org_number='replay',
+                                                      uplink1_ip=ip1, uplink2_ip=ip2)
+                devices[serial].current_uplink = current_uplink
+            serial_of_network[networkId] = serial
+            devices_changed = True
+        elif record_type == 'U':
+            _, serial, uplink, name, ip = record
+            if serial in devices and uplink == len(devices[serial].uplinks) + 1:
+                devices[serial].add_uplink(name, ip)
+                devices_changed = True
+    if cycle_time is not None:
+        evaluate(cycle_time)
+        cycles += 1
+
+    failovers = 0
+    failbacks = 0
+    flaps = 0
+    detect_times = []
+    last_failback = {}
+    for t, networkId, default_uplink, load_balancing, bad_since in actions:
+        serial = serial_of_network.get(networkId)
+        device = devices.get(serial)
+        is_nlb = getattr(device, 'isNLB', False)
+        if load_balancing or (is_nlb and default_uplink == 'wan1'):
+            failbacks += 1
+            last_failback[serial] = t
+            continue
+        failovers += 1
+        if serial in last_failback and t - last_failback[serial] <= flap_window:
+            flaps += 1
+        if bad_since is not None:
+            detect_times.append(t - bad_since)
+
+    result = dict(params)
+    result.update({
+        'cycles': cycles,
+        'failovers': failovers,
+        'failbacks': failbacks,
+        'flaps': flaps,
+        'detect_mean_s': sum(detect_times) / len(detect_times) if detect_times else None,
+        'detect_p50_s': percentile(detect_times, 50),
+        'detect_max_s': max(detect_times) if detect_times else None,
+    })
+    if keep_actions:
+        result['actions'] = [(t, serial_of_network.get(networkId), default_uplink, load_balancing)
+                             for t, networkId, default_uplink, load_balancing, _ in actions]
+    return result
+
+
+def _init_worker(path):
+    global _worker_log
+    kind, records = read_log(path)
+    _worker_log = (load_selector(kind), kind, records)
+
+
+def _replay_in_worker(task):
+    params, flap_window = task
+    selector, kind, records = _worker_log
+    start = time.perf_counter()
+    result = replay(selector, kind, records, params, flap_window)
+    result['replay_s'] = time.perf_counter() - start
+    return result
+
+
+def parse_grid(grid_args, selector):
+    """
+    Turns ['name=v1,v2', ...] into the list of all combinations of parameter dicts. Every name must be one of
+    the numeric or string settings at the top of the selector script, 'None' selects None for optional ones.
+    """
+    axes = []
+    for arg in grid_args:
+        name, _, values = arg.partition('=')
+        current = getattr(selector, name, None)
+        if isinstance(current, str) or (current is None and hasattr(selector, name)):
+            axes.append([(name, None if value == 'None' else value) for value in values.split(',')])
+            continue
+        if isinstance(current, bool) or not isinstance(current, (int, float)):
+            raise ValueError("%s is not a numeric or string setting of %s" % (name, selector.__name__))
+        parsed = []
+        for value in values.split(','):
+            number = float(value)
+            parsed.append(int(number) if number.is_integer() and isinstance(current, int) else number)
+        axes.append([(name, value) for value in parsed])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recorded probe log through the uplink selector logic')
+    parser.add_argument('log', help='probe log written by one of the selector scripts (record_file)')
+    parser.add_argument('--grid', nargs='*', default=[],
+                        help='parameter values to sweep, e.g. trouble_eval_window=10,20 failback_wait_time=60,120')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='parallel replay processes')
+    parser.add_argument('--flap-window', type=float, default=600,
+                        help='a failover within this many seconds of a failback of the same device is a flap')
+    parser.add_argument('--csv', help='also write the results to this CSV file')
+    args = parser.parse_args(argv)
+
+    kind, records = read_log(args.log)
+    selector = load_selector(kind)
+    grid = parse_grid(args.grid, selector) or [{}]
+    cycle_times = [r[1] for r in records if r[0] == 'C']
+    recorded_span = cycle_times[-1] - cycle_times[0] if len(cycle_times) > 1 else 0.0
+    print('%s log with %d records, %d cycles spanning %.0f seconds; replaying %d parameter set(s)' % (
+        kind, len(records), len(cycle_times), recorded_span, len(grid)))
+
+    tasks = [(params, args.flap_window) for params in grid]
+    start = time.perf_counter()
+    if args.workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(args.workers, len(tasks)), initializer=_init_worker,
+                                  initargs=(args.log,)) as pool:
+            results = pool.map(_replay_in_worker, tasks)
+    else:
+        _init_worker(args.log)
+        results = [_replay_in_worker(task) for task in tasks]
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        settings = ' '.join('%s=%s' % (name, result[name]) for name in grid[0])
+        detect = 'n/a' if result['detect_mean_s'] is None else '%.1fs mean/%.1fs p50/%.1fs max' % (
+            result['detect_mean_s'], result['detect_p50_s'], result['detect_max_s'])
+        print('%s failovers=%d failbacks=%d flaps=%d time_to_detect=%s (x%.0f real time)' % (
+            settings, result['failovers'], result['failbacks'], result['flaps'], detect,
+            recorded_span / result['replay_s'] if result['replay_s'] else 0))
+    print('replayed %d parameter set(s) in %.2f seconds' % (len(results), elapsed))
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
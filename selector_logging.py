@@ -0,0 +1,148 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Leveled, structured logging shared by both selector scripts.
+# Records are handed to a queue from the monitoring loop and formatted/written as JSON lines by a background
+# listener thread, so a slow terminal or disk never throttles the ping or Dashboard polling cadence.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+_listener = None
+
+
+class JSONLineFormatter(logging.Formatter):
+    """
+    Formats a log record as a single JSON object per line. Any structured fields passed in with
+    extra={'fields': {...}} are merged into the top level of the object.
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    The stock QueueHandler formats the message in the calling thread before queueing it. Since listener and
+    producer live in the same process we can hand over the record untouched and let the listener do the work.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class ReadingSampler(logging.Filter):
+    """
+    Lets through only 1 of every 'every' records that carry the same sample_key (typically the device serial).
+    Records without a sample_key (state changes, errors, cycle summaries) are never dropped.
+    """
+
+    def __init__(self, every=1):
+        super().__init__()
+        self.every = max(int(every), 1)
+        self._counts = {}
+
+    def filter(self, record):
+        key = getattr(record, 'sample_key', None)
+        if key is None or self.every == 1:
+            return True
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        return count % self.every == 0
+
+
+def setup_logging(name, level='INFO', log_file=None, sample_every=1):
+    """
+    Configures the logger called 'name' to push records onto an unbounded queue that a QueueListener drains
+    in the background, writing JSON lines to log_file (or stdout if None). Returns the logger.
+    """
+    global _listener
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.propagate = False
+    for old_filter in list(logger.filters):
+        logger.removeFilter(old_filter)
+    logger.addFilter(ReadingSampler(sample_every))
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    logger.handlers = []
+
+    if log_file:
+        target = logging.FileHandler(log_file)
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JSONLineFormatter())
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_DeferredQueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=False)
+    _listener.start()
+    atexit.register(stop_logging)
+    return logger
+
+
+def stop_logging():
+    """
+    Flushes anything still in the queue and stops the background listener.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_event(logger, level, msg, *args, **fields):
+    """
+    Logs a structured record. Formatting of msg with args is deferred until the listener thread writes it, and
+    nothing is built at all if the level is not enabled.
+    A 'sample_key' keyword marks the record as a routine reading subject to ReadingSampler.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    extra = {'fields': fields}
+    if 'sample_key' in fields:
+        extra['sample_key'] = fields.pop('sample_key')
+    logger.log(level, msg, *args, extra=extra)
+
+
+def log_state_change(logger, event, serial, networkId, msg, *args, **fields):
+    """
+    State changes (failover, failback, load balancing toggles) are always logged, bypassing both the configured
+    level and the reading sampler, so quieting routine readings can never hide a decision.
+    """
+    fields.update({'event': event, 'serial': serial, 'networkId': networkId})
+    record = logger.makeRecord(logger.name, logging.WARNING, '(state change)', 0, msg, args, None,
+                               extra={'fields': fields})
+    logger.handle(record)
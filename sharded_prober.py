@@ -0,0 +1,344 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Runs MX_uplink_monitor_selector.py split across several processes for fleets too large for one Python process.
+#
+# The supervisor (this process) reads the device inventory from the Dashboard and splits the devices by serial into
+# shard_count shards. Each shard is pinged and evaluated by its own worker process with its own MultiPing and
+# WAN_device objects, using the settings at the top of MX_uplink_monitor_selector.py. Every worker also pings the
+# scriptConnTestDestinations itself. Uplink changes decided by the workers are not sent to the Dashboard by them but
+# queued to a single writer process, which makes the calls one at a time so the organization wide API rate limit is
+# still respected.
+#
+# Workers send a snapshot of their WAN_device objects to the supervisor every shard_snapshot_interval seconds. When the
+# inventory changes, shards are rebalanced: devices stay in their shard where possible and the ones that have to move
+# take their latest state with them. A crashed worker is restarted from the latest snapshot of its shard, and a
+# crashed writer is simply restarted (the queued uplink changes are kept).
+#
+# Run it as root, like the selector script:
+#     $ sudo python sharded_prober.py
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+import MX_uplink_monitor_selector as selector
+from dashboard_orgs import LazyDashboardAPI
+from selector_logging import setup_logging, log_event, log_state_change
+from task_scheduler import TaskScheduler
+
+# number of worker processes pinging and evaluating devices
+shard_count=os.cpu_count() or 1
+
+# number of seconds between the state snapshots every worker sends to the supervisor. A restarted worker loses at most
+# this much of its evaluation history
+shard_snapshot_interval=10
+
+# number of seconds to wait for the workers to answer a snapshot request before rebalancing with older snapshots
+shard_snapshot_timeout=15
+
+# number of seconds between inventory refreshes from the Dashboard
+inventory_refresh_interval=3600
+
+log = selector.log
+
+# workers and writer are spawned (not forked) so each gets its own logging thread and Dashboard client
+_mp = multiprocessing.get_context('spawn')
+
+
+def assign_shards(serials, current, count):
+    """
+    Returns a dict with the shard number of every serial. Serials keep the shard they have in 'current' while it
+    exists, new serials go to the smallest shards and then devices are moved from the largest to the smallest shards
+    until no two shards differ in size by more than one.
+    """
+    shards = [[] for _ in range(count)]
+    new = []
+    for serial in sorted(serials):
+        shard = current.get(serial)
+        if shard is not None and 0 <= shard < count:
+            shards[shard].append(serial)
+        else:
+            new.append(serial)
+    for serial in new:
+        min(shards, key=len).append(serial)
+    while True:
+        largest = max(shards, key=len)
+        smallest = min(shards, key=len)
+        if len(largest) - len(smallest) <= 1:
+            break
+        smallest.append(largest.pop())
+    return {serial: shard for shard, members in enumerate(shards) for serial in members}
+
+
+def apply_settings(settings):
+    # spawned processes import MX_uplink_monitor_selector afresh, so settings changed at run time have to be applied
+    # again in each of them
+    for name, value in settings.items():
+        setattr(selector, name, value)
+    if set(settings) & {'log_level', 'log_file', 'log_reading_sample_rate'}:
+        selector.log = setup_logging(selector.log.name, level=selector.log_level, log_file=selector.log_file,
+                                     sample_every=selector.log_reading_sample_rate)
+    if 'dashboard_base_url' in settings:
+        selector.dashboard = LazyDashboardAPI(selector.api_key, base_url=selector.dashboard_base_url,
+                                              output_log=False, suppress_logging=True)
+
+
+def _queue_uplink_selection(decisions):
+    # stands in for set_uplink_selection() in the workers: the change is recorded as usual but sent to the writer
+    def queue_uplink_selection(networkId, load_balancing, default_uplink):
+        if selector.recorder is not None:
+            selector.recorder.record_action(selector.clock(), networkId, default_uplink, load_balancing)
+        decisions.put((selector.orgOfNetwork.get(networkId), networkId, load_balancing, default_uplink))
+    return queue_uplink_selection
+
+
+def _worker_main(index, conn, decisions, devices, settings, snapshot_interval):
+    apply_settings(settings)
+    selector.set_uplink_selection = _queue_uplink_selection(decisions)
+    if selector.record_file:
+        selector.recorder = selector.ProbeRecorder('%s.shard%d' % (selector.record_file, index), 'icmp')
+    selector.load_devices(devices)
+    log_event(log, logging.INFO, "shard %d monitoring %d devices", index, len(devices), shard=index,
+              devices=len(devices))
+
+    # the same deadline scheduling as the main loop of the selector script: the ping cycles at a fixed rate, the
+    # failback checks right when their failback_wait_time is over and the commands of the supervisor in between
+    tasks = TaskScheduler(miss_tolerance=selector.task_miss_tolerance, log=log)
+
+    def handle_commands():
+        while True:
+            try:
+                if not conn.poll():
+                    return
+                command, payload = conn.recv()
+            except (EOFError, OSError):
+                # the supervisor is gone
+                tasks.stop()
+                return
+            if command == 'assign':
+                selector.load_devices(payload)
+                log_event(log, logging.INFO, "shard %d now monitoring %d devices", index, len(payload),
+                          shard=index, devices=len(payload))
+            elif command == 'snapshot':
+                conn.send(('snapshot', payload, selector.allMXDevices))
+            elif command == 'stop':
+                conn.send(('snapshot', payload, selector.allMXDevices))
+                tasks.stop()
+                return
+
+    def probe_cycle():
+        if len(selector.allUplinkIPs) > 0:
+            selector.ping_cycle()
+
+    def send_snapshot():
+        conn.send(('snapshot', None, selector.allMXDevices))
+
+    def start_failback_timer(device, due):
+        tasks.call_later(due - selector.clock() + selector.task_miss_tolerance, selector.check_failback, device,
+                         name='failback')
+
+    selector.failback_timer = start_failback_timer
+    tasks.every(0.2, handle_commands, name='commands')
+    tasks.every(selector.longest_probe_wait() + selector.inter_ping_delay, probe_cycle, name='probe')
+    tasks.every(snapshot_interval, send_snapshot, name='snapshot', first_delay=snapshot_interval)
+    tasks.run()
+
+
+def _writer_main(decisions, settings):
+    # the only process calling the Dashboard to change uplinks. set_uplink_selection() paces the calls
+    apply_settings(settings)
+    while True:
+        decision = decisions.get()
+        if decision is None:
+            return
+        the_org_id, networkId, load_balancing, default_uplink = decision
+        if the_org_id is not None:
+            # so set_uplink_selection() uses the client and rate limiter of the right organization
+            selector.orgOfNetwork[networkId] = the_org_id
+        try:
+            selector.set_uplink_selection(networkId, load_balancing, default_uplink)
+        except Exception:
+            log.exception("Error updating uplink selection of network %s", networkId)
+
+
+class Supervisor(object):
+
+    def __init__(self, count, settings=None):
+        """
+        count is the number of worker processes. settings is an optional dict of MX_uplink_monitor_selector.py
+        setting names and values that override the ones in the script, in this process and in every worker and writer.
+        """
+        self.count = count
+        self.settings = dict(settings or {})
+        apply_settings(self.settings)
+        self.decisions = _mp.Queue()
+        self.writer = None
+        self.workers = [None] * count
+        self.conns = [None] * count
+        # latest known WAN_device object of every device, and the tester objects of each shard
+        self.snapshots = {}
+        self.shard_testers = [{} for _ in range(count)]
+        self.assignment = {}
+        self._snapshot_seq = 0
+
+    def start_writer(self):
+        self.writer = _mp.Process(target=_writer_main, args=(self.decisions, self.settings), name='uplink-writer', daemon=True)
+        self.writer.start()
+
+    def shard_devices(self, index):
+        devices = {serial: self.snapshots[serial] for serial, shard in self.assignment.items() if shard == index}
+        devices.update(self.shard_testers[index])
+        return devices
+
+    def start_worker(self, index):
+        parent_conn, child_conn = _mp.Pipe()
+        worker = _mp.Process(target=_worker_main, args=(index, child_conn, self.decisions, self.shard_devices(index),
+                                                             self.settings, shard_snapshot_interval),
+                             name='prober-shard-%d' % index, daemon=True)
+        worker.start()
+        child_conn.close()
+        self.workers[index] = worker
+        self.conns[index] = parent_conn
+
+    def store_snapshot(self, index, devices):
+        for serial, device in devices.items():
+            if serial[0 : 6] == 'tester':
+                self.shard_testers[index][serial] = device
+            elif self.assignment.get(serial) == index:
+                self.snapshots[serial] = device
+
+    def receive(self, timeout):
+        # handles snapshots arriving from the workers, returns the sequence numbers of requested snapshots received
+        answered = set()
+        conns = [conn for conn in self.conns if conn is not None]
+        for conn in multiprocessing.connection.wait(conns, timeout):
+            index = self.conns.index(conn)
+            try:
+                _, seq, devices = conn.recv()
+            except (EOFError, OSError):
+                # the worker died, check_processes() restarts it
+                self.conns[index] = None
+                continue
+            self.store_snapshot(index, devices)
+            if seq is not None:
+                answered.add((index, seq))
+        return answered
+
+    def request_snapshots(self, command='snapshot'):
+        # asks every worker for its current state and waits for the answers, so devices changing shards carry it along
+        self._snapshot_seq += 1
+        seq = self._snapshot_seq
+        waiting = set()
+        for index, conn in enumerate(self.conns):
+            if conn is not None and self.workers[index].is_alive():
+                try:
+                    conn.send((command, seq))
+                    waiting.add((index, seq))
+                except (EOFError, OSError):
+                    self.conns[index] = None
+        deadline = time.monotonic() + shard_snapshot_timeout
+        while waiting and time.monotonic() < deadline:
+            waiting -= self.receive(max(deadline - time.monotonic(), 0))
+        for index, _ in waiting:
+            log.warning("shard %d did not answer the snapshot request, using its previous snapshot", index)
+
+    def refresh_inventory(self):
+        selector.refreshDevicesDict()
+        fresh = selector.allMXDevices
+        testers = {serial: device for serial, device in fresh.items() if serial[0 : 6] == 'tester'}
+        devices = {serial: device for serial, device in fresh.items() if serial[0 : 6] != 'tester'}
+
+        if any(worker is not None for worker in self.workers):
+            self.request_snapshots()
+        for serial, device in devices.items():
+            known = self.snapshots.get(serial)
+            if known is not None and (known.networkId, known.uplinks, known.uplink_ips) == \
+                    (device.networkId, device.uplinks, device.uplink_ips):
+                # keep the evaluation history of devices already being monitored
+                known.isNLB = device.isNLB
+                devices[serial] = known
+        self.snapshots = devices
+        for index in range(self.count):
+            for serial, device in testers.items():
+                self.shard_testers[index].setdefault(serial, device)
+            for serial in list(self.shard_testers[index]):
+                if serial not in testers:
+                    del self.shard_testers[index][serial]
+
+        previous = self.assignment
+        self.assignment = assign_shards(devices, previous, self.count)
+        moved = sum(1 for serial, shard in self.assignment.items() if serial in previous and previous[serial] != shard)
+        log_event(log, logging.INFO, "Monitoring %d devices in %d shards", len(devices), self.count,
+                  devices=len(devices), shards=self.count, moved=moved)
+
+        for index in range(self.count):
+            if self.workers[index] is None or not self.workers[index].is_alive():
+                continue
+            try:
+                self.conns[index].send(('assign', self.shard_devices(index)))
+            except (EOFError, OSError, AttributeError):
+                self.conns[index] = None
+
+    def check_processes(self):
+        if self.writer is None or not self.writer.is_alive():
+            if self.writer is not None:
+                log_state_change(log, 'writer_restart', None, None, 'uplink writer process exited with code %s, restarting',
+                                 self.writer.exitcode)
+            self.start_writer()
+        for index, worker in enumerate(self.workers):
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    log_state_change(log, 'shard_restart', None, None,
+                                     'shard %d process exited with code %s, restarting from its last snapshot',
+                                     index, worker.exitcode, shard=index)
+                    self.receive(0)
+                self.start_worker(index)
+
+    def stop(self):
+        self.request_snapshots('stop')
+        for worker in self.workers:
+            if worker is not None:
+                worker.join(5)
+                if worker.is_alive():
+                    worker.terminate()
+        if self.writer is not None:
+            self.decisions.put(None)
+            self.writer.join(30)
+
+    def run(self):
+        self.refresh_inventory()
+        last_refresh = time.monotonic()
+        try:
+            while True:
+                self.check_processes()
+                self.receive(1.0)
+                if time.monotonic() - last_refresh >= inventory_refresh_interval:
+                    self.refresh_inventory()
+                    last_refresh = time.monotonic()
+        finally:
+            self.stop()
+
+
+def main():
+    Supervisor(shard_count).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Shared-fate correlation for MX_uplink_monitor_selector.py. When a transit provider, or the path from the script to a
+# region, has a problem, the uplinks of many sites go bad in the same ping cycle; failing all of them over only flaps
+# them and burns Dashboard API calls. The uplinks are grouped once per inventory by ISP/ASN or region (from a file of
+# prefixes) or else by their IP prefix, and once per ping cycle the fraction of each group's pinged uplinks with a bad
+# result is computed. A group in which enough uplinks went bad together is held: devices whose troubled uplinks belong
+# to it make no uplink changes until it has been back to normal for a while.
+
+import collections
+import ipaddress
+
+
+def load_group_prefixes(path):
+    """
+    Reads a file with one "prefix group" pair per line, such as "203.0.113.0/24 AS64500", to name the group of the
+    uplinks in each prefix. Blank lines and lines starting with # are skipped.
+    """
+    prefixes = []
+    with open(path) as prefixes_file:
+        for number, line in enumerate(prefixes_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError("%s:%d: expected a prefix and a group name" % (path, number))
+            prefixes.append((ipaddress.ip_network(fields[0], strict=False), fields[1]))
+    return prefixes
+
+
+class SharedFateCorrelator(object):
+
+    def __init__(self, threshold=0.5, min_degraded=5, hold_time=20, prefix_length=24, prefix_length_v6=48,
+                 group_prefixes=()):
+        """
+        A group is held when at least min_degraded of its pinged uplinks, and at least threshold (a fraction) of them,
+        had a bad result in the same cycle, and released hold_time seconds after the last cycle that did. Uplinks
+        in none of group_prefixes, a list of (ip_network, name), are grouped by their prefix_length (IPv4) or
+        prefix_length_v6 (IPv6) prefix.
+        """
+        self.threshold = threshold
+        self.min_degraded = min_degraded
+        self.hold_time = hold_time
+        self.prefix_length = prefix_length
+        self.prefix_length_v6 = prefix_length_v6
+        # longest prefixes first, so the most specific one names the group
+        self._prefixes = sorted(group_prefixes, key=lambda prefix: prefix[0].prefixlen, reverse=True)
+        # the group of every uplink of every device, indexed like its uplinks (None when it has no IP)
+        self.groups_of = {}
+        # time at which each held group is released
+        self.held_groups = {}
+
+    def group_of(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        for network, name in self._prefixes:
+            if address.version == network.version and address in network:
+                return name
+        length = self.prefix_length if address.version == 4 else self.prefix_length_v6
+        return str(ipaddress.ip_network((address, length), strict=False))
+
+    def build(self, devices):
+        # indexes the uplinks of devices, an iterable of (serial, list of uplink IPs)
+        self.groups_of = {serial: [self.group_of(ip) if ip else None for ip in ips] for serial, ips in devices}
+        self.held_groups = {group: release for group, release in self.held_groups.items()
+                            if any(group in groups for groups in self.groups_of.values())}
+
+    def correlate(self, responsesPerSerial, is_bad, now):
+        """
+        Runs once per ping cycle over its results, one value per uplink by serial; is_bad tells whether a value is a
+        bad result. Returns the groups that were just held, as (group, degraded, pinged) tuples, and those released.
+        """
+        pinged = collections.Counter()
+        degraded = collections.Counter()
+        groups_of = self.groups_of
+        for serial, values in responsesPerSerial.items():
+            groups = groups_of.get(serial)
+            if groups is None:
+                continue
+            for group, value in zip(groups, values):
+                if group is None or value is None:
+                    continue
+                pinged[group] += 1
+                if is_bad(value):
+                    degraded[group] += 1
+
+        held = []
+        for group, count in degraded.items():
+            if count >= self.min_degraded and count >= self.threshold * pinged[group]:
+                if group not in self.held_groups:
+                    held.append((group, count, pinged[group]))
+                self.held_groups[group] = now + self.hold_time
+        released = [group for group, release in self.held_groups.items() if release <= now]
+        for group in released:
+            del self.held_groups[group]
+        return held, released
+
+    def is_held(self, serial, unstable):
+        # True if one of the uplinks of the device that unstable flags is in a held group
+        if not self.held_groups:
+            return False
+        groups = self.groups_of.get(serial, ())
+        return any(unstable[i] and group in self.held_groups for i, group in enumerate(groups) if i < len(unstable))
@@ -0,0 +1,357 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Incremental availability and SLA counters of the devices monitored by MX_uplink_monitor_selector.py, so per-site
+# monthly reports do not need to scan the logs. Every evaluation of a device adds the time since its previous one to
+# the counters of the state the device was in: the time each uplink was healthy and unstable, the time spent off WAN1
+# and the time with load balancing off. Failovers and failbacks are counted, along with the time to detect of every
+# failover: from the first bad ping of the incident (lost, or slower than average_latency_tolerance) on the uplinks
+# failed away from to the failover. Time the device was not evaluated (script stopped, network pinned) is left out.
+# The counters are kept per UTC day and per UTC month, so the report of any range of days adds up the whole months in
+# it and the days around them. Only the counters of the current day and month change; they are checkpointed to a JSON
+# file per day and per month in the SLA directory, which is where the reports of past periods are read from.
+#
+# Example, the June report of all devices as CSV:
+#     $ python sla_rollups.py sla/ --start 2020-06-01 --end 2020-07-01 --csv june.csv
+
+import argparse
+import calendar
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+from selector_logging import log_event
+
+DAY = 86400
+
+# counters of a device, followed by UPLINK_COUNTERS for each of its uplinks
+COUNTERS = ('observed_s', 'off_primary_s', 'lb_off_s', 'failovers', 'failbacks', 'detect_sum_s', 'detect_count',
+            'detect_max_s')
+UPLINK_COUNTERS = ('healthy_s', 'unstable_s')
+_OBSERVED, _OFF_PRIMARY, _LB_OFF, _FAILOVERS, _FAILBACKS, _DETECT_SUM, _DETECT_COUNT, _DETECT_MAX = range(len(COUNTERS))
+
+
+class _DeviceState(object):
+    __slots__ = ('t', 'healthy', 'unstable', 'on_primary', 'load_balancing', 'onset', 'last_bad')
+
+    def __init__(self):
+        # time and state of the latest evaluation (t is None before the first one)
+        self.t = None
+        self.healthy = ()
+        self.unstable = ()
+        self.on_primary = True
+        self.load_balancing = True
+        # per uplink: first and latest bad ping of the current incident
+        self.onset = []
+        self.last_bad = []
+
+
+def _day_keys(day):
+    gmt = time.gmtime(day)
+    return 'day-%04d-%02d-%02d' % gmt[:3], 'month-%04d-%02d' % gmt[:2]
+
+
+def parse_day(value):
+    # a YYYY-MM-DD date (UTC) or seconds since the epoch, as the start of its UTC day
+    try:
+        t = float(value)
+    except ValueError:
+        t = calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+    return t // DAY * DAY
+
+
+def period(start=None, end=None, now=None):
+    # start and end of a report from YYYY-MM-DD dates, by default from the start of the current month to today included
+    now = time.time() if now is None else now
+    if start is None:
+        gmt = time.gmtime(now)
+        start = calendar.timegm((gmt.tm_year, gmt.tm_mon, 1, 0, 0, 0))
+    else:
+        start = parse_day(start)
+    end = parse_day(now) + DAY if end is None else parse_day(end)
+    return start, end
+
+
+class SLARollups(object):
+
+    def __init__(self, log, directory, max_gap=60, quiet_period=20):
+        """
+        max_gap is the longest time between two evaluations of a device that is still counted, and quiet_period how
+        long an uplink has to go without bad pings for its incident to be over.
+        """
+        self.log = log
+        self.directory = directory
+        self.max_gap = max_gap
+        self.quiet_period = quiet_period
+        os.makedirs(directory, exist_ok=True)
+        self._devices = {}
+        self._uplinks = {}
+        # counters of the buckets (days and months) being updated by key, then by serial
+        self._buckets = {}
+        self._dirty = set()
+        self._day = None
+        self._keys = ()
+        # buckets read back from their checkpoint for reports
+        self._cache = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _read(self, key):
+        # the counters of a bucket from its checkpoint, by serial, and the uplink names of its devices
+        try:
+            with open(self._path(key)) as bucket_file:
+                stored = json.load(bucket_file)
+        except FileNotFoundError:
+            return {}, {}
+        return ({serial: device['counters'] for serial, device in stored.items()},
+                {serial: device['uplinks'] for serial, device in stored.items()})
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # carry on from the checkpoint after a restart
+            bucket, uplinks = self._read(key)
+            for serial, names in uplinks.items():
+                self._uplinks.setdefault(serial, names)
+            self._buckets[key] = bucket
+        return bucket
+
+    def _counters(self, day, serial):
+        # the counters of serial in the day and month buckets of day
+        if day != self._day:
+            self._day = day
+            self._keys = _day_keys(day)
+        size = len(COUNTERS) + len(UPLINK_COUNTERS) * len(self._uplinks[serial])
+        counters = []
+        for key in self._keys:
+            bucket = self._bucket(key)
+            device = bucket.get(serial)
+            if device is None:
+                device = bucket[serial] = [0.0] * size
+            elif len(device) < size:
+                device.extend([0.0] * (size - len(device)))
+            self._dirty.add(key)
+            counters.append(device)
+        return counters
+
+    def _accrue(self, serial, state, t):
+        # adds the time from the previous evaluation to t to the counters of the state the device was in
+        start = state.t
+        if start is None or not 0 < t - start <= self.max_gap:
+            return
+        while start < t:
+            day = start // DAY * DAY
+            end = min(t, day + DAY)
+            elapsed = end - start
+            for counters in self._counters(day, serial):
+                counters[_OBSERVED] += elapsed
+                if not state.on_primary:
+                    counters[_OFF_PRIMARY] += elapsed
+                if not state.load_balancing:
+                    counters[_LB_OFF] += elapsed
+                for i, healthy in enumerate(state.healthy):
+                    if healthy:
+                        counters[len(COUNTERS) + 2 * i] += elapsed
+                    if state.unstable[i]:
+                        counters[len(COUNTERS) + 2 * i + 1] += elapsed
+            start = end
+
+    def _state(self, serial, uplinks):
+        state = self._devices.get(serial)
+        if state is None:
+            state = self._devices[serial] = _DeviceState()
+        if len(state.onset) < len(uplinks):
+            state.onset.extend([None] * (len(uplinks) - len(state.onset)))
+            state.last_bad.extend([None] * (len(uplinks) - len(state.last_bad)))
+            self._uplinks[serial] = list(uplinks)
+        return state
+
+    def sample(self, serial, uplinks, index, t, bad):
+        # a ping result of uplink index of the device, bad if a ping was lost or too slow
+        state = self._state(serial, uplinks)
+        if bad:
+            if state.onset[index] is None:
+                state.onset[index] = t
+            state.last_bad[index] = t
+        elif state.onset[index] is not None and t - state.last_bad[index] > self.quiet_period:
+            state.onset[index] = None
+
+    def observe(self, serial, uplinks, t, healthy, unstable, on_primary, load_balancing):
+        # an evaluation of the device: whether each uplink is healthy and unstable, whether it is on WAN1 and whether
+        # load balancing is on
+        state = self._state(serial, uplinks)
+        self._accrue(serial, state, t)
+        state.t = t
+        state.healthy = healthy
+        state.unstable = unstable
+        state.on_primary = on_primary
+        state.load_balancing = load_balancing
+
+    def decision(self, serial, uplinks, t, event, on_primary, load_balancing):
+        # a state change of the device: failovers and failbacks are counted, any of them can change whether the
+        # device is on WAN1 and whether load balancing is on
+        state = self._state(serial, uplinks)
+        self._accrue(serial, state, t)
+        if state.t is not None:
+            state.t = t
+        if event in ('failover', 'failback'):
+            for counters in self._counters(t // DAY * DAY, serial):
+                if event == 'failback':
+                    counters[_FAILBACKS] += 1
+                    continue
+                counters[_FAILOVERS] += 1
+                onsets = [state.onset[i] for i, unstable in enumerate(state.unstable)
+                          if unstable and state.onset[i] is not None]
+                if onsets:
+                    detect = t - min(onsets)
+                    counters[_DETECT_SUM] += detect
+                    counters[_DETECT_COUNT] += 1
+                    counters[_DETECT_MAX] = max(counters[_DETECT_MAX], detect)
+        state.on_primary = on_primary
+        state.load_balancing = load_balancing
+
+    def checkpoint(self, now):
+        # writes the buckets changed since the last checkpoint, and stops holding the ones that are over
+        written = 0
+        for key in sorted(self._dirty):
+            bucket = self._buckets[key]
+            path = self._path(key)
+            with open(path + '.tmp', 'w') as bucket_file:
+                json.dump({serial: {'uplinks': self._uplinks.get(serial, []), 'counters': counters}
+                           for serial, counters in bucket.items()}, bucket_file)
+            os.replace(path + '.tmp', path)
+            self._cache.pop(key, None)
+            written += 1
+        self._dirty.clear()
+        current = _day_keys(now // DAY * DAY)
+        for key in [key for key in self._buckets if key not in current]:
+            del self._buckets[key]
+        log_event(self.log, logging.DEBUG, "SLA counters checkpointed", buckets=written)
+        return written
+
+    def _past(self, key):
+        # a bucket that is not being updated, read from its checkpoint once
+        cached = self._cache.get(key)
+        if cached is None:
+            if len(self._cache) >= 64:
+                self._cache.clear()
+            cached = self._cache[key] = self._read(key)
+        return cached
+
+    def report(self, start, end, serials=None):
+        """
+        Adds up the counters of every device (or only those in serials) from the UTC day of start to the one before
+        end. Returns a dict by serial with the device counters, time to detect statistics and the counters and
+        availability (percentage of the observed time healthy) of every uplink.
+        """
+        keys = []
+        day = start // DAY * DAY
+        while day < end:
+            gmt = time.gmtime(day)
+            month_end = calendar.timegm((gmt.tm_year + gmt.tm_mon // 12, gmt.tm_mon % 12 + 1, 1, 0, 0, 0))
+            if gmt.tm_mday == 1 and month_end <= end:
+                keys.append(_day_keys(day)[1])
+                day = month_end
+            else:
+                keys.append(_day_keys(day)[0])
+                day += DAY
+
+        totals = {}
+        for key in keys:
+            if key in self._buckets:
+                bucket, uplinks = self._buckets[key], self._uplinks
+            else:
+                bucket, uplinks = self._past(key)
+            for serial, counters in bucket.items():
+                if serials is not None and serial not in serials:
+                    continue
+                device = totals.get(serial)
+                if device is None:
+                    device = totals[serial] = {'counters': [0.0] * len(COUNTERS), 'uplinks': {}}
+                for i in range(len(COUNTERS)):
+                    if i == _DETECT_MAX:
+                        device['counters'][i] = max(device['counters'][i], counters[i])
+                    else:
+                        device['counters'][i] += counters[i]
+                for i, name in enumerate(uplinks.get(serial, ())):
+                    offset = len(COUNTERS) + len(UPLINK_COUNTERS) * i
+                    if offset >= len(counters):
+                        break
+                    uplink = device['uplinks'].setdefault(name, [0.0] * len(UPLINK_COUNTERS))
+                    for j in range(len(UPLINK_COUNTERS)):
+                        uplink[j] += counters[offset + j]
+
+        report = {}
+        for serial, device in totals.items():
+            counters = dict(zip(COUNTERS, device['counters']))
+            observed = counters['observed_s']
+            detect_count = counters.pop('detect_count')
+            detect_sum = counters.pop('detect_sum_s')
+            counters['failovers'] = int(counters['failovers'])
+            counters['failbacks'] = int(counters['failbacks'])
+            counters['time_to_detect_mean_s'] = detect_sum / detect_count if detect_count else None
+            counters['time_to_detect_max_s'] = counters.pop('detect_max_s') if detect_count else None
+            counters['uplinks'] = {}
+            for name, values in device['uplinks'].items():
+                uplink = dict(zip(UPLINK_COUNTERS, values))
+                uplink['availability'] = 100.0 * uplink['healthy_s'] / observed if observed else None
+                counters['uplinks'][name] = uplink
+            report[serial] = counters
+        return report
+
+
+def write_csv(report, out):
+    # one row per device and uplink
+    device_fields = [name for name in COUNTERS if not name.startswith('detect_')] + \
+                    ['time_to_detect_mean_s', 'time_to_detect_max_s']
+    writer = csv.writer(out)
+    writer.writerow(['serial'] + device_fields + ['uplink'] + list(UPLINK_COUNTERS) + ['availability'])
+    for serial in sorted(report):
+        device = report[serial]
+        for name, uplink in sorted(device['uplinks'].items()):
+            writer.writerow([serial] + [device[field] for field in device_fields] + [name] +
+                            [uplink[field] for field in UPLINK_COUNTERS] + [uplink['availability']])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report the availability and SLA counters kept by '
+                                                 'MX_uplink_monitor_selector.py')
+    parser.add_argument('directory', help='SLA directory of the selector (sla_dir)')
+    parser.add_argument('--start', help='first UTC day, YYYY-MM-DD (default: start of the current month)')
+    parser.add_argument('--end', help='UTC day after the last one, YYYY-MM-DD (default: tomorrow)')
+    parser.add_argument('--serial', nargs='*', help='only these devices')
+    parser.add_argument('--csv', help='write the report to this CSV file instead of printing it as JSON')
+    args = parser.parse_args(argv)
+
+    start, end = period(args.start, args.end)
+    rollups = SLARollups(logging.getLogger('sla_rollups'), args.directory)
+    report = rollups.report(start, end, set(args.serial) if args.serial else None)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as out:
+            write_csv(report, out)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return report
+
+
+if __name__ == '__main__':
+    main()
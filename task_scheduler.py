@@ -0,0 +1,146 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Deadline scheduler driving the main loop of the selector scripts. Every task (probe cycle, inventory refresh,
+# failback timers, ...) runs at its own deadline on the monotonic clock. Periodic tasks are scheduled at fixed rate,
+# so their timing does not drift by however long each run took. For every task name it keeps how late runs started,
+# how many missed their deadline and how many failed. A task raising an exception is logged and stays scheduled.
+
+import heapq
+import itertools
+import logging
+import time
+
+
+class Task(object):
+
+    def __init__(self, deadline, name, function, args, interval):
+        self.deadline = deadline
+        self.name = name
+        self.function = function
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TaskStats(object):
+
+    def __init__(self):
+        self.runs = 0
+        self.misses = 0
+        self.skipped = 0
+        self.failures = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def as_dict(self):
+        return {'runs': self.runs, 'misses': self.misses, 'skipped': self.skipped, 'failures': self.failures,
+                'miss_rate': self.misses / self.runs if self.runs else 0.0,
+                'mean_lateness': self.total_lateness / self.runs if self.runs else 0.0,
+                'max_lateness': self.max_lateness}
+
+
+class TaskScheduler(object):
+    """
+    A run that starts more than miss_tolerance seconds after its deadline counts as a deadline miss. When a periodic
+    task falls more than a whole interval behind, the ticks it missed are skipped (and counted) instead of run in a
+    burst. The exceptions of tasks are logged to log.
+    """
+
+    def __init__(self, miss_tolerance=0.050, clock=time.monotonic, sleep=time.sleep, log=None):
+        self.miss_tolerance = miss_tolerance
+        self.log = log if log is not None else logging.getLogger(__name__)
+        self.clock = clock
+        self.sleep = sleep
+        self._heap = []
+        self._sequence = itertools.count()
+        self.stats = {}
+        self._stopped = False
+
+    def call_at(self, deadline, function, *args, name=None, interval=None):
+        task = Task(deadline, name or getattr(function, '__name__', 'task'), function, args, interval)
+        heapq.heappush(self._heap, (deadline, next(self._sequence), task))
+        return task
+
+    def call_later(self, delay, function, *args, name=None):
+        return self.call_at(self.clock() + max(delay, 0.0), function, *args, name=name)
+
+    def every(self, interval, function, *args, name=None, first_delay=0.0):
+        return self.call_at(self.clock() + first_delay, function, *args, name=name, interval=interval)
+
+    def stop(self):
+        self._stopped = True
+
+    def next_deadline(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def run_due(self):
+        """
+        Runs every task whose deadline has passed, returns the number of tasks run.
+        """
+        ran = 0
+        while self._heap and self._heap[0][0] <= self.clock():
+            deadline, _, task = heapq.heappop(self._heap)
+            if task.cancelled:
+                continue
+            start = self.clock()
+            lateness = start - deadline
+            stats = self.stats.get(task.name)
+            if stats is None:
+                stats = self.stats[task.name] = TaskStats()
+            stats.runs += 1
+            stats.total_lateness += lateness
+            stats.max_lateness = max(stats.max_lateness, lateness)
+            if lateness > self.miss_tolerance:
+                stats.misses += 1
+            try:
+                task.function(*task.args)
+            except Exception:
+                stats.failures += 1
+                self.log.exception("task %s failed", task.name)
+            finally:
+                if task.interval is not None and not task.cancelled:
+                    next_deadline = deadline + task.interval
+                    now = self.clock()
+                    if now - next_deadline >= task.interval:
+                        behind = int((now - next_deadline) // task.interval)
+                        stats.skipped += behind
+                        next_deadline += behind * task.interval
+                    task.deadline = next_deadline
+                    heapq.heappush(self._heap, (next_deadline, next(self._sequence), task))
+            ran += 1
+        return ran
+
+    def run(self):
+        # runs tasks at their deadlines until stop() is called or no tasks are left
+        self._stopped = False
+        while not self._stopped:
+            deadline = self.next_deadline()
+            if deadline is None:
+                return
+            delay = deadline - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            self.run_due()
+
+    def stats_summary(self):
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
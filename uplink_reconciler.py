@@ -0,0 +1,133 @@
+"""
+Copyright (c) 2020 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Reads the uplink selection of the monitored networks back from the Dashboard so the selector scripts notice when it
+# was changed outside of them. Every round reads the next batch of networks (round robin, so the API calls per round
+# are bounded however many networks are monitored) on a few worker threads, each call paced by the rate limiter of
+# the network's organization. The ETag of every response is kept and sent back as If-None-Match, so an unchanged
+# uplink selection costs no response body wherever the Dashboard supports conditional requests.
+# The scripts' main thread picks up the results with results() and compares them with its own state.
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from selector_logging import log_event
+
+RECONCILE_POLICIES = ('adopt', 'enforce')
+
+
+class UplinkReconciler(object):
+
+    def __init__(self, log, base_url, concurrency=4, batch_size=100, timeout=10):
+        self.log = log
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='reconcile')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._results = queue.Queue()
+        self._etags = {}
+        self._cursor = 0
+        self._inflight = 0
+        self.fetched = 0
+        self.not_modified = 0
+        self.errors = 0
+
+    def start_round(self, networks):
+        """
+        Starts reading the uplink selection of the next batch_size of networks, a list of (networkId, OrgContext).
+        Does nothing while the previous round is still running. Returns the number of networks submitted.
+        """
+        with self._lock:
+            if self._inflight > 0 or len(networks) == 0:
+                return 0
+            if self._cursor >= len(networks):
+                self._cursor = 0
+            batch = networks[self._cursor:self._cursor + self.batch_size]
+            self._cursor += len(batch)
+            self._inflight = len(batch)
+        for networkId, monitored_org in batch:
+            self._executor.submit(self._read, networkId, monitored_org)
+        return len(batch)
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            # imported on first use, it takes longer to import than the rest of the script
+            import requests
+            session = self._local.session = requests.Session()
+        return session
+
+    def confirm(self, networks):
+        # reads the uplink selection of the given (networkId, OrgContext) right away, outside of the rounds, asking for
+        # the whole of it so there is a result even if it is what was read last time
+        for networkId, monitored_org in networks:
+            self._etags.pop(networkId, None)
+            self._executor.submit(self._read, networkId, monitored_org, False)
+
+    def _read(self, networkId, monitored_org, in_round=True):
+        try:
+            headers = {"Accept": "application/json", "X-Cisco-Meraki-API-Key": monitored_org.api_key}
+            etag = self._etags.get(networkId)
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            monitored_org.throttle()
+            read_time = time.monotonic()
+            response = self._session().get(self.base_url + '/networks/' + networkId +
+                                           '/appliance/trafficShaping/uplinkSelection',
+                                           headers=headers, timeout=self.timeout)
+            if response.status_code == 304:
+                self.not_modified += 1
+                return
+            response.raise_for_status()
+            selection = response.json()
+            if response.headers.get('ETag'):
+                self._etags[networkId] = response.headers['ETag']
+            self.fetched += 1
+            self._results.put((networkId, selection['loadBalancingEnabled'], selection['defaultUplink'], read_time))
+        except Exception as error:
+            self.errors += 1
+            log_event(self.log, logging.WARNING, "reading the uplink selection of %s failed: %s", networkId, error,
+                      networkId=networkId)
+        finally:
+            if in_round:
+                with self._lock:
+                    self._inflight -= 1
+
+    def results(self):
+        # returns the (networkId, load_balancing, default_uplink, read_time) read since the last call; read_time is on
+        # the time.monotonic() clock
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def forget(self, networkId):
+        # the next read of the network gets the full uplink selection again
+        self._etags.pop(networkId, None)
+
+    def stats(self):
+        return {'fetched': self.fetched, 'not_modified': self.not_modified, 'errors': self.errors}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)